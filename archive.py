@@ -0,0 +1,307 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# archive.py
+# 最近の発話の音声を，あらかじめ確保した1つのファイルに循環して保存する
+# 誤認識の原因を調べるため，マイクが拾った音声と認識結果，反応したプラグインを残す
+# ファイルはmmapで開き，発話ごとに1回コピーするだけで書き込む
+# (発話ごとのファイル作成やfsyncをしないので，SDカードに負担をかけない)
+#
+# 使い方:
+#   python3 archive.py list archive.bin
+#   python3 archive.py export -o outdir archive.bin [番号 ...]
+
+import os
+import sys
+import mmap
+import time
+import wave
+import struct
+import logging
+import argparse
+from collections import namedtuple
+
+from audio import AudioData
+
+
+# ファイルの先頭に置くヘッダー
+# マジックナンバー，インデックスのエントリー数，音声領域のバイト数，
+# 書き込んだ発話の数，音声領域に書き込んだバイト数(折り返さずに数える)
+HEADER = struct.Struct('<8sIQQQ')
+HEADER_SIZE = 64
+MAGIC = b'SSPKARC1'
+
+# インデックスのエントリー
+# 発話の番号，時刻，音声の位置(折り返さずに数える)，バイト数，
+# サンプリングレート，サンプル幅，プラグイン名，書き起こし
+ENTRY = struct.Struct('<QdQIIH32s192s')
+
+# 音声領域の先頭の位置をそろえる
+ALIGN = 4096
+
+DEFAULT_SIZE = 32 * 1024 * 1024
+DEFAULT_SLOTS = 1024
+
+
+# 保存した発話の情報
+ArchiveEntry = namedtuple('ArchiveEntry', ['seq', 'timestamp', 'length',
+                                           'sample_rate', 'sample_width',
+                                           'transcript', 'plugin'])
+
+
+def encode_text(txt, size):
+    """
+    文字列をUTF-8でsizeバイト以内に切り詰める(文字の途中では切らない)
+    """
+    b = (txt or '').encode('utf-8')[:size]
+    return b.decode('utf-8', 'ignore').encode('utf-8')
+
+
+def decode_text(b):
+    return b.rstrip(b'\x00').decode('utf-8', 'ignore')
+
+
+class UtteranceArchive:
+    """
+    発話の音声を循環して保存するアーカイブ
+    pathのファイルが無ければsizeバイトの音声領域とslots個のインデックスを
+    確保して作り，あればそのまま開く
+    書き込むのは1つのプロセスだけで，readonlyで開いた読み込み側は
+    読み終えた後に上書きされていないか確かめる
+    古い発話は，音声領域かインデックスを使い切ると上書きされる
+    """
+
+    def __init__(self, path, size=DEFAULT_SIZE, slots=DEFAULT_SLOTS,
+                 readonly=False):
+        self.path = path
+        self.readonly = readonly
+        if not readonly and not self._valid(path):
+            self._create(path, size, slots)
+        self.file = open(path, 'rb' if readonly else 'r+b')
+        access = mmap.ACCESS_READ if readonly else mmap.ACCESS_WRITE
+        self.mm = mmap.mmap(self.file.fileno(), 0, access=access)
+        magic, self.slots, self.size, count, head = \
+                HEADER.unpack_from(self.mm, 0)
+        if magic != MAGIC:
+            self.close()
+            raise ValueError("{} is not an utterance archive".format(path))
+        self.index_offset = HEADER_SIZE
+        self.data_offset = self.data_start(self.slots)
+
+    @staticmethod
+    def data_start(slots):
+        n = HEADER_SIZE + ENTRY.size * slots
+        return (n + ALIGN - 1) // ALIGN * ALIGN
+
+    @staticmethod
+    def _valid(path):
+        try:
+            with open(path, 'rb') as f:
+                return f.read(len(MAGIC)) == MAGIC
+        except OSError:
+            return False
+
+    def _create(self, path, size, slots):
+        """
+        アーカイブのファイルを作り，全体の領域を確保する
+        """
+        total = self.data_start(slots) + size
+        with open(path, 'wb') as f:
+            if hasattr(os, 'posix_fallocate'):
+                # 書き込み中に断片化したり，容量不足になったりしないよう確保する
+                os.posix_fallocate(f.fileno(), 0, total)
+            else:
+                f.truncate(total)
+            f.write(HEADER.pack(MAGIC, slots, size, 0, 0))
+        logging.debug("アーカイブ{}を作りました({}バイト)".format(path, total))
+
+    @property
+    def count(self):
+        """
+        これまでに保存した発話の数
+        """
+        return HEADER.unpack_from(self.mm, 0)[3]
+
+    @property
+    def head(self):
+        return HEADER.unpack_from(self.mm, 0)[4]
+
+    def append(self, ad, timestamp=None, transcript='', plugin=''):
+        """
+        AudioDataを保存して，発話の番号を返す
+        音声領域より長い音声は，先頭から音声領域の長さまでを保存する
+        """
+        data = ad.frame_data
+        n = min(len(data), self.size)
+        if n < len(data):
+            logging.warning("発話が長すぎるので，{}バイトに切り詰めます".format(n))
+        count, head = self.count, self.head
+        pos = head % self.size
+        if pos + n > self.size:
+            # 末尾に収まらないので，音声領域の先頭から書く
+            head += self.size - pos
+            pos = 0
+        off = self.data_offset + pos
+        # 上書きする範囲の発話を読み込み側が使わないよう，先にヘッダーの
+        # 書き込み位置を進めてから音声を書く
+        HEADER.pack_into(self.mm, 0, MAGIC, self.slots, self.size,
+                         count, head + n)
+        self.mm[off:off+n] = memoryview(data)[:n]
+        # インデックスを書いてから，発話の数を更新して公開する
+        self._write_entry(count, timestamp or time.time(), head, n,
+                          ad.sample_rate, ad.sample_width,
+                          transcript, plugin)
+        HEADER.pack_into(self.mm, 0, MAGIC, self.slots, self.size,
+                         count + 1, head + n)
+        return count
+
+    def _entry_offset(self, seq):
+        return self.index_offset + (seq % self.slots) * ENTRY.size
+
+    def _write_entry(self, seq, timestamp, offset, length, rate, width,
+                     transcript, plugin):
+        ENTRY.pack_into(self.mm, self._entry_offset(seq), seq, timestamp,
+                        offset, length, rate, width,
+                        encode_text(plugin, 32), encode_text(transcript, 192))
+
+    def _read_entry(self, seq):
+        """
+        seq番の発話のインデックスを読み，(エントリー, 音声の位置)を返す
+        上書きされていたらKeyErrorを投げる
+        """
+        count, head = self.count, self.head
+        if not count - self.slots <= seq < count:
+            raise KeyError(seq)
+        fields = ENTRY.unpack_from(self.mm, self._entry_offset(seq))
+        eseq, timestamp, offset, length, rate, width, plugin, txt = fields
+        if eseq != seq or offset < head - self.size:
+            raise KeyError(seq)
+        entry = ArchiveEntry(seq, timestamp, length, rate, width,
+                             decode_text(txt), decode_text(plugin))
+        return entry, offset
+
+    def annotate(self, seq, transcript=None, plugin=None):
+        """
+        保存した発話に，認識結果(transcript)と反応したプラグインの名前を書き込む
+        すでに上書きされていたら何もしない
+        """
+        try:
+            entry, offset = self._read_entry(seq)
+        except KeyError:
+            return
+        if transcript is None:
+            transcript = entry.transcript
+        if plugin is None:
+            plugin = entry.plugin
+        self._write_entry(seq, entry.timestamp, offset, entry.length,
+                          entry.sample_rate, entry.sample_width,
+                          transcript, plugin)
+
+    def get(self, seq):
+        """
+        seq番の発話の情報をArchiveEntryとして返す
+        """
+        return self._read_entry(seq)[0]
+
+    def entries(self):
+        """
+        残っている発話の情報を，古い順にリストで返す
+        """
+        result = []
+        count = self.count
+        for seq in range(max(0, count - self.slots), count):
+            try:
+                result.append(self.get(seq))
+            except KeyError:
+                pass
+        return result
+
+    def read(self, seq):
+        """
+        seq番の発話の音声をAudioDataとして返す
+        コピーしている間に上書きされたらKeyErrorを投げる
+        """
+        entry, offset = self._read_entry(seq)
+        off = self.data_offset + offset % self.size
+        data = self.mm[off:off+entry.length]
+        # コピーした後に，上書きされていないか確かめる
+        self._read_entry(seq)
+        return AudioData(data, entry.sample_rate, entry.sample_width)
+
+    def export(self, seq, path):
+        """
+        seq番の発話をWAVファイルに書き出す
+        """
+        ad = self.read(seq)
+        with wave.open(path, 'wb') as wf:
+            wf.setnchannels(1)
+            wf.setsampwidth(ad.sample_width)
+            wf.setframerate(ad.sample_rate)
+            wf.writeframes(ad.frame_data)
+
+    def flush(self):
+        if not self.readonly:
+            self.mm.flush()
+
+    def close(self):
+        if self.mm is not None:
+            self.flush()
+            self.mm.close()
+            self.mm = None
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+def format_entry(entry):
+    """
+    発話の情報を1行の文字列にする
+    """
+    seconds = entry.length / float(entry.sample_rate * entry.sample_width)
+    return "{:>6} {} {:>6.2f}s {:<16} {}".format(
+            entry.seq,
+            time.strftime('%Y-%m-%d %H:%M:%S',
+                          time.localtime(entry.timestamp)),
+            seconds, entry.plugin or '-', entry.transcript)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            description='発話のアーカイブを表示し，WAVファイルに書き出す')
+    sub = parser.add_subparsers(dest='command')
+    sub.required = True
+    p = sub.add_parser('list', help='保存されている発話の一覧を表示する')
+    p.add_argument('archive', help='アーカイブのファイル')
+    p = sub.add_parser('export', help='発話をWAVファイルに書き出す')
+    p.add_argument('archive', help='アーカイブのファイル')
+    p.add_argument('seq', nargs='*', type=int,
+                   help='書き出す発話の番号(省略するとすべて)')
+    p.add_argument('-o', '--outdir', default='.',
+                   help='WAVファイルを書き出すディレクトリ')
+    args = parser.parse_args(argv)
+
+    with UtteranceArchive(args.archive, readonly=True) as ar:
+        if args.command == 'list':
+            for entry in ar.entries():
+                print(format_entry(entry))
+            return 0
+        seqs = args.seq or [e.seq for e in ar.entries()]
+        os.makedirs(args.outdir, exist_ok=True)
+        for seq in seqs:
+            path = os.path.join(args.outdir, '{:06d}.wav'.format(seq))
+            try:
+                ar.export(seq, path)
+            except KeyError:
+                print("{}番の発話は残っていません".format(seq),
+                      file=sys.stderr)
+                continue
+            print(path)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
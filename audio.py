@@ -3,8 +3,22 @@
 
 
 import io
+import os
 import wave
+import aifc
+import shutil
 import audioop
+import subprocess
+
+
+def get_flac_converter():
+    """
+    FLACの変換に使うflacコマンドのパスを返す
+    """
+    flac_converter = shutil.which("flac")
+    if flac_converter is None:
+        raise OSError("FLAC conversion utility not available - consider installing the FLAC command line application")
+    return flac_converter
 
 
 class AudioSource:
@@ -18,6 +32,24 @@ class AudioSource:
         raise NotImplementedError("this is an abstract class")
 
 
+def downmix(frame_data, sample_width, channels):
+    """
+    Returns the average of all ``channels`` of the interleaved ``frame_data`` as mono audio data.
+
+    Each channel is extracted with strided slices (one per byte of a sample), so this stays in C code for any sample width.
+    """
+    frame_bytes = sample_width * channels
+    size = len(frame_data) // frame_bytes * sample_width
+    mono = None
+    for c in range(channels):
+        channel = bytearray(size)
+        for k in range(sample_width):
+            channel[k::sample_width] = frame_data[c * sample_width + k::frame_bytes][:size // sample_width]
+        channel = audioop.mul(bytes(channel), sample_width, 1.0 / channels)
+        mono = channel if mono is None else audioop.add(mono, channel, sample_width)
+    return mono
+
+
 class AudioFile(AudioSource):
     """
     Creates a new ``AudioFile`` instance given a WAV/AIFF/FLAC audio file ``filename_or_fileobject``. Subclass of ``AudioSource``.
@@ -84,7 +116,7 @@ class AudioFile(AudioSource):
                 except (aifc.Error, EOFError):
                     raise ValueError("Audio file could not be read as PCM WAV, AIFF/AIFF-C, or Native FLAC; check if file is corrupted or in another format")
                 self.little_endian = False  # AIFF is a big-endian format
-        assert 1 <= self.audio_reader.getnchannels() <= 2, "Audio must be mono or stereo"
+        assert self.audio_reader.getnchannels() >= 1, "Audio must have at least one channel"
         self.SAMPLE_WIDTH = self.audio_reader.getsampwidth()
 
         # 24-bit audio needs some special handling for old Python versions (workaround for https://bugs.python.org/issue12866)
@@ -129,8 +161,11 @@ class AudioFile(AudioSource):
             if self.samples_24_bit_pretending_to_be_32_bit:  # we need to convert samples from 24-bit to 32-bit before we can process them with ``audioop`` functions
                 buffer = b"".join(b"\x00" + buffer[i:i + sample_width] for i in range(0, len(buffer), sample_width))  # since we're in little endian, we prepend a zero byte to each 24-bit sample to get a 32-bit sample
                 sample_width = 4  # make sure we thread the buffer as 32-bit audio now, after converting it from 24-bit audio
-            if self.audio_reader.getnchannels() != 1:  # stereo audio
+            channels = self.audio_reader.getnchannels()
+            if channels == 2:  # stereo audio
                 buffer = audioop.tomono(buffer, sample_width, 1, 1)  # convert stereo audio data to mono
+            elif channels > 2:  # multichannel audio (e.g., a microphone array recording)
+                buffer = downmix(buffer, sample_width, channels)
             return buffer
 
 
@@ -153,6 +188,84 @@ class AudioData(object):
         self.sample_rate = sample_rate
         self.sample_width = int(sample_width)
 
+    @property
+    def frame_count(self):
+        """
+        The number of samples in the audio data.
+        """
+        return len(self.frame_data) // self.sample_width
+
+    @property
+    def duration(self):
+        """
+        The length of the audio data in seconds.
+        """
+        return self.frame_count / float(self.sample_rate)
+
+    def slice(self, start=None, end=None):
+        """
+        Returns a new ``AudioData`` instance containing the audio between ``start`` and ``end`` seconds.
+
+        ``start`` defaults to the beginning and ``end`` to the end of the audio. The returned instance shares the underlying buffer through a ``memoryview``, so slicing does not copy the frame data.
+        """
+        n = self.frame_count
+        first = 0 if start is None else min(n, max(0, int(start * self.sample_rate)))
+        last = n if end is None else min(n, max(first, int(end * self.sample_rate)))
+        view = memoryview(self.frame_data).cast("B")
+        return AudioData(view[first * self.sample_width:last * self.sample_width], self.sample_rate, self.sample_width)
+
+    @classmethod
+    def concatenate(cls, segments):
+        """
+        Returns a new ``AudioData`` instance containing ``segments`` (a sequence of ``AudioData`` instances with the same sample rate and width) one after another.
+
+        The frame data is copied exactly once, however many segments there are.
+        """
+        segments = list(segments)
+        assert segments, "At least one segment is required"
+        rate, width = segments[0].sample_rate, segments[0].sample_width
+        assert all(s.sample_rate == rate and s.sample_width == width for s in segments), "Segments must have the same sample rate and width"
+        return cls(b"".join(s.frame_data for s in segments), rate, width)
+
+    def __add__(self, other):
+        return AudioData.concatenate([self, other])
+
+    def window_levels(self, window=0.02):
+        """
+        Returns the RMS level of each ``window``-second window of the audio, as a list.
+
+        Each window is measured with ``audioop.rms``, so the work per window is done in C.
+        """
+        size = max(1, int(window * self.sample_rate)) * self.sample_width
+        data = memoryview(self.frame_data).cast("B")
+        if self.sample_width == 1:
+            data = audioop.bias(data, 1, -128)  # unsigned 8-bit samples
+        return [audioop.rms(data[i:i + size], self.sample_width) for i in range(0, len(data) - size + 1, size)]
+
+    def trim(self, threshold=None, margin=0.2, window=0.02, ratio=4.0):
+        """
+        Returns a new ``AudioData`` instance with the leading and trailing silence removed.
+
+        The audio is split into ``window``-second windows. The first and last windows whose RMS level exceeds ``threshold`` mark the speech, and ``margin`` seconds of audio are kept on either side as a guard. If ``threshold`` is not given, it is ``ratio`` times the noise floor (the 10th percentile of the window levels).
+
+        The result shares the buffer of this instance (see ``slice``). If no window exceeds the threshold, this instance is returned unchanged.
+        """
+        levels = self.window_levels(window)
+        if not levels:
+            return self
+        if threshold is None:
+            floor = sorted(levels)[len(levels) // 10]
+            threshold = max(floor * ratio, 2 ** (8 * self.sample_width - 1) / 1000.0)
+        loud = [i for i, level in enumerate(levels) if level > threshold]
+        if not loud:
+            return self
+        step = max(1, int(window * self.sample_rate)) / float(self.sample_rate)
+        start = max(0.0, loud[0] * step - margin)
+        end = (loud[-1] + 1) * step + margin
+        if start == 0.0 and end >= self.duration:
+            return self
+        return self.slice(start, end)
+
     def get_raw_data(self, convert_rate=None, convert_width=None):
         """
         Returns a byte string representing the raw frame data for the audio represented by the ``AudioData`` instance.
@@ -192,6 +305,8 @@ class AudioData(object):
         if convert_width == 1:
             raw_data = audioop.bias(raw_data, 1, 128)  # add 128 to every sample to make them act like unsigned samples again
 
+        if isinstance(raw_data, memoryview):
+            raw_data = raw_data.tobytes()
         return raw_data
 
     def get_wav_data(self, convert_rate=None, convert_width=None):
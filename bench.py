@@ -0,0 +1,482 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# bench.py
+# 合成した音声とHTMLのフィクスチャを使い，スマートスピーカーの処理ごとの
+# 所要時間を測るベンチマーク
+# 結果をJSONで書き出し，Raspberry Piとx86などの実行結果を比べられるようにする
+#
+#   python3 bench.py -o bench-pi.json
+#   python3 bench.py --corpus corpus   (合成した音声を残す)
+
+import os
+import sys
+import json
+import math
+import time
+import wave
+import random
+import socket
+import logging
+import argparse
+import platform
+import tempfile
+from array import array
+from datetime import datetime
+
+from audio import AudioData, AudioFile
+from replay import load_manifest
+
+
+# フィクスチャのディレクトリ
+FIXTURE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                           'fixtures')
+# 合成する音声のサンプリングレートとSN比(dB)
+RATES = (16000, 44100)
+SNRS = (30, 10, 0)
+# プラグインの呼び出しに使うメッセージ
+MESSAGES = ('おはよう', '東京の天気', 'ラズパイについて教えて')
+
+
+def synth_utterance(rate=16000, snr_db=20, bursts=3, burst_seconds=0.4,
+                    gap_seconds=0.3, lead_seconds=1.0, rand=random):
+    """
+    発話の代わりになる音声(16ビットモノラルの生データ)を合成する
+    lead_seconds秒の無音の後に，周波数の違うトーンとノイズを混ぜた
+    burst_seconds秒の区間を，gap_seconds秒の間隔でbursts回並べる
+    背景にはSN比がsnr_dbになるようにガウスノイズを加える
+    """
+    amplitude = 6000.0
+    # トーンの実効値に対するノイズの標準偏差
+    noise = amplitude * math.sqrt((0.7**2 + 0.3**2) / 2) / 10 ** (snr_db / 20.0)
+    samples = array('h')
+
+    def append(value):
+        samples.append(max(-32768, min(32767, int(value))))
+
+    def silence(seconds):
+        for i in range(int(seconds * rate)):
+            append(rand.gauss(0, noise))
+
+    silence(lead_seconds)
+    for b in range(bursts):
+        freq = rand.uniform(150, 700)
+        n = int(burst_seconds * rate)
+        for i in range(n):
+            # 区間の両端を滑らかにする
+            env = min(1.0, i / (0.02 * rate), (n - i) / (0.02 * rate))
+            v = amplitude * env * (
+                    0.7 * math.sin(2 * math.pi * freq * i / rate) +
+                    0.3 * math.sin(2 * math.pi * 2.5 * freq * i / rate))
+            append(v + rand.gauss(0, noise))
+        silence(gap_seconds)
+    silence(lead_seconds)
+    if sys.byteorder == 'big':
+        samples.byteswap()
+    return samples.tobytes()
+
+
+def write_wav(path, data, rate):
+    wf = wave.open(path, 'wb')
+    wf.setnchannels(1)
+    wf.setsampwidth(2)
+    wf.setframerate(rate)
+    wf.writeframes(data)
+    wf.close()
+
+
+def make_corpus(outdir, rates=RATES, snrs=SNRS, per_condition=2, seed=0):
+    """
+    サンプリングレートとSN比の組み合わせごとにper_condition個の音声を合成し，
+    outdirにWAVファイルとマニフェスト(manifest.jsonl)を書き出す
+    マニフェストはreplay.pyと同じ形式で，daemon.py --replayにも使える
+    マニフェストのパスを返す
+    """
+    rand = random.Random(seed)
+    os.makedirs(outdir, exist_ok=True)
+    manifest = os.path.join(outdir, 'manifest.jsonl')
+    with open(manifest, 'w', encoding='utf-8') as f:
+        for rate in rates:
+            for snr in snrs:
+                for i in range(per_condition):
+                    fn = 'synth-{}-{}db-{}.wav'.format(rate, snr, i)
+                    data = synth_utterance(rate, snr, bursts=rand.randint(2, 4),
+                                           rand=rand)
+                    write_wav(os.path.join(outdir, fn), data, rate)
+                    f.write(json.dumps({'audio': fn, 'transcript': '',
+                                        'rate': rate, 'snr': snr}) + '\n')
+    return manifest
+
+
+def measure(func, repeat=20, warmup=2):
+    """
+    funcをrepeat回呼び出し，1回あたりの所要時間(ミリ秒)の統計を返す
+    """
+    for i in range(warmup):
+        func()
+    times = []
+    for i in range(repeat):
+        start = time.perf_counter()
+        func()
+        times.append((time.perf_counter() - start) * 1000)
+    times.sort()
+    return {
+        'n': repeat,
+        'mean_ms': sum(times) / repeat,
+        'min_ms': times[0],
+        'p50_ms': times[repeat // 2],
+        'p90_ms': times[min(repeat - 1, int(repeat * 0.9))],
+        'max_ms': times[-1],
+    }
+
+
+def load_corpus(manifest):
+    """
+    マニフェストの音声をAudioDataのリストとして読み込む
+    """
+    corpus = []
+    for entry in load_manifest(manifest):
+        with AudioFile(entry.path) as af:
+            corpus.append(AudioData(af.stream.read(), af.SAMPLE_RATE,
+                                    af.SAMPLE_WIDTH))
+    return corpus
+
+
+def bench_chunks(corpus, repeat):
+    """
+    record.pyのチャンクごとの処理(周波数の除去とボリュームの計算)を測る
+    1回の計測で，1つの音声のすべてのチャンクを処理する
+    """
+    import record
+    results = []
+    for rate in sorted({ad.sample_rate for ad in corpus}):
+        ad = next(a for a in corpus if a.sample_rate == rate)
+        size = record.get_chunk(rate) * 2
+        chunks = [ad.frame_data[i:i+size]
+                  for i in range(0, len(ad.frame_data) - size + 1, size)]
+
+        def run():
+            for c in chunks:
+                record.chunk_level(record.filter_chunk(c, rate))
+
+        r = measure(run, repeat)
+        r.update(name='record.chunk', rate=rate, chunks=len(chunks),
+                 per_chunk_us=r['mean_ms'] * 1000 / max(1, len(chunks)))
+        results.append(r)
+    results.extend(bench_idle(repeat))
+    return results
+
+
+def bench_idle(repeat, rate=16000, seconds=5.0, noise=20, gate=50,
+               seed=0):
+    """
+    発話を待っている間(小さな雑音だけ)のチャンクの処理を，
+    フィルタをかける場合と，生データのRMSとピークで省く場合とで比べる
+    チャンクの長さに対する処理時間の割合(budget_pct)も記録する
+    """
+    import record
+    from vad import is_quiet
+    rand = random.Random(seed)
+    samples = array('h', (int(rand.gauss(0, noise))
+                          for i in range(int(rate * seconds))))
+    data = samples.tobytes()
+    size = record.get_chunk(rate) * 2
+    chunks = [data[i:i+size] for i in range(0, len(data) - size + 1, size)]
+
+    def full():
+        for c in chunks:
+            record.chunk_level(record.filter_chunk(c, rate))
+
+    def gated():
+        for c in chunks:
+            if not is_quiet(c, gate):
+                record.chunk_level(record.filter_chunk(c, rate))
+
+    results = []
+    for name, func in (('record.idle_full', full),
+                       ('record.idle_gated', gated)):
+        r = measure(func, repeat)
+        per_chunk = r['mean_ms'] / max(1, len(chunks))
+        r.update(name=name, rate=rate, chunks=len(chunks),
+                 per_chunk_us=per_chunk * 1000,
+                 budget_pct=per_chunk / (size / 2 * 1000.0 / rate) * 100)
+        results.append(r)
+    return results
+
+
+def bench_audiodata(corpus, repeat):
+    """
+    AudioDataの変換とWAV，FLACへのエンコードを測る
+    """
+    results = []
+    for rate in sorted({ad.sample_rate for ad in corpus}):
+        ad = next(a for a in corpus if a.sample_rate == rate)
+        seconds = len(ad.frame_data) / float(rate * ad.sample_width)
+        cases = [
+            ('audiodata.raw_16k', lambda: ad.get_raw_data(
+                convert_rate=16000, convert_width=2)),
+            ('audiodata.wav_16k', lambda: ad.get_wav_data(
+                convert_rate=16000, convert_width=2)),
+            ('audiodata.flac', lambda: ad.get_flac_data()),
+        ]
+        for name, func in cases:
+            try:
+                r = measure(func, repeat)
+            except OSError as e:
+                # flacコマンドが無い
+                results.append({'name': name, 'rate': rate,
+                                'skipped': str(e)})
+                continue
+            r.update(name=name, rate=rate, audio_seconds=seconds)
+            results.append(r)
+    return results
+
+
+def synth_array(data, channels, delays, noise_levels, rand=random):
+    """
+    1チャンネルの音声(16ビットの生データ)から，マイクアレイの録音を合成する
+    チャンネルcはdelays[c]サンプル遅らせ，標準偏差noise_levels[c]の
+    ガウスノイズを加える
+    インターリーブした生データを返す
+    """
+    src = array('h')
+    src.frombytes(data)
+    n = len(src)
+    out = array('h', bytes(2 * n * channels))
+    for c in range(channels):
+        d = delays[c]
+        noise = noise_levels[c]
+        for i in range(n):
+            v = src[i - d] if 0 <= i - d < n else 0
+            out[i * channels + c] = max(-32768, min(32767,
+                                        int(v + rand.gauss(0, noise))))
+    return out.tobytes()
+
+
+def bench_micarray(repeat, channel_counts=(4, 6), rate=16000, seed=0):
+    """
+    マイクアレイの音声を1チャンネルにまとめる処理(micarray)をチャンネル数と
+    まとめ方ごとに測る
+    チャンクの長さに対する処理時間の割合(budget_pct)も記録する
+    """
+    import record
+    import micarray
+    rand = random.Random(seed)
+    data = synth_utterance(rate, snr_db=20, bursts=2, lead_seconds=0.5,
+                           rand=rand)
+    chunk = record.get_chunk(rate)
+    results = []
+    for channels in channel_counts:
+        delays = [rand.randint(-8, 8) for c in range(channels)]
+        noise = [rand.uniform(200, 1500) for c in range(channels)]
+        frames = synth_array(data, channels, delays, noise, rand)
+        size = chunk * 2 * channels
+        chunks = [frames[i:i+size]
+                  for i in range(0, len(frames) - size + 1, size)]
+        for mode in ('best', 'beam'):
+            def run():
+                mixer = micarray.ChannelMixer(channels, rate, mode)
+                for c in chunks:
+                    mixer.process(c)
+
+            r = measure(run, repeat)
+            per_chunk = r['mean_ms'] / max(1, len(chunks))
+            r.update(name='micarray.' + mode, rate=rate, channels=channels,
+                     chunks=len(chunks), per_chunk_us=per_chunk * 1000,
+                     budget_pct=per_chunk / (chunk * 1000.0 / rate) * 100)
+            results.append(r)
+    return results
+
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURE_DIR, name), 'rb') as f:
+        return f.read()
+
+
+def chunked(data, size):
+    return (data[i:i+size] for i in range(0, len(data), size))
+
+
+def bench_html(repeat):
+    """
+    保存したページから天気予報とWikipediaの概要を取り出す処理を測る
+    """
+    from plugins import weatherreport, wikipedia
+    tenki = read_fixture('tenki_week.html')
+    wiki = read_fixture('wikipedia.html')
+    cases = [
+        # 索引を作るときと同じように，ページ全体を読む
+        ('html.weather_all', lambda: weatherreport.parse_forecast(
+            chunked(tenki, weatherreport.CHUNK_SIZE)), len(tenki)),
+        ('html.wikipedia', lambda: wikipedia.extract_abstruction(
+            chunked(wiki, wikipedia.CHUNK_SIZE)), len(wiki)),
+        ('html.wikipedia_whole', lambda: wikipedia.get_abstruction(
+            wiki.decode('utf-8')), len(wiki)),
+    ]
+    results = []
+    for name, func, size in cases:
+        r = measure(func, repeat)
+        r.update(name=name, bytes=size)
+        results.append(r)
+    return results
+
+
+def bench_dispatch(repeat):
+    """
+    プラグインの読み込みと，メッセージごとのコマンドの呼び出しを測る
+    天気予報はフィクスチャのページで作った索引を使い，ネットワークには
+    アクセスしない
+    """
+    import plugin
+    from types import SimpleNamespace
+    from plugins import weatherreport
+    results = []
+    r = measure(plugin.import_commands, max(1, repeat // 4), warmup=1)
+    r.update(name='plugin.import', plugins=len(plugin.COMMANDS))
+    results.append(r)
+
+    tenki = read_fixture('tenki_week.html')
+    parser = weatherreport.ForecastParser()
+    parser.feed(tenki.decode('utf-8'))
+    parser.close()
+    weatherreport.INDEX.build(parser.rows)
+    scheduled = weatherreport.scheduled
+    weatherreport.scheduled = True
+    config = SimpleNamespace(WR_URL='http://127.0.0.1:9/', WR_INDEX=0,
+                             WR_REFRESH=10**9)
+    try:
+        for message in MESSAGES:
+            r = measure(lambda: plugin.invoke_commands(message, config),
+                        repeat)
+            r.update(name='plugin.dispatch', message=message)
+            results.append(r)
+    finally:
+        weatherreport.scheduled = scheduled
+    return results
+
+
+def synth_titles(count, seed=0):
+    """
+    カタカナか漢字を2〜10文字並べた項目名をcount個作るジェネレータ
+    """
+    rand = random.Random(seed)
+    kana = [chr(c) for c in range(0x30A1, 0x30F7)]
+    kanji = [chr(c) for c in range(0x4E00, 0x4E00 + 2000)]
+    for i in range(count):
+        pool = kana if rand.random() < 0.5 else kanji
+        yield ''.join(rand.choice(pool) for _ in range(rand.randint(2, 10)))
+
+
+def bench_resolver(repeat, count=100000, seed=0):
+    """
+    項目名のあいまい検索の索引を作る時間とメモリの使用量，検索の時間を測る
+    メモリはtracemallocで測り，1項目名あたりのバイト数も返す
+    """
+    import tracemalloc
+    from wikiindex import TitleResolver
+    titles = list(synth_titles(count, seed))
+    tracing = tracemalloc.is_tracing()
+    if not tracing:
+        tracemalloc.start()
+    try:
+        before = tracemalloc.get_traced_memory()[0]
+        start = time.perf_counter()
+        resolver = TitleResolver(titles)
+        elapsed = (time.perf_counter() - start) * 1000
+        used = tracemalloc.get_traced_memory()[0] - before
+    finally:
+        if not tracing:
+            tracemalloc.stop()
+    build = {'name': 'resolver.build', 'titles': count, 'n': 1,
+             'mean_ms': elapsed, 'min_ms': elapsed, 'p50_ms': elapsed,
+             'p90_ms': elapsed, 'max_ms': elapsed, 'bytes': used,
+             'bytes_per_title': used / count}
+    # 1文字違いの項目名を引く
+    words = [t[:-1] + 'ー' for t in titles[:10]]
+    r = measure(lambda: [resolver.resolve(w) for w in words], repeat)
+    r.update(name='resolver.resolve', titles=count)
+    return [build, r]
+
+
+def host_info():
+    """
+    ベンチマークを実行した環境の情報を返す
+    """
+    return {
+        'hostname': socket.gethostname(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpu_count': os.cpu_count(),
+        'python': platform.python_version(),
+        'implementation': platform.python_implementation(),
+        'time': datetime.now().isoformat(timespec='seconds'),
+    }
+
+
+def run_all(manifest, repeat=20):
+    """
+    すべてのベンチマークを実行し，結果を辞書で返す
+    必要なモジュールが無いベンチマークは，理由を付けて飛ばす
+    """
+    corpus = load_corpus(manifest)
+    results = []
+    benches = [
+        ('record.chunk', lambda: bench_chunks(corpus, repeat)),
+        ('audiodata', lambda: bench_audiodata(corpus, repeat)),
+        ('micarray', lambda: bench_micarray(repeat)),
+        ('html', lambda: bench_html(repeat)),
+        ('plugin', lambda: bench_dispatch(repeat)),
+        ('resolver', lambda: bench_resolver(repeat)),
+    ]
+    for name, func in benches:
+        try:
+            results.extend(func())
+        except ImportError as e:
+            logging.warning("{}を飛ばします({})".format(name, e))
+            results.append({'name': name, 'skipped': str(e)})
+    return {'host': host_info(), 'repeat': repeat,
+            'corpus': len(corpus), 'results': results}
+
+
+def format_results(data):
+    """
+    結果を表にした文字列を返す
+    """
+    lines = ['{:24s} {:28s} {:>9s} {:>9s} {:>9s}'.format(
+             'benchmark', 'params', 'mean(ms)', 'p50(ms)', 'p90(ms)')]
+    for r in data['results']:
+        params = ','.join('{}={}'.format(k, v) for k, v in r.items()
+                          if k in ('rate', 'message', 'chunks', 'bytes',
+                                   'channels', 'titles'))
+        if 'skipped' in r:
+            lines.append('{:24s} {:28s} skipped: {}'.format(
+                         r['name'], params, r['skipped']))
+            continue
+        lines.append('{:24s} {:28s} {:>9.3f} {:>9.3f} {:>9.3f}'.format(
+                     r['name'], params, r['mean_ms'], r['p50_ms'],
+                     r['p90_ms']))
+    return '\n'.join(lines)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description='スマートスピーカーの処理ごとの所要時間を測る')
+    parser.add_argument('-o', '--output', default=None,
+                        help='結果を書き出すJSONファイル(省略すると表示のみ)')
+    parser.add_argument('-n', '--repeat', type=int, default=20,
+                        help='1つのベンチマークを繰り返す回数')
+    parser.add_argument('--corpus', default=None,
+                        help='合成した音声を書き出すディレクトリ'
+                             '(省略すると一時ディレクトリ)')
+    parser.add_argument('--seed', type=int, default=0)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    with tempfile.TemporaryDirectory() as tmpdir:
+        manifest = make_corpus(args.corpus or tmpdir, seed=args.seed)
+        data = run_all(manifest, args.repeat)
+    print(format_results(data))
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(data, f, ensure_ascii=False, indent=2)
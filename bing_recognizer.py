@@ -13,6 +13,13 @@ from urllib.parse import urlencode
 from urllib.request import Request, urlopen
 from urllib.error import URLError, HTTPError
 
+import metrics
+
+# APIのエンドポイント(設定ファイルのBING_TOKEN_URL，BING_RECOGNITION_URLで変えられる)
+TOKEN_URL = "https://api.cognitive.microsoft.com/sts/v1.0/issueToken"
+RECOGNITION_URL = "https://speech.platform.bing.com/speech/recognition/interactive/cognitiveservices/v1"
+
+
 class RequestError(Exception): pass
 
 
@@ -25,7 +32,7 @@ class Bing:
         self.operation_timeout = None  # seconds after an internal operation 
 
     def recognize(self, audio_data, config=None, key='',
-                  language="ja-JP", show_all=False):
+                  language="ja-JP", show_all=False, max_alternatives=0):
         """
         Microsoft Bing Speech APIを使って音声認識を実行するメソッド。
         audio_data(AudioData)に音声ファイル，
@@ -33,6 +40,9 @@ class Bing:
         APIを呼び出して結果を返す。
         show_allがTrueだとレスポンスのJSONを辞書に変換して返す。
         Falseだと，認識した文字列を返す。
+        max_alternativesを指定すると，詳細形式(format=detailed)で呼び出し，
+        (文字列, 信頼度)の候補(N-best)を確からしい順に最大max_alternatives個，
+        リストで返す。
         """
 
         # キャッシュしたaccess_tokenとexpire_timeを取り出す
@@ -41,7 +51,7 @@ class Bing:
         from time import monotonic
         if expire_time is None or monotonic() > expire_time:
             # キャッシュが無効の場合，access_tokenなどを取得する
-            credential_url = "https://api.cognitive.microsoft.com/sts/v1.0/issueToken"
+            credential_url = getattr(config, "BING_TOKEN_URL", TOKEN_URL)
             credential_request = Request(credential_url, data=b"", headers={
                 "Content-type": "application/x-www-form-urlencoded",
                 "Content-Length": "0",
@@ -52,29 +62,42 @@ class Bing:
                 start_time = monotonic()
 
             try:
-                credential_response = urlopen(credential_request, timeout=60)
+                with metrics.span('token_fetch'):
+                    credential_response = urlopen(credential_request,
+                                                  timeout=60)
+                    access_token = credential_response.read().decode("utf-8")
             except HTTPError as e:
                 raise RequestError("credential request failed: {}".format(e.reason))
             except URLError as e:
                 raise RequestError("credential connection failed: {}".format(e.reason))
-            access_token = credential_response.read().decode("utf-8")
 
             if allow_caching:
                 # access_tokenを保存する
                 self.bing_cached_access_token = access_token
                 self.bing_cached_access_token_expiry = start_time + 600  # according to https://docs.microsoft.com/en-us/azure/cognitive-services/speech/api-reference-rest/bingvoicerecognition, the token expires in exactly 10 minutes
 
+        # 前後の無音を取り除き，送るデータを小さくする
+        if getattr(config, "TRIM_SILENCE", True):
+            with metrics.span('trim'):
+                audio_data = audio_data.trim(
+                        margin=getattr(config, "TRIM_MARGIN", 0.2))
+
         # wavのデータを，APIがサポートした形式にコンバートする
-        wav_data = audio_data.get_wav_data(
-            convert_rate=16000,  # audio samples must be 8kHz or 16 kHz
-            convert_width=2  # audio samples should be 16-bit
-        )
+        with metrics.span('wav_encode'):
+            wav_data = audio_data.get_wav_data(
+                convert_rate=16000,  # audio samples must be 8kHz or 16 kHz
+                convert_width=2  # audio samples should be 16-bit
+            )
 
-        url = "https://speech.platform.bing.com/speech/recognition/interactive/cognitiveservices/v1?{}".format(urlencode({
+        params = {
             "language": language,
             "locale": language,
             "requestid": uuid.uuid4(),
-        }))
+        }
+        if max_alternatives:
+            # 候補(NBest)と信頼度を含む詳細形式の結果を返してもらう
+            params["format"] = "detailed"
+        url = "{}?{}".format(getattr(config, "BING_RECOGNITION_URL", RECOGNITION_URL), urlencode(params))
 
         if sys.version_info >= (3, 6):
             # Python 3.6以上の場合，
@@ -95,17 +118,20 @@ class Bing:
             })
 
         try:
-            response = urlopen(request, timeout=self.operation_timeout)
+            with metrics.span('recognize_request'):
+                response = urlopen(request, timeout=self.operation_timeout)
+                response_text = response.read().decode("utf-8")
         except HTTPError as e:
             raise RequestError("recognition request failed: {}".format(e.reason))
         except URLError as e:
             raise RequestError("recognition connection failed: {}".format(e.reason))
-        response_text = response.read().decode("utf-8")
         result = json.loads(response_text)
 
         # 結果を返す
         if show_all:
             return result
+        if max_alternatives:
+            return parse_nbest(result, max_alternatives)
         if "RecognitionStatus" not in result or\
              result["RecognitionStatus"] != "Success" or\
              "DisplayText" not in result:
@@ -113,6 +139,23 @@ class Bing:
         return result["DisplayText"]
 
 
+def parse_nbest(result, max_alternatives):
+    """
+    詳細形式の結果から，(文字列, 信頼度)の候補を最大max_alternatives個返す
+    NBestが無ければ(単純形式なら)，DisplayTextだけを候補にする
+    """
+    if result.get("RecognitionStatus") != "Success":
+        raise UnknownValueError()
+    nbest = [(alt.get("Display", ""), alt.get("Confidence"))
+             for alt in result.get("NBest", [])]
+    if not nbest and "DisplayText" in result:
+        nbest = [(result["DisplayText"], None)]
+    nbest = [alt for alt in nbest if alt[0]]
+    if not nbest:
+        raise UnknownValueError()
+    return nbest[:max_alternatives]
+
+
 def test_recognize(key, filename):
     """
     Microsoft Bing Speech APIを使って音声認識するテスト用関数
@@ -0,0 +1,491 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# capture.py
+# マイクからの録音と発話区間の検出を別プロセスで行い，
+# 音声データと検出結果を共有メモリのリングバッファに書き込む
+# メインのプロセスで音声合成やHTMLの解析に時間がかかっても(GILの競合やGC)，
+# 録音が途切れたり，入力がオーバーフローしたりしないようにする
+
+import time
+import queue
+import struct
+import logging
+import multiprocessing
+from multiprocessing import shared_memory
+
+import metrics
+from audio import AudioData
+from vad import VoiceDetector, IdleMeter, check_idle_gate, is_quiet, \
+        report_idle
+
+
+# チャンクのフラグ
+FLAG_VOICE = 1      # 発話の区間に含まれる
+FLAG_START = 2      # 発話が始まったチャンク
+FLAG_END = 4        # 発話が終わったチャンク
+
+# 共有メモリの先頭に置くヘッダー
+# 書き込んだチャンクの数，チャンクのバイト数，スロットの数，サンプリングレート
+HEADER = struct.Struct('<QIII')
+HEADER_SIZE = 64
+
+# 16ビットの入力(pyaudio.paInt16と同じ値，親プロセスでPyAudioを読み込まない)
+PA_INT16 = 8
+
+# 発話を待つ間，子プロセスが生きているかを調べる間隔(秒)
+POLL_INTERVAL = 0.5
+
+# チャンクごとの処理時間を受け取るオブジェクト(プロファイル用)
+# record.chunk_timerと同じく，add(read, fft, avg, deque)メソッドを持つ
+# 子プロセスがリングバッファに書いた処理時間を，発話を待つ間に渡す
+chunk_timer = None
+
+
+class OverrunError(Exception):
+    """
+    読み込む前に，リングバッファのデータが上書きされた
+    """
+
+
+class CaptureError(RuntimeError):
+    """
+    録音用の子プロセスが，知らせずに終了した(クラッシュやOOMなど)
+    """
+
+
+class FrameRing:
+    """
+    共有メモリ上に置く，チャンクのリングバッファ
+    書き込むプロセスは1つだけで，読み込み側はロックを使わない
+    書き込み側はスロットにデータを書いてから，書き込んだチャンクの数(seq)を
+    増やして公開する
+    読み込み側はseqを見て読める範囲を決め，読み終えた後にもう一度seqを見て，
+    読んでいる間に上書きされていないか確かめる
+    チャンクの番号(seq)は0から増え続け，seq % slotsのスロットに入る
+    スロットごとに，チャンクの処理時間(読み込み，FFT，平均，deque)も置く
+    """
+
+    def __init__(self, shm, chunk_bytes, slots, rate):
+        self.shm = shm
+        self.chunk_bytes = chunk_bytes
+        self.slots = slots
+        self.rate = rate
+        buf = shm.buf
+        self._seq = buf[0:8].cast('Q')
+        off = HEADER_SIZE
+        self.levels = buf[off:off+4*slots].cast('f')
+        off += 4*slots
+        self.times = buf[off:off+16*slots].cast('f')
+        off += 16*slots
+        self.flags = buf[off:off+slots]
+        off += slots
+        self.data = buf[off:off+chunk_bytes*slots]
+
+    @staticmethod
+    def size(chunk_bytes, slots):
+        return HEADER_SIZE + 21*slots + chunk_bytes*slots
+
+    @classmethod
+    def create(cls, chunk_bytes, slots, rate):
+        """
+        共有メモリを確保してリングバッファを作る
+        """
+        shm = shared_memory.SharedMemory(
+                create=True, size=cls.size(chunk_bytes, slots))
+        HEADER.pack_into(shm.buf, 0, 0, chunk_bytes, slots, rate)
+        return cls(shm, chunk_bytes, slots, rate)
+
+    @classmethod
+    def attach(cls, name):
+        """
+        別のプロセスが作ったリングバッファを開く
+        """
+        shm = shared_memory.SharedMemory(name=name)
+        seq, chunk_bytes, slots, rate = HEADER.unpack_from(shm.buf, 0)
+        return cls(shm, chunk_bytes, slots, rate)
+
+    @property
+    def name(self):
+        return self.shm.name
+
+    @property
+    def seq(self):
+        """
+        これまでに書き込んだチャンクの数
+        """
+        return self._seq[0]
+
+    def write(self, data, level, flags=0, times=None):
+        """
+        チャンクを1つ書き込み，そのチャンクの番号を返す
+        timesには(読み込み，FFT，平均，deque)の処理時間(秒)を渡せる
+        """
+        seq = self._seq[0]
+        slot = seq % self.slots
+        off = slot * self.chunk_bytes
+        self.data[off:off+len(data)] = data
+        self.levels[slot] = level
+        self.flags[slot] = flags
+        for i, t in enumerate(times or (0.0, 0.0, 0.0, 0.0)):
+            self.times[4*slot+i] = t
+        # データを書き終えてから公開する
+        self._seq[0] = seq + 1
+        return seq
+
+    def mark(self, seq, flags):
+        """
+        書き込み済みのチャンクにフラグを追加する
+        """
+        if self.available(seq):
+            slot = seq % self.slots
+            self.flags[slot] = self.flags[slot] | flags
+
+    def available(self, seq):
+        """
+        seq番のチャンクがまだ上書きされずに残っているかを返す
+        """
+        cur = self._seq[0]
+        return cur - self.slots <= seq < cur
+
+    def segments(self, start, end):
+        """
+        start番からend番の手前までのチャンクを，
+        コピーせずにmemoryviewのリスト(折り返しがあれば2つ)で返す
+        """
+        cur = self._seq[0]
+        if start < cur - self.slots or end > cur or start > end:
+            raise OverrunError("chunks {}-{} are not available".format(
+                               start, end))
+        s = (start % self.slots) * self.chunk_bytes
+        e = s + (end - start) * self.chunk_bytes
+        size = self.chunk_bytes * self.slots
+        if e <= size:
+            return [self.data[s:e]]
+        return [self.data[s:], self.data[:e-size]]
+
+    def read(self, start, end):
+        """
+        start番からend番の手前までのチャンクをバイト列として返す
+        segments()と違い，共有メモリの内容をbytesにコピーする
+        (返した後に上書きされても変わらない)
+        コピーしている間に上書きされたらOverrunErrorを投げる
+        """
+        data = b''.join(self.segments(start, end))
+        if not self.available(start):
+            raise OverrunError("chunk {} was overwritten".format(start))
+        return data
+
+    def voice_start(self, start, end):
+        """
+        start番からend番の手前までの発話で，声が始まったチャンクの番号を返す
+        (発話の前に含めたprev_length秒分のチャンクを除く)
+        分からなければstartを返す
+        """
+        for seq in range(max(start, self._seq[0] - self.slots), end):
+            if self.flags[seq % self.slots] & FLAG_VOICE:
+                return seq
+        return start
+
+    def timings(self, start, end):
+        """
+        start番からend番の手前までのチャンクの処理時間を，
+        (読み込み，FFT，平均，deque)のタプルのリストで返す
+        上書きされたチャンクや，書き込み中のスロットの分は含めない
+        """
+        start = max(start, self._seq[0] - self.slots + 1)
+        rows = []
+        for seq in range(start, end):
+            off = 4 * (seq % self.slots)
+            rows.append(tuple(self.times[off:off+4]))
+        return rows
+
+    def close(self):
+        # memoryviewを解放してから共有メモリを閉じる
+        for view in (self._seq, self.levels, self.times, self.flags,
+                     self.data):
+            view.release()
+        self.shm.close()
+
+    def unlink(self):
+        self.shm.unlink()
+
+
+def default_level(data, rate):
+    """
+    record.pyと同じ方法でチャンクのボリュームを計算する
+    """
+    import record
+    return record.chunk_level(record.filter_chunk(data, rate))
+
+
+def capture_main(name, params, events, stop, audio_factory=None,
+                 level=default_level, mic=None, idle_gate=0):
+    """
+    録音用の子プロセスで実行する関数
+    マイクから読み込んだチャンクをリングバッファに書き込み，
+    発話を検出したら(開始番号, 終了番号)をeventsに送る
+    micに(チャンネル数, まとめ方, 最大の遅れ)を渡すと，マイクアレイの音声を
+    1チャンネルにまとめてから書き込む
+    idle_gateを指定すると，発話を待っている間は生データが十分小さいチャンクの
+    ボリュームを計算せず，無音とみなす(閾値がvad.LEVEL_FLOOR以下なら使わない)
+    発話ごとに，待機中の(CPU時間, 経過時間, チャンク数, 省いたチャンク数)も送る
+    チャンクごとの処理時間はリングバッファに書く
+    (levelがdefault_level以外なら，levelにかかった時間をFFTの分とする)
+    """
+    ring = FrameRing.attach(name)
+    rate = ring.rate
+    chunk = ring.chunk_bytes // 2
+    channels, mix, max_delay = mic or (1, 'best', None)
+    idle_gate = check_idle_gate(idle_gate, params.get('threshold', 200))
+    mixer = None
+    audio = stream = None
+    try:
+        if audio_factory is None:
+            import pyaudio
+            audio_factory = pyaudio.PyAudio
+        if channels > 1:
+            import micarray
+            mixer = micarray.get_mixer(channels, rate, mix, max_delay)
+        audio = audio_factory()
+        stream = audio.open(format=PA_INT16, channels=channels, rate=rate,
+                            input=True, frames_per_buffer=chunk)
+        detector = VoiceDetector(rate, chunk, **params)
+        meter = IdleMeter()
+        split = None
+        if level is default_level:
+            # フィルタとボリュームの計算の時間を分けて測る
+            import record
+            split = (record.filter_chunk, record.chunk_level)
+        # PortAudioが報告する入力の遅延(秒)を親プロセスに知らせる
+        events.put(('listening', stream.get_input_latency()))
+        while not stop.is_set():
+            idle = not detector.active
+            t0 = time.perf_counter()
+            data = stream.read(chunk, exception_on_overflow=False)
+            t1 = time.perf_counter()
+            if mixer is not None:
+                data = mixer.process(data)
+            skipped = idle and idle_gate and is_quiet(data, idle_gate)
+            if skipped:
+                lv = 0.0
+                t2 = t3 = time.perf_counter()
+            elif split is not None:
+                filtered = split[0](data, rate)
+                t2 = time.perf_counter()
+                lv = split[1](filtered)
+                t3 = time.perf_counter()
+            else:
+                lv = level(data, rate)
+                t2 = t3 = time.perf_counter()
+            meter.add(idle, skipped)
+            # 検出器には音声を持たせず，チャンクの数だけを数える
+            n = len(detector.audio)
+            done = detector.push(None, lv)
+            t4 = time.perf_counter()
+            voice = len(detector.audio) > n
+            flags = 0
+            if voice:
+                flags = FLAG_VOICE | (FLAG_START if n == 0 else 0)
+            seq = ring.write(data, lv, flags,
+                             (t1 - t0, t2 - t1, t3 - t2, t4 - t3))
+            if done:
+                # 発話が終わった(最後のチャンクが発話に含まれないこともある)
+                end = seq + 1 if voice else seq
+                start = end - len(detector.frames)
+                ring.mark(end - 1, FLAG_END)
+                events.put(('utterance', start, end, meter.stats()))
+                detector.reset()
+                meter.reset()
+    except EOFError:
+        # リプレイする音声を読み終えた
+        events.put(('eof',))
+    except Exception as e:
+        logging.exception("録音中にエラーが発生しました")
+        events.put(('error', '{}: {}'.format(type(e).__name__, e)))
+    finally:
+        if stream is not None:
+            stream.close()
+        if audio is not None:
+            audio.terminate()
+        ring.close()
+
+
+class CaptureProcess:
+    """
+    録音と発話区間の検出を子プロセスで行うクラス
+    get_audiodata()で，子プロセスが検出した発話を受け取る
+    リングバッファにはbuffer_seconds秒分の音声を保持する
+    discard_staleがTrueなら，get_audiodata()を呼ぶ前に終わっていた発話
+    (応答の再生中に拾った音声など)は捨てる
+    応答を再生した後にflush()を呼ぶと，再生中に声が始まった発話も捨てる
+    channelsが2以上なら，mixとmax_delayに従って1チャンネルにまとめて保持する
+    idle_gateは，待機中にフィルタを省く生データのRMS(0なら省かない)
+    子プロセスが知らせずに終了したら，max_restarts回まで起動し直し，
+    それを超えたらCaptureErrorを投げる
+    chunk_timerを設定している間は，発話を待つ間に子プロセスが測った
+    チャンクごとの処理時間を渡す(待っていない間の分は，リングバッファに
+    残っている範囲だけ)
+    """
+
+    def __init__(self, rate=16000, chunk=1024, threshold=200,
+                 startup_time=0.15, silence_limit=1, prev_length=0.5,
+                 max_second=9.5, buffer_seconds=30, audio_factory=None,
+                 level=default_level, discard_stale=True, context=None,
+                 channels=1, mix='best', max_delay=None, idle_gate=0,
+                 max_restarts=3):
+        self.rate = rate
+        self.chunk = chunk
+        self.mic = (channels, mix, max_delay)
+        self.idle_gate = idle_gate
+        self.params = dict(threshold=threshold, startup_time=startup_time,
+                           silence_limit=silence_limit,
+                           prev_length=prev_length, max_second=max_second)
+        self.slots = max(int(buffer_seconds * rate / chunk), 2 * int(
+                         (min(9.5, max_second) + prev_length) * rate / chunk))
+        self.audio_factory = audio_factory
+        self.level = level
+        self.discard_stale = discard_stale
+        self.ctx = context or multiprocessing.get_context()
+        self.ring = None
+        self.process = None
+        self.events = None
+        self.stop_event = None
+        self.on_listen = None
+        self.max_restarts = max_restarts
+        self.restarts = 0
+        # この番号より前に声が始まった発話は捨てる(flush()で進める)
+        self.discard_before = 0
+        # この番号より前のチャンクの処理時間は渡し終えた
+        self.timed = 0
+
+    def start(self):
+        """
+        リングバッファを作り，録音用の子プロセスを起動する
+        """
+        self.ring = FrameRing.create(self.chunk * 2, self.slots, self.rate)
+        self.discard_before = 0
+        self.timed = 0
+        self.events = self.ctx.Queue()
+        self.stop_event = self.ctx.Event()
+        self.process = self.ctx.Process(
+                target=capture_main, name='capture', daemon=True,
+                args=(self.ring.name, self.params, self.events,
+                      self.stop_event, self.audio_factory, self.level,
+                      self.mic, self.idle_gate))
+        self.process.start()
+        logging.debug("録音用のプロセスを起動しました(pid {})".format(
+                      self.process.pid))
+        return self
+
+    def get_utterance(self, timeout=None):
+        """
+        次の発話を待ち，(開始番号, 終了番号)を返す
+        タイムアウトしたらNoneを返す
+        リプレイする音声を読み終えたらEOFErrorを投げる
+        """
+        since = self.ring.seq
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            # 子プロセスが止まっていないか調べるため，短い間隔で待つ
+            wait = POLL_INTERVAL if deadline is None else \
+                    min(POLL_INTERVAL, max(0.0, deadline - time.monotonic()))
+            try:
+                event = self.events.get(timeout=wait)
+            except queue.Empty:
+                self.collect_timings()
+                if not self.process.is_alive():
+                    self.handle_exit()
+                    since = self.ring.seq
+                elif deadline is not None and time.monotonic() >= deadline:
+                    return None
+                continue
+            self.collect_timings()
+            kind = event[0]
+            if kind == 'listening':
+                latency = event[1]
+                logging.info("入力の遅延は{:.1f}ミリ秒です".format(
+                             latency * 1000))
+                metrics.observe('input_latency', latency)
+                if self.on_listen:
+                    self.on_listen()
+            elif kind == 'utterance':
+                start, end, idle = event[1:]
+                report_idle(*idle)
+                if self.ring.voice_start(start, end) < self.discard_before:
+                    # flush()する前に声が始まっていた(再生した応答など)
+                    continue
+                if end > since or not self.discard_stale:
+                    return start, end
+            elif kind == 'eof':
+                raise EOFError("capture source exhausted")
+            elif kind == 'error':
+                raise RuntimeError(event[1])
+
+    def collect_timings(self):
+        """
+        子プロセスがリングバッファに書いた処理時間をchunk_timerに渡す
+        """
+        end = self.ring.seq
+        if chunk_timer is not None:
+            for row in self.ring.timings(self.timed, end):
+                chunk_timer.add(*row)
+        self.timed = end
+
+    def flush(self):
+        """
+        これまでに録音した音声を捨てる
+        応答の再生を終えたときに呼び，再生中に拾った自分の声が
+        次の発話として扱われないようにする
+        """
+        if self.ring is not None:
+            self.discard_before = self.ring.seq
+
+    def handle_exit(self):
+        """
+        子プロセスが知らせずに終了したときに呼ぶ
+        起動し直せる回数が残っていれば起動し直し，無ければCaptureErrorを投げる
+        """
+        msg = "録音用のプロセスが終了しました(終了コード{})".format(
+                self.process.exitcode)
+        if self.restarts >= self.max_restarts:
+            raise CaptureError(msg)
+        self.restarts += 1
+        logging.error(msg + "。起動し直します({}回目)".format(self.restarts))
+        self.stop()
+        self.start()
+
+    def get_audiodata(self, timeout=None):
+        """
+        次の発話をAudioDataとして返す
+        タイムアウトしたらNoneを返す
+        """
+        start_time = time.perf_counter()
+        while True:
+            r = self.get_utterance(timeout)
+            if r is None:
+                return None
+            try:
+                # 共有メモリからコピーするのは，ここの1回だけ
+                data = self.ring.read(*r)
+                break
+            except OverrunError:
+                logging.warning("発話を読み込む前に上書きされました")
+        metrics.observe('capture_wait', time.perf_counter() - start_time)
+        return AudioData(data, self.rate, 2)
+
+    def stop(self):
+        """
+        子プロセスを止めて，共有メモリを解放する
+        """
+        if self.process is not None:
+            self.stop_event.set()
+            self.process.join(5)
+            if self.process.is_alive():
+                self.process.terminate()
+                self.process.join()
+            self.process = None
+        if self.ring is not None:
+            self.ring.close()
+            self.ring.unlink()
+            self.ring = None
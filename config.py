@@ -1,23 +1,104 @@
 # システムの設定値
 
-from bing_recognizer import Bing
-
 SAMPLE_RATE = 16000
 VOLUME_THRESHOLD = 200
-STARTUP_TIME = 3
+# 発話を待っている間，生データのRMSがこの値より小さい(ピークも4倍未満の)
+# チャンクはフィルタをかけずに無音とみなし，CPUの使用量を減らす(0なら省かない)
+# 近似なので，小さな声の出だしなどで発話の区間が変わることがある
+# 使うときは，マイクの雑音より大きく，小さな声より十分小さい値にする
+# (VOLUME_THRESHOLDが256以下のときは使わない)
+IDLE_GATE = 0
+# 閾値を超えた音がこの秒数より長く続いたら，録音を始める
+# (以前のSTARTUP_TIMEはチャンクの数で，STARTUP_SECONDSが無いときだけ
+# 秒に直して使う)
+STARTUP_SECONDS = 0.2
 SILENCE_LIMIT = 2
 PREV_LENGTH = 1.0
 MAX_SECOND = 9.5
+# 音声認識の前に，発話の前後の無音を取り除く
+TRIM_SILENCE = True
+# 無音を取り除くときに，発話の前後に残す秒数
+TRIM_MARGIN = 0.2
+# 1回に読み込む音声の長さの目安(ミリ秒)，これを超えない2のべき乗のチャンク値にする
+CAPTURE_LATENCY = 64
+# マイクのチャンネル数(マイクアレイなら4や6)
+MIC_CHANNELS = 1
+# 複数チャンネルを1チャンネルにまとめる方法
+# 'best'はSN比が一番よいチャンネルを選び，'beam'は遅れを揃えて足し合わせる
+MIC_MIX = 'best'
+# 'beam'で揃えるチャンネル間の遅れの最大値(ミリ秒)
+MIC_MAX_DELAY = 1.0
+# 録音と発話区間の検出を別プロセスで行う
+CAPTURE_PROCESS = False
+# 別プロセスで録音するときに，共有メモリに保持する音声の秒数
+CAPTURE_BUFFER = 30
+# 最近の発話を保存するアーカイブのファイル(Noneなら保存しない)
+# 保存した発話はpython3 archive.py list/exportで確認する
+ARCHIVE_PATH = None
+# アーカイブの音声領域のバイト数(16kHzで約17分)と，保存する発話の最大数
+ARCHIVE_SIZE = 32 * 1024 * 1024
+ARCHIVE_SLOTS = 1024
 
 WAKE_WORD = 'ラズパイ'
 
-RECOGNIZER = Bing
+# 音声認識の結果の候補(N-best)をいくつまで受け取るか(1なら一番確からしいものだけ)
+# ウェイクワードとコマンドは，候補を確からしい順に調べて最初に一致したものを使う
+RECOGNITION_ALTERNATIVES = 3
+# 2番目以降の候補をウェイクワードとして受け付けるのは，何番目の候補までか
+# (1なら先頭の候補だけ)と，その候補の信頼度の下限(信頼度の無い候補は受け付けない)
+# 再起動，終了のコマンドは先頭の候補のときだけ受け付ける
+WAKE_WORD_MAX_RANK = 2
+WAKE_WORD_MIN_CONFIDENCE = 0.6
+
+# プラグインのファイルを調べる間隔(秒)，変更されたプラグインを自動で読み込み直す
+# (0なら「再起動」と話したときだけ読み込み直す)
+PLUGIN_RELOAD_INTERVAL = 2
+
+# 音声認識のクラス(モジュール名.クラス名，使うときに読み込む)
+RECOGNIZER = 'bing_recognizer.Bing'
 BING_KEY = '(Bing Speech APIのキー)'
+# 音声認識APIのエンドポイント(speechserver.pyのローカルサーバーを使うときに変える)
+BING_TOKEN_URL = 'https://api.cognitive.microsoft.com/sts/v1.0/issueToken'
+BING_RECOGNITION_URL = 'https://speech.platform.bing.com/speech/recognition/interactive/cognitiveservices/v1'
+GOOGLE_DISCOVERY_URL = ('https://{api}.googleapis.com/$discovery/rest?'
+                        'version={apiVersion}')
+
+# プラグインで共有するHTTPクライアントの設定
+
+# 接続，読み込みのタイムアウト(秒)
+HTTP_TIMEOUT = 10
+# 同時接続数の上限
+HTTP_MAX_CONNECTIONS = 4
+# 条件付きGET用にレスポンスを保存するディレクトリ(Noneだとメモリ上に保存)
+HTTP_CACHE_DIR = None
+# メモリ上に置く，条件付きGET用のレスポンスの合計バイト数の上限
+HTTP_CACHE_MEMORY = 4 * 1024 * 1024
+
+# ハブ(hub.py)で応答を音声合成してサテライトに送る
+# (Falseならサテライトで音声合成する)
+HUB_TTS = True
 
 # 天気予報用のURLとインデックス
 
 WR_URL = 'https://tenki.jp/week/3/'
 WR_INDEX = 0
+# ページのすべての地点を索引にするかどうか(地名で天気を聞けるようになる)
+# 関東・甲信地方のページ(約80KB，42地点)で，索引は約30KBのメモリを使う
+# FalseだとWR_INDEX番目の地点を読んだところで受信をやめる
+WR_ALL_PLACES = True
+# 天気予報の索引を作り直す間隔(秒)と時刻
+WR_REFRESH = 1800
+WR_REFRESH_AT = ['05:00']
+
+# Wikipedia検索用の索引ファイル(wikiindex.pyで作る，Noneだと使わない)
+WIKI_INDEX = None
+# あいまい検索用の項目名の一覧ファイル(Noneだとあいまい検索をしない)
+# 1項目名あたり約680バイトのメモリを使うので，Raspberry Piでは
+# 全項目名ではなく，よく聞く項目名に絞り込んだ一覧を指定する
+# (索引の全項目名はメモリに載らないので，WIKI_INDEXからは読まない)
+WIKI_TITLES = None
+# 存在しない項目名を覚えておく秒数
+WIKI_NEGATIVE_TTL = 3600
 
 # 効果音
 
@@ -3,49 +3,238 @@
 
 # 標準ライブラリのモジュールをインポート
 
+import time
+_import_time = time.perf_counter()
+
 import sys
 import os
 from io import BytesIO
 import logging
 import optparse
 import importlib
+import threading
 
-# PyAudio，gttsなど外部ライブラリをインポート
+# PyAudio，gtts，PyGameなど時間のかかる外部ライブラリは，
+# 起動を速くするため使うときに読み込む
 
-import pyaudio
-from gtts import gTTS
+import metrics
+from audio import AudioData, AudioFile
+from plugin import import_commands, reload_commands, schedule_commands, \
+        watch_commands, load_recognizer, recognize_candidates, \
+        has_wake_word, dispatch_candidates
+from scheduler import Scheduler
+from vad import startup_seconds
+
+# プラグインの先読み用ジョブを実行するスケジューラー
+scheduler = Scheduler()
+# メインループのプロファイルを取るオブジェクト(--profileを指定したときのみ)
+profiler = None
+
+# PyGame(ミキサーを初期化できたら読み込む)
+pygame = None
+pygame_ready = False
+# バックグラウンドで初期化を行うスレッド
+warmup_thread = None
+# スピーカーの代わりに音声を受け取るオブジェクト(リプレイ用)
+# speech(txt)とplay(path)メソッドを持つ
+sink = None
+# マイクの代わりに音声を読み込むPyAudio互換のオブジェクトを返す関数
+audio_factory = None
+# 録音用の子プロセス(設定ファイルのCAPTURE_PROCESSがTrueのときのみ)
+capture_process = None
+
+# 最近の発話を保存するアーカイブ(設定ファイルのARCHIVE_PATHを指定したときのみ)
+archive = None
+
+# プラグインより先に調べる，組み込みのコマンド
+BUILTIN_COMMANDS = ('再起動', '終了')
+
+# リプレイする音声のディレクトリかマニフェスト(--replayを指定したときのみ)
+replay_path = None
+# プラグインのジョブ(先読みや読み込み直し)をスケジューラーで動かすかどうか
+# リプレイではネットワークに繋がないよう，--replay-scheduleを指定したときだけ
+schedule_plugins = True
+
+# 起動にかかった時間を記録する
+startup_timing = False
+startup_marks = []
+
+
+def process_start():
+    """
+    プロセスが起動した時刻をtime.perf_counter()の値で返す
+    /procが無い環境では，このモジュールを読み込み始めた時刻を返す
+    """
+    try:
+        with open('/proc/self/stat') as f:
+            starttime = int(f.read().rsplit(')', 1)[1].split()[19])
+        with open('/proc/uptime') as f:
+            uptime = float(f.read().split()[0])
+        elapsed = uptime - starttime / os.sysconf('SC_CLK_TCK')
+        return time.perf_counter() - elapsed
+    except (OSError, ValueError, IndexError):
+        return _import_time
+
+
+def startup_mark(name):
+    """
+    起動処理の区切りの時刻を記録する
+    """
+    startup_marks.append((name, time.perf_counter()))
 
-# PyGameをインポート
 
-pygame_ready = False
-try:
-    import pygame
-    pygame.mixer.init()
-    pygame_ready = True
-except ImportError:
-    pass
+def startup_report():
+    """
+    プロセスの起動からの経過時間を表にして返す
+    """
+    start = process_start()
+    lines = ["起動時間(プロセス起動からのミリ秒)"]
+    prev = start
+    for name, t in sorted(startup_marks, key=lambda m: m[1]):
+        lines.append("{:>9.1f}ms (+{:>8.1f}ms) {}".format(
+                     (t - start)*1000, (t - prev)*1000, name))
+        prev = t
+    return '\n'.join(lines)
 
 
-from audio import AudioData, AudioFile
-from record import get_sound_chunk
-from plugin import invoke_commands, import_commands
+def on_listen():
+    """
+    最初に音声のモニターを開始したときに，起動時間を報告する
+    """
+    if any(name == 'listening' for name, t in startup_marks):
+        return
+    startup_mark('listening')
+    if startup_timing:
+        print(startup_report(), file=sys.stderr)
+
+
+def warmup():
+    """
+    時間のかかる初期化を行う
+    録音用のモジュール(NumPy，PyAudio)を読み込み，
+    PyGameのミキサーを初期化する
+    """
+    global pygame, pygame_ready
+    import record
+    startup_mark('record imported')
+    if getattr(config, 'CAPTURE_PROCESS', False) and audio_factory is None:
+        start_capture()
+        startup_mark('capture process started')
+    if sink is None:
+        try:
+            import pygame as pg
+            pg.mixer.init()
+            pygame = pg
+            pygame_ready = True
+        except (ImportError, RuntimeError):
+            # PyGameが無いか，音声の出力先が無い
+            pass
+        startup_mark('mixer initialized')
+
+
+def start_warmup():
+    """
+    プラグインの読み込みと並行して初期化を行うため，
+    warmup()をバックグラウンドのスレッドで開始する
+    """
+    global warmup_thread
+    warmup_thread = threading.Thread(target=warmup, name='warmup',
+                                     daemon=True)
+    warmup_thread.start()
+
+
+def wait_warmup():
+    """
+    バックグラウンドの初期化が終わるのを待つ
+    開始していなければ，ここで初期化する
+    """
+    global warmup_thread
+    if warmup_thread is None:
+        warmup_thread = threading.current_thread()
+        warmup()
+    elif warmup_thread is not threading.current_thread():
+        warmup_thread.join()
+
+
+def start_capture():
+    """
+    録音と発話区間の検出を行う子プロセスを起動する
+    """
+    global capture_process
+    import multiprocessing
+    from record import get_chunk
+    from capture import CaptureProcess
+    rate = config.SAMPLE_RATE
+    # スレッドを起動した後なので，forkではなくspawnで起動する
+    capture_process = CaptureProcess(
+            rate, get_chunk(rate, getattr(config, 'CAPTURE_LATENCY', None)),
+            config.VOLUME_THRESHOLD,
+            startup_seconds(config), config.SILENCE_LIMIT, config.PREV_LENGTH,
+            config.MAX_SECOND,
+            buffer_seconds=getattr(config, 'CAPTURE_BUFFER', 30),
+            context=multiprocessing.get_context('spawn'),
+            channels=getattr(config, 'MIC_CHANNELS', 1),
+            mix=getattr(config, 'MIC_MIX', 'best'),
+            max_delay=getattr(config, 'MIC_MAX_DELAY', None),
+            idle_gate=getattr(config, 'IDLE_GATE', 0))
+    capture_process.on_listen = on_listen
+    capture_process.start()
+
+
+def stop_capture():
+    """
+    録音用の子プロセスを止める
+    """
+    global capture_process
+    if capture_process is not None:
+        capture_process.stop()
+        capture_process = None
+
+
+def flush_capture():
+    """
+    応答を再生した後に呼び，再生中に録音した音声を発話として扱わない
+    """
+    if capture_process is not None:
+        capture_process.flush()
 
 
 def get_audiodata():
     """
     設定に従って音声を録音，AudioDataオブジェクトとして返す
     """
+    wait_warmup()
+    if capture_process is not None:
+        # 子プロセスが検出した発話を共有メモリから受け取る
+        ad = capture_process.get_audiodata()
+        msg = "音声チャンクを取得しました(サイズ{}バイト)。"
+        logging.debug(msg.format(len(ad.frame_data)))
+        return ad
+
+    from record import get_sound_chunk
+    # pyaudio.paInt16と同じ値(リプレイではPyAudioを読み込まない)
+    from capture import PA_INT16
+
     sf = BytesIO()
-    sf, w = get_sound_chunk(pyaudio.paInt16, 1,
+    sf, w = get_sound_chunk(PA_INT16,
+                         getattr(config, 'MIC_CHANNELS', 1),
                          config.SAMPLE_RATE, sf,
                          config.VOLUME_THRESHOLD,
-                         config.STARTUP_TIME,
+                         startup_seconds(config),
                          config.SILENCE_LIMIT,
                          config.PREV_LENGTH,
-                         config.MAX_SECOND)
-
+                         config.MAX_SECOND,
+                         on_listen=on_listen,
+                         audio_factory=audio_factory,
+                         latency=getattr(config, 'CAPTURE_LATENCY', None),
+                         mix=getattr(config, 'MIC_MIX', 'best'),
+                         max_delay=getattr(config, 'MIC_MAX_DELAY', None),
+                         idle_gate=getattr(config, 'IDLE_GATE', 0))
+
+    # WAVのヘッダーを除いた生データを取り出す
     sf.seek(0)
-    ad = AudioData(sf.read(), 16000, w)
+    with AudioFile(sf) as af:
+        ad = AudioData(af.stream.read(), af.SAMPLE_RATE, af.SAMPLE_WIDTH)
 
     msg = "音声チャンクを取得しました(サイズ{}バイト)。"
     logging.debug(msg.format(len(ad.get_raw_data())))
@@ -53,58 +242,135 @@ def get_audiodata():
     return ad
 
 
+def open_archive():
+    """
+    設定ファイルのARCHIVE_PATHに，最近の発話を保存するアーカイブを開く
+    """
+    global archive
+    path = getattr(config, 'ARCHIVE_PATH', None)
+    if path:
+        from archive import UtteranceArchive, DEFAULT_SIZE, DEFAULT_SLOTS
+        archive = UtteranceArchive(
+                path, getattr(config, 'ARCHIVE_SIZE', DEFAULT_SIZE),
+                getattr(config, 'ARCHIVE_SLOTS', DEFAULT_SLOTS))
+
+
+def archive_audio(ad):
+    """
+    録音した発話をアーカイブに保存し，発話の番号を返す
+    アーカイブを使わないときはNoneを返す
+    """
+    if archive is None:
+        return None
+    with metrics.span('archive'):
+        return archive.append(ad)
+
+
+def archive_note(seq, transcript=None, plugin=None):
+    """
+    アーカイブに保存した発話に，認識結果と反応したプラグインを書き込む
+    """
+    if archive is not None and seq is not None:
+        archive.annotate(seq, transcript, plugin)
+
+
+def get_recognizer():
+    """
+    設定ファイルのRECOGNIZERから音声認識のクラスを返す
+    """
+    return load_recognizer(config.RECOGNIZER)
+
+
 def recognize(ad):
     """
-    設定に従い音声認識を実行，結果を返す
+    設定に従い音声認識を実行，認識結果の候補(N-best)を
+    確からしい順に(文字列, 信頼度)のリストで返す
     """
-    # 音声認識オブジェクトを生成
-    rg = config.RECOGNIZER()
-    # 音声認識を実行
-    result = rg.recognize(ad, config, show_all=False)
+    # 音声認識オブジェクトを生成して実行
+    candidates = recognize_candidates(get_recognizer()(), ad, config)
     msg = "音声認識を実行しました。\n{}"
-    logging.debug(msg.format(str(result)))
-    return result
+    logging.debug(msg.format(str(candidates)))
+    return candidates
+
+
+def is_wake_word(candidates):
+    """
+    候補にウェイクワードがあればTrueを返す(plugin.has_wake_word()を参照)
+    """
+    return has_wake_word(candidates, config)
+
+
+def dispatch(candidates):
+    """
+    候補を確からしい順に調べてコマンドを実行する
+    組み込みのコマンド(BUILTIN_COMMANDS)は，先頭の候補のときだけ受け付ける
+    (plugin.dispatch_candidates()を参照)
+    """
+    return dispatch_candidates(candidates, config, BUILTIN_COMMANDS)
 
 
 def speech(txt):
     """
     テキストを音声ファイルに変換して再生する
     """
+    if sink is not None:
+        with metrics.span('tts_synthesis'):
+            sink.speech(txt)
+        flush_capture()
+        return
+
+    from gtts import gTTS
+
+    wait_warmup()
     # gttsを使って音声合成を実行
-    so = gTTS(text=txt, lang="ja")
-    so.save('speech_text.mp3')
-    if pygame_ready:
-        # PyGameをインポートしていたら，PyGameを使って音声再生
-        pygame.mixer.music.load('speech_text.mp3')
-        pygame.mixer.music.play()
-        while pygame.mixer.music.get_busy():
-            # 音声の再生が終わるまで待つ
-            pygame.time.Clock().tick(5)
-    else:
-        # PyGameをインポートできなかったので
-        # コマンドを使って音声再生(Raspberry Piのみ)
-        os.system("omxplayer ./speech_text.mp3")
+    with metrics.span('tts_synthesis'):
+        so = gTTS(text=txt, lang="ja")
+        so.save('speech_text.mp3')
+    with metrics.span('playback'):
+        if pygame_ready:
+            # PyGameをインポートしていたら，PyGameを使って音声再生
+            pygame.mixer.music.load('speech_text.mp3')
+            pygame.mixer.music.play()
+            while pygame.mixer.music.get_busy():
+                # 音声の再生が終わるまで待つ
+                pygame.time.Clock().tick(5)
+        else:
+            # PyGameをインポートできなかったので
+            # コマンドを使って音声再生(Raspberry Piのみ)
+            os.system("omxplayer ./speech_text.mp3")
     os.remove('./speech_text.mp3')
+    flush_capture()
 
 
 def play_sound(path):
     """
     ファイルを指定して音声を再生する
     """
+    if sink is not None:
+        sink.play(path)
+        flush_capture()
+        return
+    wait_warmup()
     if pygame_ready:
-        pygame.mixer.music.load(path)
-        pygame.mixer.music.play()
-        while pygame.mixer.music.get_busy():
-            # 音声の再生が終わるまで待つ
-            pygame.time.Clock().tick(5)
+        with metrics.span('playback'):
+            pygame.mixer.music.load(path)
+            pygame.mixer.music.play()
+            while pygame.mixer.music.get_busy():
+                # 音声の再生が終わるまで待つ
+                pygame.time.Clock().tick(5)
+    flush_capture()
 
 
 def restart():
     """
     プラグインと設定ファイルを再読み込みする
+    (プラグインは，変更されたものだけを読み込み直す)
     """
-    import_commands()
     importlib.reload(config)
+    # 読み込み直したプラグインのジョブだけを登録し直す
+    # (変わっていないプラグインのジョブはすぐに実行し直さない)
+    reload_commands(scheduler=scheduler if schedule_plugins else None,
+                    config=config)
 
 
 def run():
@@ -113,14 +379,26 @@ def run():
     """
     logging.debug("スマートスピーカーを起動しました")
     play_sound(config.STARTUP)
+    startup_mark('startup sound')
+    if profiler:
+        profiler.start()
+    interactions = 0
     while True:
         # メインループ
-        
+        if profiler and interactions:
+            # 前回の対話が終わったことをプロファイラに伝える
+            profiler.tick()
+        interactions += 1
+
         # 音声チャンクを取得する
         ad = get_audiodata()
+        seq = archive_audio(ad)
 
         # 音声認識を実行
-        result = recognize(ad)
+        candidates = recognize(ad)
+        result = config.WAKE_WORD if is_wake_word(candidates) \
+            else (candidates[0][0] if candidates else '')
+        archive_note(seq, result)
 
         if result == config.WAKE_WORD:
             # ウェイクワードが発声されたので，コマンドを待ち受け
@@ -129,8 +407,10 @@ def run():
             play_sound(config.COMMANDREADY)
 
             ad = get_audiodata()
-            # 音声認識を実行
-            result = recognize(ad)
+            seq = archive_audio(ad)
+            # 音声認識を実行し，候補を順に調べてコマンドを探す
+            result, mod, com_result = dispatch(recognize(ad))
+            archive_note(seq, result)
 
             # 再起動，終了のコマンドを実行
             if result == '再起動':
@@ -148,8 +428,9 @@ def run():
                 speech(msg)
                 break
 
-            # 音声コマンドを実行
-            com_result = invoke_commands(result, config)
+            # 音声コマンドの結果
+            if mod is not None:
+                archive_note(seq, plugin=mod.__name__.rsplit('.', 1)[-1])
 
             if com_result:
                 # 文字列を音声に変換して再生
@@ -178,6 +459,33 @@ def set_option():
     parser.add_option('-c', '--config',
                       action='store', dest='conffile', default='config',
                       help='設定ファイルを指定する(オプション，省略するとconfig.pyを使う)')
+    parser.add_option('--metrics-port',
+                      action='store', dest='metrics_port', type='int',
+                      default=None,
+                      help='処理時間のメトリクスを公開するポート番号(オプション)')
+    parser.add_option('--profile',
+                      action='store', dest='profile', type='int', default=0,
+                      help='指定した回数の対話の間，プロファイルを取る(オプション)')
+    parser.add_option('--profile-seconds',
+                      action='store', dest='profile_seconds', type='float',
+                      default=0,
+                      help='指定した秒数の間，プロファイルを取る(オプション)')
+    parser.add_option('--profile-dir',
+                      action='store', dest='profile_dir', default='.',
+                      help='プロファイルの結果を書き出すディレクトリ(オプション)')
+    parser.add_option('--startup-timing',
+                      action='store_true', dest='startup_timing',
+                      default=False,
+                      help='起動から音声のモニター開始までの時間を表示する(オプション)')
+    parser.add_option('--replay',
+                      action='store', dest='replay', default=None,
+                      help=('マイクの代わりにWAVファイルのディレクトリか'
+                            'マニフェストから音声を読み込む(オプション)'))
+    parser.add_option('--replay-schedule',
+                      action='store_true', dest='replay_schedule',
+                      default=False,
+                      help=('リプレイでもプラグインのジョブ(天気予報などの'
+                            '先読み)を動かす(オプション)'))
     options, remainder = parser.parse_args()
     loglevel = None
     if options.loglevel.lower() == 'debug':
@@ -187,14 +495,58 @@ def set_option():
     if loglevel:
         logging.basicConfig(level=loglevel)
 
+    global startup_timing
+    startup_timing = options.startup_timing
+
+    if options.metrics_port is not None:
+        # メトリクスをhttp://127.0.0.1:<ポート番号>/metricsで公開する
+        metrics.start_server(options.metrics_port)
+
+    if options.profile or options.profile_seconds:
+        # メインループのプロファイルを取る
+        from profiler import Profiler
+        global profiler
+        profiler = Profiler(options.profile_dir,
+                            interactions=options.profile or None,
+                            seconds=options.profile_seconds or None)
+
     # 設定ファイルを読み込む
     conffile = options.conffile
     global config   # 設定オブジェクト
     config = importlib.import_module(conffile)
 
+    global replay_path, schedule_plugins
+    replay_path = options.replay
+    schedule_plugins = not replay_path or options.replay_schedule
+
 
 if __name__ == '__main__':
     set_option()
+    if replay_path:
+        # 録音した音声でパイプライン全体を動かす
+        import replay
+        replay.setup(sys.modules[__name__], replay_path)
+    open_archive()
+    # 録音用のモジュールとミキサーの初期化を，プラグインの読み込みと並行して行う
+    start_warmup()
+    startup_mark('config loaded')
     import_commands()
-    run()
+    startup_mark('plugins loaded')
+    if schedule_plugins:
+        scheduler.start()
+        schedule_commands(scheduler, config)
+        if getattr(config, 'PLUGIN_RELOAD_INTERVAL', 0):
+            # 変更されたプラグインを，録音を止めずに読み込み直す
+            watch_commands(scheduler, config, config.PLUGIN_RELOAD_INTERVAL)
+    try:
+        if replay_path:
+            replay.run(sys.modules[__name__])
+        else:
+            run()
+    finally:
+        if profiler:
+            profiler.stop()
+        stop_capture()
+        if archive is not None:
+            archive.close()
 
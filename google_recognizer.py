@@ -12,6 +12,9 @@ import json
 from googleapiclient import discovery
 import httplib2
 
+import metrics
+
+# ディスカバリ文書のURL(設定ファイルのGOOGLE_DISCOVERY_URLで変えられる)
 DISCOVERY_URL = ('https://{api}.googleapis.com/$discovery/rest?'
                  'version={apiVersion}')
 
@@ -22,7 +25,7 @@ class Google:
 
 
     def recognize(self, audio_data, config=None, key='',
-                  language="ja-JP", show_all=False):
+                  language="ja-JP", show_all=False, max_alternatives=0):
         """
         Google Cloud Speech APIを使って音声認識を実行するメソッド。
         audio_data(AudioData)に音声ファイル，
@@ -30,41 +33,59 @@ class Google:
         APIを呼び出して結果を返す。
         show_allがTrueだとレスポンスのJSONを辞書に変換して返す。
         Falseだと，認識した文字列を返す。
+        max_alternativesを指定すると，maxAlternativesを付けて呼び出し，
+        (文字列, 信頼度)の候補(N-best)を確からしい順に最大max_alternatives個，
+        リストで返す。
         """
         print(show_all)
         # アクセスキーを変数に代入
         access_key = key or config.GOOGLE_KEY
 
 
+        # 前後の無音を取り除き，送るデータを小さくする
+        if getattr(config, 'TRIM_SILENCE', True):
+            with metrics.span('trim'):
+                audio_data = audio_data.trim(
+                        margin=getattr(config, 'TRIM_MARGIN', 0.2))
+
         # WAVデータを変換，BASE 64エンコードする
-        wav_data = audio_data.get_wav_data(
-            convert_rate=16000,  # audio samples must be 8kHz or 16 kHz
-            convert_width=2  # audio samples should be 16-bit
-        )
-        speech_data = base64.b64encode(wav_data)
+        with metrics.span('wav_encode'):
+            wav_data = audio_data.get_wav_data(
+                convert_rate=16000,  # audio samples must be 8kHz or 16 kHz
+                convert_width=2  # audio samples should be 16-bit
+            )
+            speech_data = base64.b64encode(wav_data)
         http = httplib2.Http()
         service = discovery.build('speech', 'v1beta1', http=http,
-                        discoveryServiceUrl=DISCOVERY_URL,
+                        discoveryServiceUrl=getattr(
+                            config, 'GOOGLE_DISCOVERY_URL', DISCOVERY_URL),
                         developerKey=access_key)
 
         # APIに送るリクエストを作る
+        recognition_config = {
+            'encoding': 'LINEAR16',  # raw 16-bit signed LE samples
+            'sampleRate': 16000,  # 16 khz
+            'languageCode': language
+        }
+        if max_alternatives:
+            # 候補を複数返してもらう(APIの上限は30)
+            recognition_config['maxAlternatives'] = min(30, max_alternatives)
         service_request = service.speech().syncrecognize(
             body={
-                'config': {
-                    'encoding': 'LINEAR16',  # raw 16-bit signed LE samples
-                    'sampleRate': 16000,  # 16 khz
-                    'languageCode': language
-                },
+                'config': recognition_config,
                 'audio': {
                     'content': speech_data.decode('UTF-8')
                     }
                 })
         # APIを呼び出して結果を得る
-        response = service_request.execute()
+        with metrics.span('recognize_request'):
+            response = service_request.execute()
 
         # 結果を返す
         if show_all:
             return response
+        elif max_alternatives:
+            return parse_alternatives(response, max_alternatives)
         else:
             if response.get('results', '') and \
                     len(response.get('results', [])) and\
@@ -74,6 +95,17 @@ class Google:
                     return alt['transcript']
             return ""
 
+
+def parse_alternatives(response, max_alternatives):
+    """
+    レスポンスの最初の結果から，(文字列, 信頼度)の候補を最大max_alternatives個返す
+    信頼度は先頭の候補にしか付かないことが多く，無ければNoneにする
+    """
+    results = response.get('results') or [{}]
+    return [(alt['transcript'], alt.get('confidence'))
+            for alt in results[0].get('alternatives', [])
+            if alt.get('transcript', '')][:max_alternatives]
+
 def test_recognize(key, filename):
     """
     Google Cloud Speech APIを使って音声認識するテスト用関数
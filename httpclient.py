@@ -0,0 +1,390 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# httpclient.py
+# プラグインで共有するHTTPクライアント
+# ホストごとに持続的接続をプールし，gzip/deflateを透過的に展開，
+# ETag/Last-Modifiedを使った条件付きGETでレスポンスを再検証する
+
+import os
+import io
+import json
+import zlib
+import hashlib
+import logging
+import threading
+import http.client
+from collections import OrderedDict
+from urllib.parse import urlsplit, urljoin
+
+
+# 同時に使える接続数の上限
+DEFAULT_MAX_CONNECTIONS = 4
+# ホストごとにプールしておく待機中の接続数
+DEFAULT_MAX_IDLE = 2
+# 接続，読み込みのタイムアウト(秒)
+DEFAULT_TIMEOUT = 10
+# リダイレクトをたどる回数の上限
+MAX_REDIRECTS = 5
+
+# メモリ上に置くレスポンスの本文の合計バイト数と，エントリ数の上限
+DEFAULT_STORE_BYTES = 4 * 1024 * 1024
+DEFAULT_STORE_ENTRIES = 64
+
+USER_AGENT = 'miniot_sspeaker'
+REDIRECT_CODES = (301, 302, 303, 307, 308)
+
+
+class HTTPClientError(Exception): pass
+
+
+class ResponseStore:
+    """
+    条件付きGET用にレスポンスを保存するクラス
+    pathを指定するとディレクトリにファイルとして保存し，
+    省略するとメモリ上に保存する
+    メモリ上には，最近使ったものから本文の合計がmax_bytes，
+    数がmax_entriesまでのエントリを置き，それを超えたら古いものから捨てる
+    (長く動かし続けても，メモリの使用量が増え続けないようにする)
+    """
+
+    def __init__(self, path=None, max_bytes=DEFAULT_STORE_BYTES,
+                 max_entries=DEFAULT_STORE_ENTRIES):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.Lock()
+        if path:
+            os.makedirs(path, exist_ok=True)
+
+    def _remember(self, url, entry):
+        """
+        エントリをメモリ上に置き，上限を超えたら古いものから捨てる
+        呼び出す側でlockを取っておく
+        """
+        old = self.entries.pop(url, None)
+        if old is not None:
+            self.size -= len(old[2])
+        if len(entry[2]) > self.max_bytes:
+            # 大きすぎる本文はメモリ上に置かない
+            return
+        self.entries[url] = entry
+        self.size += len(entry[2])
+        while self.size > self.max_bytes or \
+                len(self.entries) > self.max_entries:
+            url, old = self.entries.popitem(last=False)
+            self.size -= len(old[2])
+
+    def _filename(self, url):
+        return os.path.join(self.path,
+                            hashlib.sha1(url.encode('utf-8')).hexdigest())
+
+    def get(self, url):
+        """
+        保存したエントリ(etag, last_modified, body)を返す
+        保存されていなければNoneを返す
+        """
+        with self.lock:
+            if url in self.entries:
+                self.entries.move_to_end(url)
+                return self.entries[url]
+        if not self.path:
+            return None
+        fn = self._filename(url)
+        try:
+            with open(fn+'.json', 'r', encoding='utf-8') as f:
+                meta = json.load(f)
+            with open(fn+'.body', 'rb') as f:
+                body = f.read()
+        except (OSError, ValueError):
+            return None
+        entry = (meta.get('etag'), meta.get('last_modified'), body)
+        with self.lock:
+            self._remember(url, entry)
+        return entry
+
+    def put(self, url, etag, last_modified, body):
+        """
+        レスポンスのバリデータと本文を保存する
+        """
+        entry = (etag, last_modified, body)
+        with self.lock:
+            self._remember(url, entry)
+        if not self.path:
+            return
+        fn = self._filename(url)
+        try:
+            # 書きかけのファイルを読まないように，置き換えで保存する
+            with open(fn+'.body.tmp', 'wb') as f:
+                f.write(body)
+            os.replace(fn+'.body.tmp', fn+'.body')
+            with open(fn+'.json.tmp', 'w', encoding='utf-8') as f:
+                json.dump({'url': url, 'etag': etag,
+                           'last_modified': last_modified}, f)
+            os.replace(fn+'.json.tmp', fn+'.json')
+        except OSError as e:
+            logging.warning("レスポンスを保存できませんでした({})".format(e))
+
+
+class Response:
+    """
+    HTTPのレスポンスを表すクラス
+    read()やiter_content()で展開済みの本文を少しずつ読み出せる
+    最後まで読むと接続はプールに戻り，途中でclose()すると接続を切る
+    """
+
+    def __init__(self, url, status, headers, raw=None, body=None,
+                 release=None, store=None):
+        self.url = url
+        self.status = status
+        self.headers = headers
+        self.from_cache = body is not None
+        self._raw = raw
+        self._body = io.BytesIO(body) if body is not None else None
+        self._release = release
+        self._store = store
+        self._saved = [] if store else None
+        self._eof = False
+        self._closed = False
+
+        encoding = ''
+        if raw is not None:
+            encoding = (headers.get('Content-Encoding') or '').lower()
+        self._decoder = None
+        self._raw_deflate = False
+        if encoding == 'gzip':
+            self._decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == 'deflate':
+            self._decoder = zlib.decompressobj()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def _decode(self, data):
+        if self._decoder is None:
+            return data
+        try:
+            return self._decoder.decompress(data)
+        except zlib.error:
+            if self._raw_deflate:
+                raise
+            # zlibヘッダの無いdeflateを送るサーバーがあるので，
+            # raw deflateとして展開し直す
+            self._raw_deflate = True
+            self._decoder = zlib.decompressobj(-zlib.MAX_WBITS)
+            return self._decoder.decompress(data)
+
+    def iter_content(self, chunk_size=8192):
+        """
+        展開済みの本文をchunk_sizeバイト程度ずつ返すジェネレータ
+        """
+        while not self._eof and not self._closed:
+            if self._body is not None:
+                data = self._body.read(chunk_size)
+                if not data:
+                    self._finish()
+                    break
+                yield data
+                continue
+            raw = self._raw.read(chunk_size)
+            if not raw:
+                data = self._decoder.flush() if self._decoder else b''
+                if data:
+                    self._keep(data)
+                    yield data
+                self._finish()
+                break
+            data = self._decode(raw)
+            if data:
+                self._keep(data)
+                yield data
+
+    def read(self, amt=None):
+        """
+        本文を読み込んでバイト列として返す
+        amtを省略すると最後まで読み込む
+        """
+        if amt is None:
+            return b''.join(self.iter_content())
+        for data in self.iter_content(amt):
+            return data
+        return b''
+
+    def _keep(self, data):
+        if self._saved is not None:
+            self._saved.append(data)
+
+    def _finish(self):
+        """
+        本文を最後まで読んだときの処理
+        """
+        self._eof = True
+        if self._saved is not None:
+            self._store.put(self.url,
+                            self.headers.get('ETag'),
+                            self.headers.get('Last-Modified'),
+                            b''.join(self._saved))
+            self._saved = None
+        self.close()
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._release:
+            # 最後まで読んでいれば接続を再利用できる
+            self._release(self._eof)
+            self._release = None
+
+
+class HTTPClient:
+    """
+    プラグインで共有するHTTPクライアント
+    同時接続数はmax_connectionsまでに制限され，
+    すべての接続にtimeoutが設定される
+    """
+
+    def __init__(self, timeout=DEFAULT_TIMEOUT,
+                 max_connections=DEFAULT_MAX_CONNECTIONS,
+                 max_idle=DEFAULT_MAX_IDLE, store=None):
+        self.timeout = timeout
+        self.max_idle = max_idle
+        self.store = store if store is not None else ResponseStore()
+        self.slots = threading.BoundedSemaphore(max_connections)
+        self.lock = threading.Lock()
+        self.idle = {}
+
+    def _connect(self, key, fresh=False):
+        """
+        プールから接続を取り出す，無ければ新しく作る
+        freshがTrueなら必ず新しく作る
+        戻り値は(接続, 再利用したかどうか)
+        """
+        with self.lock:
+            conns = self.idle.get(key)
+            if conns and not fresh:
+                return conns.pop(), True
+        scheme, host, port = key
+        if scheme == 'https':
+            conn = http.client.HTTPSConnection(host, port,
+                                               timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(host, port,
+                                              timeout=self.timeout)
+        return conn, False
+
+    def _put_back(self, key, conn):
+        with self.lock:
+            conns = self.idle.setdefault(key, [])
+            if len(conns) < self.max_idle:
+                conns.append(conn)
+                return
+        conn.close()
+
+    def _request(self, key, path, headers):
+        """
+        接続を取得してGETリクエストを送る
+        再利用した接続がサーバー側で切られていたら，一度だけ接続し直す
+        """
+        conn, reused = self._connect(key)
+        try:
+            conn.request('GET', path, headers=headers)
+            return conn, conn.getresponse()
+        except (http.client.RemoteDisconnected, ConnectionError,
+                http.client.BadStatusLine):
+            conn.close()
+            if not reused:
+                raise
+        conn, reused = self._connect(key, fresh=True)
+        conn.request('GET', path, headers=headers)
+        return conn, conn.getresponse()
+
+    def open(self, url, headers=None, revalidate=True):
+        """
+        URLにGETでアクセスし，Responseオブジェクトを返す
+        以前のレスポンスが保存されていれば条件付きGETで再検証し，
+        304が返ってきたら保存した本文をレスポンスとして返す
+        戻り値はwith文で使うか，close()を呼んで閉じること
+        """
+        if not self.slots.acquire(timeout=self.timeout):
+            raise HTTPClientError("too many connections: {}".format(url))
+        try:
+            return self._open(url, headers, revalidate)
+        except:
+            self.slots.release()
+            raise
+
+    def _open(self, url, headers, revalidate):
+        for i in range(MAX_REDIRECTS+1):
+            parts = urlsplit(url)
+            scheme = parts.scheme or 'http'
+            port = parts.port or (443 if scheme == 'https' else 80)
+            key = (scheme, parts.hostname, port)
+            path = parts.path or '/'
+            if parts.query:
+                path += '?' + parts.query
+
+            req_headers = {'Accept-Encoding': 'gzip, deflate',
+                           'User-Agent': USER_AGENT}
+            req_headers.update(headers or {})
+            entry = self.store.get(url) if revalidate else None
+            if entry:
+                etag, last_modified, body = entry
+                if etag:
+                    req_headers['If-None-Match'] = etag
+                if last_modified:
+                    req_headers['If-Modified-Since'] = last_modified
+
+            conn, resp = self._request(key, path, req_headers)
+
+            if resp.status in REDIRECT_CODES and resp.getheader('Location'):
+                resp.read()
+                self._release_conn(key, conn, resp, True)
+                url = urljoin(url, resp.getheader('Location'))
+                continue
+
+            if resp.status == 304 and entry:
+                # 変更されていないので，保存した本文を返す
+                resp.read()
+                self._release_conn(key, conn, resp, True)
+                logging.debug("レスポンスを再利用します({})".format(url))
+                return Response(url, 200, resp.headers, body=entry[2],
+                                release=lambda eof: self.slots.release())
+
+            store = None
+            if resp.status == 200 and (resp.getheader('ETag') or
+                                       resp.getheader('Last-Modified')):
+                store = self.store
+
+            def release(eof, key=key, conn=conn, resp=resp):
+                self._release_conn(key, conn, resp, eof)
+                self.slots.release()
+
+            return Response(url, resp.status, resp.headers, raw=resp,
+                            release=release, store=store)
+        raise HTTPClientError("too many redirects: {}".format(url))
+
+    def _release_conn(self, key, conn, resp, eof):
+        """
+        レスポンスを読み終えた接続をプールに戻す
+        途中で読むのをやめた場合は，接続を切る
+        """
+        if eof and not resp.will_close:
+            self._put_back(key, conn)
+        else:
+            conn.close()
+
+    def close(self):
+        """
+        プールしている接続をすべて閉じる
+        """
+        with self.lock:
+            conns = [c for cs in self.idle.values() for c in cs]
+            self.idle.clear()
+        for conn in conns:
+            conn.close()
@@ -0,0 +1,536 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# hub.py
+# 複数のスピーカー(サテライト)の音声認識，音声コマンド，音声合成を
+# 1台のハブでまとめて行うサーバーモード
+# サテライトは録音と発話区間の検出だけを行い，発話をソケットでハブに送る
+# ハブはCPUのコア数に合わせたプロセスプールで発話を処理し，
+# サテライトごとのセッション(ウェイクワードの状態)を持つ
+# サテライトの間では，発話を順番に公平に処理する
+#
+# ハブを起動する(認証が無いので，初期値ではこのマシンからしか接続できない
+# 他のマシンのサテライトを使うときは，信頼できるLANでだけ--hostを指定する):
+#   python3 hub.py serve --host 192.168.0.10 --port 7000
+# サテライトを起動する:
+#   python3 hub.py satellite --host 192.168.0.10 --port 7000 --id kitchen
+
+import os
+import json
+import time
+import struct
+import socket
+import logging
+import argparse
+import importlib
+import tempfile
+import threading
+import socketserver
+from collections import deque, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
+
+import metrics
+from audio import AudioData
+
+
+# フレームの先頭に置く，ヘッダー(JSON)の長さ
+FRAME_HEADER = struct.Struct('>I')
+# ヘッダーと本体の大きさの上限
+MAX_HEADER = 64 * 1024
+MAX_PAYLOAD = 16 * 1024 * 1024
+
+
+class ProtocolError(Exception):
+    """
+    サテライトとハブの間のフレームが不正
+    """
+
+
+def send_frame(sock, header, payload=b''):
+    """
+    ヘッダー(辞書)と本体(バイト列)を1つのフレームとして送る
+    """
+    header = dict(header, size=len(payload))
+    h = json.dumps(header, ensure_ascii=False).encode('utf-8')
+    sock.sendall(FRAME_HEADER.pack(len(h)) + h + payload)
+
+
+def recv_frame(rfile):
+    """
+    フレームを1つ読み，(ヘッダー, 本体)を返す
+    接続が閉じられていたらNoneを返す
+    """
+    b = rfile.read(FRAME_HEADER.size)
+    if not b:
+        return None
+    if len(b) < FRAME_HEADER.size:
+        raise ProtocolError("truncated frame")
+    n, = FRAME_HEADER.unpack(b)
+    if n > MAX_HEADER:
+        raise ProtocolError("header too large")
+    header = json.loads(rfile.read(n).decode('utf-8'))
+    if not isinstance(header, dict):
+        raise ProtocolError("header is not an object")
+    size = header.get('size', 0)
+    if not isinstance(size, int) or size < 0:
+        raise ProtocolError("invalid payload size")
+    if size > MAX_PAYLOAD:
+        raise ProtocolError("payload too large")
+    payload = rfile.read(size)
+    if len(payload) < size:
+        raise ProtocolError("truncated payload")
+    return header, payload
+
+
+class FairQueue:
+    """
+    サテライトごとの待ち行列を，順番に1つずつ取り出すキュー
+    1つのサテライトの発話は，前の発話の処理が終わる(done()を呼ぶ)まで
+    取り出さないので，セッションの状態が処理の順番と食い違わない
+    """
+
+    def __init__(self):
+        self.queues = OrderedDict()
+        self.busy = set()
+        self.cond = threading.Condition()
+        self.closed = False
+
+    def put(self, sid, item):
+        with self.cond:
+            self.queues.setdefault(sid, deque()).append(item)
+            self.cond.notify()
+
+    def get(self, timeout=None):
+        """
+        処理中でないサテライトの発話を，前回の次のサテライトから順に探して
+        (サテライトのID, 発話)を返す
+        閉じられたか，タイムアウトしたらNoneを返す
+        """
+        with self.cond:
+            deadline = None if timeout is None else time.monotonic() + timeout
+            while not self.closed:
+                for sid in list(self.queues):
+                    q = self.queues[sid]
+                    if q and sid not in self.busy:
+                        item = q.popleft()
+                        self.busy.add(sid)
+                        # 取り出したサテライトを最後に回す
+                        self.queues.move_to_end(sid)
+                        return sid, item
+                remain = None if deadline is None else \
+                        deadline - time.monotonic()
+                if remain is not None and remain <= 0:
+                    return None
+                self.cond.wait(remain)
+            return None
+
+    def done(self, sid):
+        """
+        サテライトの発話の処理が終わった
+        """
+        with self.cond:
+            self.busy.discard(sid)
+            self.cond.notify_all()
+
+    def remove(self, sid):
+        """
+        切断したサテライトの待ち行列を捨てる
+        """
+        with self.cond:
+            self.queues.pop(sid, None)
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    def __len__(self):
+        with self.cond:
+            return sum(len(q) for q in self.queues.values())
+
+
+# プロセスプールのワーカーで使う設定と音声認識のオブジェクト
+_worker_config = None
+_recognizer = None
+
+
+def config_values(config):
+    """
+    ワーカーに渡すため，設定の値を辞書にする
+    """
+    return {k: getattr(config, k) for k in dir(config) if k.isupper()}
+
+
+def init_worker(values):
+    """
+    ワーカーのプロセスを初期化する
+    設定を受け取り，プラグインを読み込む
+    """
+    global _worker_config
+    from plugin import import_commands
+    _worker_config = SimpleNamespace(**values)
+    import_commands()
+
+
+def get_recognizer(config):
+    """
+    ワーカーの音声認識のオブジェクトを返す
+    アクセストークンを使い回すため，ワーカーごとに1つだけ作る
+    """
+    global _recognizer
+    if _recognizer is None:
+        from plugin import load_recognizer
+        _recognizer = load_recognizer(config.RECOGNIZER)()
+    return _recognizer
+
+
+def synthesize(txt):
+    """
+    テキストを音声合成し，MP3のバイト列を返す
+    """
+    from io import BytesIO
+    from gtts import gTTS
+    fp = BytesIO()
+    gTTS(text=txt, lang="ja").write_to_fp(fp)
+    return fp.getvalue()
+
+
+def process_utterance(frames, rate, width, awake):
+    """
+    ワーカーで実行する，発話1つ分の処理
+    音声認識を行い，ウェイクワードの後の発話(awakeがTrue)なら
+    音声コマンドを実行して応答を音声合成する
+    認識結果の候補(N-best)の扱いは，daemon.pyと同じplugin.pyの関数で決める
+    結果を辞書で返す
+    """
+    from plugin import recognize_candidates, has_wake_word, \
+            dispatch_candidates
+    config = _worker_config
+    r = {'transcript': '', 'wake': False, 'response': None,
+         'failure': False, 'pid': os.getpid()}
+    start = time.perf_counter()
+    candidates = []
+    try:
+        candidates = recognize_candidates(
+                get_recognizer(config), AudioData(frames, rate, width),
+                config)
+    except Exception as e:
+        r['error'] = '{}: {}'.format(type(e).__name__, e)
+    r['recognize_time'] = time.perf_counter() - start
+    transcript = r['transcript'] = candidates[0][0] if candidates else ''
+    if awake:
+        # サテライトには組み込みのコマンド(再起動，終了)は無い
+        response = dispatch_candidates(candidates, config)[2]
+        if not response:
+            r['failure'] = True
+            if transcript:
+                response = transcript+"はコマンドとして認識できません。"
+            else:
+                response = "音声認識に失敗しました。"
+        r['response'] = response
+        if getattr(config, 'HUB_TTS', True):
+            try:
+                r['speech'] = synthesize(response)
+            except Exception as e:
+                logging.warning("音声合成に失敗しました({})".format(e))
+    elif has_wake_word(candidates, config):
+        r['wake'] = True
+    return r
+
+
+class Session:
+    """
+    サテライトごとのセッション
+    ウェイクワードを認識した後，次の発話をコマンドとして扱う
+    """
+
+    def __init__(self, sid, sock):
+        self.sid = sid
+        self.sock = sock
+        self.awake = False
+        self.utterances = 0
+        self.send_lock = threading.Lock()
+
+    def send(self, header, payload=b''):
+        with self.send_lock:
+            send_frame(self.sock, header, payload)
+
+
+class SatelliteHandler(socketserver.StreamRequestHandler):
+    """
+    サテライトからの接続を受け付けるハンドラ
+    """
+
+    def handle(self):
+        hub = self.server.hub
+        session = None
+        try:
+            frame = recv_frame(self.rfile)
+            if frame is None or frame[0].get('type') != 'hello':
+                raise ProtocolError("expected hello")
+            session = hub.open_session(frame[0].get('id'), self.request)
+            session.send({'type': 'welcome', 'id': session.sid})
+            while True:
+                frame = recv_frame(self.rfile)
+                if frame is None:
+                    break
+                header, payload = frame
+                if header.get('type') == 'utterance':
+                    hub.submit(session, header, payload)
+                elif header.get('type') == 'bye':
+                    break
+        except (ProtocolError, ValueError) as e:
+            logging.warning("サテライトから不正なフレームを受け取りました({})"
+                            .format(e))
+            # 接続を閉じる前に，理由をサテライトに知らせる
+            try:
+                header = {'type': 'error', 'error': str(e)}
+                if session is not None:
+                    session.send(header)
+                else:
+                    send_frame(self.request, header)
+            except OSError:
+                pass
+        except OSError as e:
+            logging.warning("サテライトとの通信でエラーが発生しました({})"
+                            .format(e))
+        finally:
+            if session is not None:
+                hub.close_session(session)
+
+
+class HubServer(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class Hub:
+    """
+    サテライトから受け取った発話を，プロセスプールで処理するハブ
+    workersを省略するとCPUのコア数だけワーカーを起動する
+    """
+
+    def __init__(self, config, address=('127.0.0.1', 0), workers=None,
+                 mp_context=None):
+        self.config = config
+        self.workers = workers or os.cpu_count() or 1
+        self.server = HubServer(address, SatelliteHandler)
+        self.server.hub = self
+        self.executor = ProcessPoolExecutor(
+                self.workers, mp_context=mp_context,
+                initializer=init_worker, initargs=(config_values(config),))
+        self.queue = FairQueue()
+        self.sessions = {}
+        self.lock = threading.Lock()
+        # 同時に処理する発話の数をワーカーの数までにする
+        self.slots = threading.Semaphore(self.workers)
+        self.threads = []
+
+    @property
+    def address(self):
+        return self.server.server_address[:2]
+
+    def open_session(self, sid, sock):
+        with self.lock:
+            if not sid or sid in self.sessions:
+                # IDが無いか重複していれば，番号を付ける
+                base = sid or 'satellite'
+                n = 1
+                while '{}-{}'.format(base, n) in self.sessions:
+                    n += 1
+                sid = '{}-{}'.format(base, n)
+            session = self.sessions[sid] = Session(sid, sock)
+        logging.debug("サテライト({})が接続しました".format(sid))
+        return session
+
+    def close_session(self, session):
+        with self.lock:
+            self.sessions.pop(session.sid, None)
+        self.queue.remove(session.sid)
+        logging.debug("サテライト({})が切断しました".format(session.sid))
+
+    def submit(self, session, header, payload):
+        """
+        サテライトの発話を待ち行列に入れる
+        """
+        session.utterances += 1
+        self.queue.put(session.sid, (session, header, payload,
+                                     time.perf_counter()))
+
+    def dispatch(self):
+        """
+        待ち行列から発話を取り出し，ワーカーに渡すスレッド
+        """
+        while True:
+            self.slots.acquire()
+            item = self.queue.get()
+            if item is None:
+                self.slots.release()
+                return
+            sid, (session, header, payload, queued) = item
+            metrics.observe('hub_queue', time.perf_counter() - queued)
+            future = self.executor.submit(
+                    process_utterance, payload, header.get('rate', 16000),
+                    header.get('width', 2), session.awake)
+            future.add_done_callback(
+                    lambda f, s=session, h=header, q=queued:
+                    self.finish(s, h, q, f))
+
+    def finish(self, session, header, queued, future):
+        """
+        ワーカーの処理が終わった発話の結果を，サテライトに返す
+        """
+        try:
+            try:
+                r = future.result()
+            except Exception as e:
+                r = {'transcript': '', 'wake': False, 'response': None,
+                     'failure': True,
+                     'error': '{}: {}'.format(type(e).__name__, e)}
+            # セッションの状態を更新する
+            session.awake = r['wake']
+            speech = r.pop('speech', b'') or b''
+            r.update(type='result', seq=header.get('seq'))
+            metrics.observe('hub_utterance', time.perf_counter() - queued)
+            try:
+                session.send(r, speech)
+            except OSError:
+                pass
+        finally:
+            self.queue.done(session.sid)
+            self.slots.release()
+
+    def start(self):
+        for target in (self.server.serve_forever, self.dispatch):
+            t = threading.Thread(target=target, daemon=True)
+            t.start()
+            self.threads.append(t)
+        logging.debug("ハブを起動しました({}:{}，ワーカー{})".format(
+                      *self.address, self.workers))
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.queue.close()
+        for t in self.threads:
+            t.join()
+        self.executor.shutdown()
+
+
+class SatelliteClient:
+    """
+    ハブに接続して発話を送るサテライト側のクライアント
+    """
+
+    def __init__(self, address, sid=None, timeout=60):
+        self.sock = socket.create_connection(address, timeout=timeout)
+        self.rfile = self.sock.makefile('rb')
+        self.seq = 0
+        send_frame(self.sock, {'type': 'hello', 'id': sid})
+        header, payload = self.receive()
+        self.sid = header['id']
+
+    def receive(self):
+        """
+        ハブからフレームを1つ受け取る
+        ハブがエラーを返したらProtocolErrorを投げる
+        """
+        frame = recv_frame(self.rfile)
+        if frame is None:
+            raise ConnectionError("hub closed the connection")
+        if frame[0].get('type') == 'error':
+            raise ProtocolError(frame[0].get('error'))
+        return frame
+
+    def send(self, ad):
+        """
+        AudioDataを送り，ハブから(結果の辞書, 応答の音声)を受け取って返す
+        """
+        self.seq += 1
+        send_frame(self.sock, {'type': 'utterance', 'seq': self.seq,
+                               'rate': ad.sample_rate,
+                               'width': ad.sample_width}, ad.frame_data)
+        return self.receive()
+
+    def close(self):
+        try:
+            send_frame(self.sock, {'type': 'bye'})
+        except OSError:
+            pass
+        self.rfile.close()
+        self.sock.close()
+
+
+def run_satellite(address, sid, daemon):
+    """
+    daemonモジュールの録音と再生を使って，サテライトとして動く
+    """
+    client = SatelliteClient(address, sid, timeout=None)
+    logging.debug("ハブに接続しました({})".format(client.sid))
+    daemon.play_sound(daemon.config.STARTUP)
+    try:
+        while True:
+            ad = daemon.get_audiodata()
+            r, speech = client.send(ad)
+            if r['wake']:
+                daemon.play_sound(daemon.config.COMMANDREADY)
+            elif r['response']:
+                if r['failure']:
+                    daemon.play_sound(daemon.config.FAILURE)
+                if speech:
+                    with tempfile.NamedTemporaryFile(suffix='.mp3') as f:
+                        f.write(speech)
+                        f.flush()
+                        daemon.play_sound(f.name)
+                else:
+                    # ハブで音声合成をしていないので，ここで合成する
+                    daemon.speech(r['response'])
+    finally:
+        client.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description='複数のサテライトの発話をまとめて処理するハブ')
+    parser.add_argument('-c', '--config', default='config',
+                        help='設定ファイル(省略するとconfig.pyを使う)')
+    parser.add_argument('-l', '--loglevel', default='INFO')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p_serve = sub.add_parser('serve', help='ハブを起動する')
+    p_serve.add_argument('--host', default='127.0.0.1',
+                         help='待ち受けるアドレス(認証が無いので，'
+                              '他のマシンから使うときだけ指定する)')
+    p_serve.add_argument('--port', type=int, default=7000)
+    p_serve.add_argument('-j', '--workers', type=int, default=None,
+                         help='ワーカーの数(省略するとCPUのコア数)')
+    p_serve.add_argument('--metrics-port', type=int, default=None)
+    p_sat = sub.add_parser('satellite', help='サテライトとして動く')
+    p_sat.add_argument('--host', default='127.0.0.1')
+    p_sat.add_argument('--port', type=int, default=7000)
+    p_sat.add_argument('--id', default=socket.gethostname(),
+                       help='サテライトの名前')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=getattr(logging, args.loglevel.upper()))
+    config = importlib.import_module(args.config)
+    if args.command == 'serve':
+        if args.metrics_port is not None:
+            metrics.start_server(args.metrics_port)
+        hub = Hub(config, (args.host, args.port), args.workers).start()
+        try:
+            while True:
+                time.sleep(3600)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            hub.stop()
+    else:
+        import daemon
+        daemon.config = config
+        daemon.start_warmup()
+        try:
+            run_satellite((args.host, args.port), args.id, daemon)
+        finally:
+            daemon.stop_capture()
@@ -0,0 +1,196 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# metrics.py
+# 処理段階ごとの所要時間を計測し，Prometheusのテキスト形式で公開する
+
+import time
+import logging
+import threading
+from contextlib import contextmanager
+
+
+# ヒストグラムのバケットの上限(秒)，1ミリ秒から約33秒まで倍々に増やす
+BUCKETS = tuple(0.001 * 2 ** i for i in range(16))
+# 処理段階の所要時間を記録するメトリクスの名前
+STAGE_METRIC = 'sspeaker_stage_seconds'
+
+
+class Histogram:
+    """
+    固定の対数バケットに値を数えていくヒストグラム
+    値をいくつ記録してもメモリの使用量は一定
+    """
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        i = 0
+        for i, le in enumerate(self.buckets):
+            if value <= le:
+                break
+        else:
+            i = len(self.buckets)
+        self.counts[i] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        """
+        (バケットの上限, その値以下の個数)のリストを返す
+        最後の上限は'+Inf'
+        """
+        r = []
+        total = 0
+        for le, n in zip(self.buckets + ('+Inf',), self.counts):
+            total += n
+            r.append((le, total))
+        return r
+
+    def quantile(self, q):
+        """
+        q(0から1)分位点の近似値を，バケットの上限で返す
+        """
+        if not self.count:
+            return 0.0
+        target = q * self.count
+        for le, total in self.cumulative():
+            if total >= target:
+                return le if le != '+Inf' else self.buckets[-1]
+        return self.buckets[-1]
+
+
+class Registry:
+    """
+    ラベルごとのヒストグラムをまとめて持つクラス
+    """
+
+    def __init__(self):
+        self.histograms = {}
+        self.lock = threading.Lock()
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self.lock:
+            h = self.histograms.get(key)
+            if h is None:
+                h = self.histograms[key] = Histogram()
+            h.observe(value)
+
+    def get(self, name, **labels):
+        with self.lock:
+            return self.histograms.get((name, tuple(sorted(labels.items()))))
+
+    def clear(self):
+        with self.lock:
+            self.histograms.clear()
+
+    def render(self):
+        """
+        Prometheusのテキスト形式の文字列を返す
+        """
+        lines = []
+        with self.lock:
+            items = sorted(self.histograms.items())
+            families = []
+            for (name, labels), h in items:
+                if name not in families:
+                    families.append(name)
+                    lines.append('# TYPE {} histogram'.format(name))
+                base = ','.join('{}="{}"'.format(k, _escape(v))
+                                for k, v in labels)
+                for le, total in h.cumulative():
+                    le = le if le == '+Inf' else repr(le)
+                    lb = (base + ',' if base else '') + 'le="{}"'.format(le)
+                    lines.append('{}_bucket{{{}}} {}'.format(name, lb, total))
+                lb = '{' + base + '}' if base else ''
+                lines.append('{}_sum{} {}'.format(name, lb, repr(h.sum)))
+                lines.append('{}_count{} {}'.format(name, lb, h.count))
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(v):
+    return str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+# 全体で共有するレジストリ
+REGISTRY = Registry()
+
+
+def observe(stage, seconds, **labels):
+    """
+    処理段階(stage)の所要時間を記録する
+    """
+    REGISTRY.observe(STAGE_METRIC, seconds, stage=stage, **labels)
+
+
+@contextmanager
+def span(stage, **labels):
+    """
+    with文で囲んだ処理の所要時間をtime.perf_counterで測り，記録する
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        observe(stage, time.perf_counter() - start, **labels)
+
+
+def report(registry=None):
+    """
+    処理段階ごとの回数，平均，パーセンタイル(ミリ秒)を表にした文字列を返す
+    パーセンタイルはバケットの上限による近似値
+    """
+    registry = registry or REGISTRY
+    lines = ['{:32s} {:>7s} {:>10s} {:>10s} {:>10s} {:>10s}'.format(
+             'stage', 'count', 'mean(ms)', 'p50(ms)', 'p90(ms)', 'p99(ms)')]
+    with registry.lock:
+        items = sorted(registry.histograms.items())
+    for (name, labels), h in items:
+        if name != STAGE_METRIC or not h.count:
+            continue
+        labels = dict(labels)
+        stage = labels.pop('stage', '')
+        if labels:
+            stage += '[' + ','.join(str(v) for v in labels.values()) + ']'
+        lines.append('{:32s} {:>7d} {:>10.2f} {:>10.2f} {:>10.2f} {:>10.2f}'
+                     .format(stage, h.count, h.sum/h.count*1000,
+                             h.quantile(0.5)*1000, h.quantile(0.9)*1000,
+                             h.quantile(0.99)*1000))
+    return '\n'.join(lines)
+
+
+def start_server(port, host='127.0.0.1'):
+    """
+    /metricsでメトリクスを返すHTTPサーバーを別スレッドで起動する
+    """
+    # 起動を速くするため，サーバーを起動するときに読み込む
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+    class MetricsHandler(BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.split('?')[0] != '/metrics':
+                self.send_error(404)
+                return
+            body = REGISTRY.render().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    thread = threading.Thread(target=server.serve_forever,
+                              name='metrics', daemon=True)
+    thread.start()
+    logging.debug("メトリクスを公開します(http://{}:{}/metrics)".format(
+                  host, server.server_port))
+    return server
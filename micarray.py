@@ -0,0 +1,128 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# micarray.py
+# マイクアレイ(複数チャンネル)の音声を，発話の検出の前に1チャンネルにまとめる
+# SN比が一番よいチャンネルを選ぶ('best')か，
+# チャンネル間の遅れを相互相関で推定して揃えてから足し合わせる('beam')
+# チャンクごとに，すべてのチャンネルを1回のFFTでまとめて処理する
+
+import numpy as np
+
+import record
+
+
+# チャンネル間の遅れの最大値(ミリ秒)，マイクの間隔が約34cmまでなら1ミリ秒でよい
+MAX_DELAY = 1.0
+
+# 今のチャンネルよりSN比がこの倍率以上よいチャンネルがあれば切り替える
+SWITCH_RATIO = 1.5
+
+# 'beam'で，SN比がこの値より大きいチャンクだけで遅れを推定し直す
+MIN_SNR = 4.0
+
+# 雑音のレベルがチャンクごとに上がる割合
+FLOOR_RISE = 1.01
+
+
+def deinterleave(data, channels):
+    """
+    インターリーブされた16ビットの生データを，
+    コピーせずに(チャンネル数, サンプル数)の配列のビューにする
+    """
+    samples = np.frombuffer(data, dtype=np.int16)
+    return samples.reshape(-1, channels).T
+
+
+def estimate_delays(spectra, ref, max_lag, mask):
+    """
+    各チャンネルのスペクトル(チャンネル数, ビン数)から，
+    refのチャンネルに対する遅れ(サンプル数，-max_lagからmax_lagまで)を
+    GCC-PHAT(位相だけを使った相互相関)で推定して配列で返す
+    """
+    n = (spectra.shape[1] - 1) * 2
+    cross = spectra * np.conj(spectra[ref])
+    cross /= np.maximum(np.abs(cross), 1e-12)
+    cross[:, ~mask] = 0
+    cc = np.fft.irfft(cross, n, axis=1)
+    # 遅れが-max_lagからmax_lagまでの相関を並べる
+    window = np.concatenate((cc[:, -max_lag:], cc[:, :max_lag+1]), axis=1) \
+        if max_lag else cc[:, :1]
+    return np.argmax(window, axis=1) - max_lag
+
+
+class ChannelMixer:
+    """
+    複数チャンネルのチャンクを受け取り，1チャンネルのチャンクを返すクラス
+    mode='best'なら，チャンネルごとのSN比(帯域内のエネルギーと，
+    チャンネルごとに追跡する雑音のレベルの比)が一番よいチャンネルを選ぶ
+    mode='beam'なら，SN比が一番よいチャンネルを基準に各チャンネルの遅れを推定し，
+    遅れを揃えて，雑音の少ないチャンネルほど重くした重みで平均する
+    (出力はmax_delayミリ秒分遅れる)
+    """
+
+    def __init__(self, channels, rate, mode='best', max_delay=MAX_DELAY,
+                 switch_ratio=SWITCH_RATIO, min_snr=MIN_SNR):
+        assert mode in ('best', 'beam'), "mode must be 'best' or 'beam'"
+        self.channels = channels
+        self.rate = rate
+        self.mode = mode
+        self.max_lag = int(round(max_delay * rate / 1000.0))
+        self.switch_ratio = switch_ratio
+        self.min_snr = min_snr
+        self.channel = 0
+        self.floor = None
+        self.snr = np.ones(channels)
+        self.delays = np.zeros(channels, dtype=int)
+        # 遅れを揃えるため，前のチャンクの末尾を2 * max_lagサンプル分残す
+        self.history = np.zeros((channels, 2 * self.max_lag))
+
+    def update_snr(self, energy):
+        """
+        チャンクのエネルギーから雑音のレベルとSN比を更新し，使うチャンネルを選ぶ
+        雑音のレベルは，エネルギーが下がればすぐに下げ，上がればゆっくり上げる
+        """
+        energy = np.maximum(energy, 1.0)
+        if self.floor is None:
+            self.floor = energy.copy()
+        self.floor = np.minimum(energy, self.floor * FLOOR_RISE)
+        self.snr = energy / self.floor
+        best = int(np.argmax(self.snr))
+        if self.snr[best] > self.snr[self.channel] * self.switch_ratio:
+            self.channel = best
+        return self.channel
+
+    def process(self, data):
+        """
+        インターリーブされたチャンクを，1チャンネルの16ビットの生データにして返す
+        """
+        x = deinterleave(data, self.channels)
+        n = x.shape[1]
+        spectra = np.fft.rfft(x, axis=1)
+        mask = record.band_mask(n, self.rate)
+        power = spectra.real ** 2 + spectra.imag ** 2
+        ch = self.update_snr(power[:, mask].sum(axis=1))
+        if self.mode == 'best':
+            return x[ch].tobytes()
+
+        if self.max_lag and self.snr[ch] > self.min_snr:
+            # 発話を含むチャンクで，基準のチャンネルに対する遅れを推定し直す
+            self.delays = estimate_delays(spectra, ch, self.max_lag, mask)
+        buf = np.concatenate((self.history, x), axis=1)
+        self.history = buf[:, n:]
+        # チャンネルcの時刻tの出力にはbuf[c, t + delay + max_lag]を使う
+        idx = np.arange(n) + (self.delays + self.max_lag)[:, None]
+        aligned = np.take_along_axis(buf, idx, axis=1)
+        weights = 1.0 / self.floor
+        out = weights @ aligned / weights.sum()
+        return np.clip(out, -32768, 32767).astype(np.int16).tobytes()
+
+
+def get_mixer(channels, rate, mode='best', max_delay=MAX_DELAY):
+    """
+    チャンネルが2つ以上ならChannelMixerを返し，1つならNoneを返す
+    """
+    if channels <= 1:
+        return None
+    return ChannelMixer(channels, rate, mode or 'best',
+                        MAX_DELAY if max_delay is None else max_delay)
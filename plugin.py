@@ -2,61 +2,377 @@
 # -*- coding: utf-8 -*-
 
 
-__all__ = ['import_commands', 'invoke_commands']
+__all__ = ['import_commands', 'reload_commands', 'watch_commands',
+           'invoke_commands', 'find_command', 'schedule_commands',
+           'get_http_client', 'load_recognizer', 'recognize_candidates',
+           'has_wake_word', 'dispatch_candidates']
 
 import sys
 import os
 import importlib
+import importlib.util
 import traceback
 import logging
+import threading
 
+import metrics
+from httpclient import HTTPClient, ResponseStore, DEFAULT_STORE_BYTES
 
+
+# 読み込んだプラグインのリスト
+# 読み込み直すときは新しいリストを作って置き換えるので，
+# コマンドの実行中に中身が変わることはない
 COMMANDS = []
 
+# プラグインのファイルの更新時刻とサイズ(モジュール名がキー)
+MTIMES = {}
+# 読み込めなかったプラグインのファイルの更新時刻とサイズ(モジュール名がキー)
+# 同じファイルを何度も読み込んでエラーを記録しないよう，変わるまで読まない
+FAILED = {}
+# プラグインがスケジューラーに登録したジョブの名前(モジュール名がキー)
+JOBS = {}
+# プラグインの読み込み直しを同時に行わないためのロック
+_reload_lock = threading.Lock()
+
+# プラグインで共有するHTTPクライアントと，作ったときの設定
+HTTP_CLIENT = None
+HTTP_SETTINGS = None
+_http_lock = threading.Lock()
+
+
+def plugin_files(p='plugins'):
+    """
+    プラグインのモジュール名とファイルのパスの組を，名前順のリストで返す
+    """
+    # プラグインディレクトリのパスを設定
+    plugin_path = importlib.import_module(p).__path__[0]
+
+    files = []
+    for pfn in sorted(os.listdir(plugin_path)):
+        # .pyファイルだけを読み込む(testsや.pytest_cacheなどは読み込まない)
+        if pfn.startswith(('_', '.')) or not pfn.endswith('.py'):
+            continue
+        files.append((p+'.'+pfn[:-len('.py')], os.path.join(plugin_path, pfn)))
+    return files
+
+
+def file_stamp(path):
+    """
+    ファイルが変わったかを調べるため，更新時刻(ナノ秒)とサイズを返す
+    """
+    st = os.stat(path)
+    return st.st_mtime_ns, st.st_size
+
 
 def import_commands(p='plugins'):
     """
     コマンド用のプラグインを読み込む
     """
+    global COMMANDS
+    mods = []
+    with _reload_lock:
+        MTIMES.clear()
+        FAILED.clear()
+        # プラグインを動的にインポート
+        for name, path in plugin_files(p):
+            MTIMES[name] = file_stamp(path)
+            mods.append(importlib.import_module(name))
+        # プラグイン保存用のリストを置き換える
+        COMMANDS = mods
 
-    # プラグインディレクトリのパスを設定
-    base = os.path.dirname(__file__)
-    plugin_path = os.path.join(base, p)
 
-    # プラグインの一覧を取得
-    dirs = os.listdir(plugin_path)
+def load_module(name, path):
+    """
+    pathのファイルを新しいモジュールオブジェクトとして実行して返す
+    途中でエラーになっても，sys.modulesや読み込み済みのモジュールは変わらない
+    """
+    spec = importlib.util.spec_from_file_location(name, path)
+    mod = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(mod)
+    return mod
 
-    # プラグインのリストをクリア
-    COMMANDS.clear()
 
-    # プラグインを動的にインポート
-    for pfn in dirs:
-        if pfn.startswith('_'):
-            continue
-        pfn = pfn.replace('.py', '')
-        mod = importlib.import_module(p+'.'+pfn)
-        # プラグイン保存用のリストにモジュールオブジェクトを追加
-        COMMANDS.append(mod)
+def install_module(name, mod):
+    """
+    読み込んだモジュールを，sys.modulesとパッケージの属性に登録する
+    """
+    sys.modules[name] = mod
+    package, _, attr = name.rpartition('.')
+    if package in sys.modules:
+        setattr(sys.modules[package], attr, mod)
+
+
+def reload_commands(p='plugins', scheduler=None, config=None):
+    """
+    前回読み込んだ後に変更，追加，削除されたプラグインだけを読み込み直す
+    変更されたプラグインは新しいモジュールとして最後まで実行できたときだけ
+    sys.modulesに登録し，COMMANDSを新しいリストに置き換える
+    (実行中のモジュールは書き換えないので，エラーになっても前のまま使える)
+    schedulerを渡すと，読み込み直したプラグインのジョブを登録し直す
+    読み込み直したモジュール名のリストを返す
+    """
+    global COMMANDS
+    with _reload_lock:
+        current = {mod.__name__: mod for mod in COMMANDS}
+        mods = []
+        changed = []
+        stamps = {}
+        for name, path in plugin_files(p):
+            try:
+                stamp = file_stamp(path)
+            except OSError:
+                # 読み込み直している間に削除された
+                continue
+            mod = current.get(name)
+            if mod is not None and MTIMES.get(name) == stamp:
+                mods.append(mod)
+                stamps[name] = stamp
+                continue
+            if FAILED.get(name) == stamp:
+                # 前に読み込めなかったファイルのまま変わっていない
+                if mod is not None:
+                    mods.append(mod)
+                    stamps[name] = MTIMES.get(name)
+                continue
+            try:
+                # 変更，追加されたプラグインと，一度取り除いたプラグインは
+                # 新しいモジュールに読み込み，実行中のモジュールには手を付けない
+                new = load_module(name, path)
+            except Exception:
+                # 読み込めなかったら，前のモジュールを使い続ける
+                msg = "プラグイン({})の読み込み中にエラーが発生しました\n{}"
+                logging.error(msg.format(name, traceback.format_exc()))
+                FAILED[name] = stamp
+                if mod is not None:
+                    mods.append(mod)
+                    stamps[name] = MTIMES.get(name)
+                continue
+            # 最後まで実行できたモジュールだけを入れ替える
+            FAILED.pop(name, None)
+            install_module(name, new)
+            mod = new
+            logging.info("プラグイン({})を読み込み直しました".format(name))
+            mods.append(mod)
+            stamps[name] = stamp
+            changed.append(mod)
+        removed = [name for name in current if name not in stamps]
+        if not changed and not removed:
+            return []
+        MTIMES.clear()
+        MTIMES.update(stamps)
+        # コマンドの一覧を一度に置き換える
+        COMMANDS = mods
+
+    for name in removed:
+        logging.info("プラグイン({})を取り除きました".format(name))
+    if scheduler is not None:
+        for name in removed:
+            unschedule_module(scheduler, name)
+        for mod in changed:
+            unschedule_module(scheduler, mod.__name__)
+            schedule_module(scheduler, config, mod)
+    return [mod.__name__ for mod in changed]
+
+
+def watch_commands(scheduler, config, interval=2, p='plugins'):
+    """
+    interval秒ごとにプラグインのファイルを調べ，
+    変更されたものを読み込み直すジョブをスケジューラーに登録する
+    録音や対話を止めずに，スケジューラーのスレッドで読み込み直す
+    """
+    scheduler.add_job('plugin-reload',
+                      lambda: reload_commands(p, scheduler, config),
+                      interval=interval, run_now=False)
 
 
 def invoke_commands(w, config):
     """
     プラグインから読み込んだコマンドを実行する
     """
+    return find_command(w, config)[1]
+
+
+def find_command(w, config):
+    """
+    プラグインから読み込んだコマンドを実行し，
+    反応したプラグインのモジュールと戻り値を返す
+    どのプラグインも反応しなければ(None, None)を返す
+    """
 
     # すべてのプラグインに認識したワードを渡し，コマンドを実行する
     for mod in COMMANDS:
         try:
             if hasattr(mod, 'process'):
-                mon_r = mod.process(w, config)
+                with metrics.span('plugin', plugin=mod.__name__):
+                    mon_r = mod.process(w, config)
                 if mon_r:
                     # 戻り値が戻ったら，その値をそのまま返す
-                    return mon_r
+                    return mod, mon_r
         except:
             e = e = sys.exc_info()[0]
             msg = "コマンド実行中にエラーが発生しました\n{}"
             logging.error(msg.format(traceback.format_tb(e)))
     # プラグインが反応しなかったので，Noneを返す
-    return None
+    return None, None
+
+
+def schedule_commands(scheduler, config):
+    """
+    プラグインにスケジューラーを渡し，先読み用のジョブを登録させる
+    プラグインはschedule(scheduler, config)関数でジョブを登録する
+    """
+    for mod in COMMANDS:
+        schedule_module(scheduler, config, mod)
 
 
+class JobRecorder:
+    """
+    プラグインが登録したジョブの名前を記録するため，スケジューラーを包むクラス
+    """
+
+    def __init__(self, scheduler, names):
+        self.scheduler = scheduler
+        self.names = names
+
+    def add_job(self, name, *args, **kwargs):
+        self.names.add(name)
+        return self.scheduler.add_job(name, *args, **kwargs)
+
+    def __getattr__(self, name):
+        return getattr(self.scheduler, name)
+
+
+def schedule_module(scheduler, config, mod):
+    """
+    1つのプラグインに先読み用のジョブを登録させる
+    """
+    try:
+        if hasattr(mod, 'schedule'):
+            names = JOBS.setdefault(mod.__name__, set())
+            mod.schedule(JobRecorder(scheduler, names), config)
+    except:
+        msg = "ジョブの登録中にエラーが発生しました\n{}"
+        logging.error(msg.format(traceback.format_exc()))
+
+
+def unschedule_module(scheduler, name):
+    """
+    プラグインが登録したジョブを取り除く
+    """
+    for job in JOBS.pop(name, ()):
+        scheduler.remove_job(job)
+
+
+def http_settings(config):
+    """
+    HTTPクライアントを作るのに使う設定の値を返す
+    """
+    return (getattr(config, 'HTTP_TIMEOUT', 10),
+            getattr(config, 'HTTP_MAX_CONNECTIONS', 4),
+            getattr(config, 'HTTP_CACHE_DIR', None),
+            getattr(config, 'HTTP_CACHE_MEMORY', DEFAULT_STORE_BYTES))
+
+
+def get_http_client(config=None):
+    """
+    プラグインで共有するHTTPクライアントを返す
+    設定ファイルのHTTP_TIMEOUT，HTTP_MAX_CONNECTIONS，HTTP_CACHE_DIR，
+    HTTP_CACHE_MEMORYを使ってクライアントを作り，
+    設定ファイルを読み込み直してこれらが変わったら作り直す
+    configを省略すると，今のクライアントをそのまま返す
+    """
+    global HTTP_CLIENT, HTTP_SETTINGS
+    settings = http_settings(config)
+    old = None
+    with _http_lock:
+        if HTTP_CLIENT is None or \
+                (config is not None and settings != HTTP_SETTINGS):
+            old = HTTP_CLIENT
+            timeout, max_connections, cache_dir, cache_memory = settings
+            HTTP_CLIENT = HTTPClient(
+                timeout=timeout, max_connections=max_connections,
+                store=ResponseStore(cache_dir, max_bytes=cache_memory))
+            HTTP_SETTINGS = settings
+        client = HTTP_CLIENT
+    if old is not None:
+        # 使い終わった接続から閉じる(使用中の接続はそのまま読み終えられる)
+        old.close()
+        logging.info("設定が変わったので，HTTPクライアントを作り直しました")
+    return client
+
+
+def load_recognizer(rc):
+    """
+    設定ファイルのRECOGNIZERから音声認識のクラスを返す
+    'bing_recognizer.Bing'のような文字列なら，そのモジュールを読み込む
+    """
+    if isinstance(rc, str):
+        modname, clsname = rc.rsplit('.', 1)
+        rc = getattr(importlib.import_module(modname), clsname)
+    return rc
+
+
+def recognize_candidates(rg, ad, config):
+    """
+    音声認識のオブジェクトrgで音声認識を実行し，認識結果の候補(N-best)を
+    確からしい順に(文字列, 信頼度)のリストで返す
+    信頼度が分からない候補はNoneにする
+    設定ファイルのRECOGNITION_ALTERNATIVESが1以下なら，候補は1つだけ
+    """
+    n = getattr(config, 'RECOGNITION_ALTERNATIVES', 1)
+    if n > 1:
+        candidates = []
+        for text, confidence in rg.recognize(ad, config, show_all=False,
+                                             max_alternatives=n):
+            if text not in [c[0] for c in candidates]:
+                candidates.append((text, confidence))
+    else:
+        result = rg.recognize(ad, config, show_all=False)
+        candidates = [(result, None)] if result else []
+    return candidates
+
+
+def has_wake_word(candidates, config):
+    """
+    候補にウェイクワードがあればTrueを返す
+    先頭以外の候補は，WAKE_WORD_MAX_RANK番目までで，信頼度が
+    WAKE_WORD_MIN_CONFIDENCE以上のものだけを数える(信頼度の無い候補は数えない)
+    テレビなどの声で，間違ってウェイクワードを認識しないようにする
+    """
+    max_rank = getattr(config, 'WAKE_WORD_MAX_RANK', 1)
+    min_confidence = getattr(config, 'WAKE_WORD_MIN_CONFIDENCE', 1.0)
+    for rank, (text, confidence) in enumerate(candidates[:max(1, max_rank)]):
+        if text != config.WAKE_WORD:
+            continue
+        if rank == 0 or (confidence is not None and
+                         confidence >= min_confidence):
+            if rank:
+                msg = "{}番目の候補(信頼度{})をウェイクワードとみなします"
+                logging.debug(msg.format(rank + 1, confidence))
+            return True
+    return False
+
+
+def dispatch_candidates(candidates, config, builtins=()):
+    """
+    音声認識の候補を確からしい順に調べ，最初に反応した候補でコマンドを実行する
+    組み込みのコマンド(builtins)は，先頭の候補のときだけ受け付け，
+    プラグインは呼ばずに(候補, None, None)を返す
+    プラグインが反応したら(候補, モジュール, 戻り値)を返す
+    どれにも反応しなければ(先頭の候補, None, None)を返す
+    """
+    for rank, (w, confidence) in enumerate(candidates):
+        if w in builtins:
+            if rank:
+                # 2番目以降の候補で，再起動や終了はしない
+                continue
+            mod, com_result = None, None
+        else:
+            mod, com_result = find_command(w, config)
+            if not com_result:
+                continue
+        if rank:
+            msg = "{}番目の候補({})でコマンドを実行します"
+            logging.debug(msg.format(rank + 1, w))
+        return w, mod, com_result
+    return (candidates[0][0] if candidates else ''), None, None
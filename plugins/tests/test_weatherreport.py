@@ -3,16 +3,188 @@
 
 # 天気予報を返す音声コマンド(whaetherreport)をテストする
 
+import threading
 import unittest
 from urllib.request import urlopen
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
 
 from weatherreport import *
 
 url = 'https://tenki.jp/week/3/16/'
-src = urlopen(url).read().decode('utf-8')
+
+# テスト用のtr要素
+tr_tokyo = """<tr>
+      <td class="point-name"><a href="/forecast/3/16/4410/13101-10days.html">千代田区</a><span class="city-name">東京地方(東京)</span></td>
+      <td class="forecast-wrap">
+        <p class="weather-icon"><img src="https://static.tenki.jp/images/icon/forecast-days-weather/08.png" alt="曇" title="曇" width="47" height="30"><br><span class="forecast-telop">曇</span></p>
+        <p><span class="high-temp">6</span>/<span class="low-temp">2</span></p>
+        <p class="precip">30<span class="unit">%</span></p>
+      </td>
+    </tr>"""
+tr_yokohama = tr_tokyo.replace('千代田区', '横浜市').replace(
+        '東京地方(東京)', '東部(横浜)').replace('>6<', '>8<')
+
+
+def make_page(n_rows):
+    """
+    テスト用の天気予報ページを作る
+    """
+    rows = [tr_tokyo, tr_yokohama] + [tr_tokyo]*(n_rows-2)
+    return ('<html><body><table><tr><th>地点</th></tr>'
+            + ''.join(rows)
+            + '</table></body></html>').encode('utf-8')
+
+
+class TestForecastParser(unittest.TestCase):
+
+    def test_parse_forecast(self):
+        """
+        parse_forecast()でページのすべての地点を取り出せるかテストする
+        """
+        page = make_page(100)
+        rows = parse_forecast(page[i:i+256] for i in range(0, len(page), 256))
+        self.assertEqual(len(rows), 100)
+        self.assertEqual(rows[1],
+                         Forecast('横浜市', '曇', '8', '2', '30', '東部(横浜)'))
+
+    def test_limit(self):
+        """
+        limit個の地点を読んだら，残りのチャンクを読まないことをテストする
+        """
+        page = make_page(100)
+        consumed = []
+        def chunks(size=256):
+            for i in range(0, len(page), size):
+                consumed.append(i)
+                yield page[i:i+size]
+
+        rows = parse_forecast(chunks(), 2)
+        self.assertEqual(rows[1],
+                         Forecast('横浜市', '曇', '8', '2', '30', '東部(横浜)'))
+        self.assertEqual(len(rows), 2)
+        self.assertLess(len(consumed)*256, len(page)//10)
+        # 地点が足りなければ，あるだけ返す
+        self.assertEqual(len(parse_forecast(chunks(), 1000)), 100)
+
+    def test_split_multibyte(self):
+        """
+        マルチバイト文字の途中でチャンクが切れる場合をテストする
+        """
+        page = make_page(3)
+        rows = parse_forecast(page[i:i+1] for i in range(len(page)))
+        self.assertEqual(rows[0], Forecast('千代田区', '曇', '6', '2', '30',
+                                           '東京地方(東京)'))
+
+
+class PageHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    count = 0
+
+    def do_GET(self):
+        PageHandler.count += 1
+        body = make_page(10)
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class Config:
+    WR_INDEX = 0
+    WR_REFRESH = 1800
+
+
+class TestWeatherIndex(unittest.TestCase):
+
+    def setUp(self):
+        PageHandler.count = 0
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), PageHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.config = Config()
+        self.config.WR_URL = 'http://127.0.0.1:{}/week/'.format(
+                self.server.server_port)
+        INDEX.updated = None
+
+    def tearDown(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def test_lookup(self):
+        """
+        WeatherIndexで地名から天気予報を引く
+        """
+        index = WeatherIndex()
+        index.refresh(self.config.WR_URL)
+        self.assertEqual(len(index.rows), 10)
+        self.assertEqual(index.lookup('横浜の天気').place, '横浜市')
+        self.assertEqual(index.lookup('東京の天気').place, '千代田区')
+        self.assertEqual(index.lookup('千代田区の天気').place, '千代田区')
+        self.assertIsNone(index.lookup('大阪の天気'))
+        self.assertEqual(index.get(1).place, '横浜市')
+        self.assertIsNone(index.get(10))
+
+    def test_process(self):
+        """
+        process()が1回の取得で複数の地点に答えることをテストする
+        """
+        r = process('横浜の天気', self.config)
+        self.assertTrue(r.startswith('横浜市の'))
+        self.assertTrue('最高気温は8度' in r)
+        # 地名が無ければWR_INDEXの地点
+        r = process('天気', self.config)
+        self.assertTrue(r.startswith('千代田区の'))
+        self.assertEqual(PageHandler.count, 1)
+        self.assertEqual(process('おはよう', self.config), '')
+
+    def test_default_place_only(self):
+        """
+        WR_ALL_PLACESがFalseなら，WR_INDEX番目の地点までしか読まない
+        """
+        self.config.WR_ALL_PLACES = False
+        r = process('横浜の天気', self.config)
+        self.assertTrue(r.startswith('千代田区の'))
+        self.assertEqual(len(INDEX.rows), 1)
+        self.config.WR_INDEX = 1
+        INDEX.updated = None
+        self.assertTrue(process('天気', self.config).startswith('横浜市の'))
+        self.assertEqual(len(INDEX.rows), 2)
+
+    def test_schedule(self):
+        """
+        スケジューラーで先読みした索引からprocess()が答えることをテストする
+        """
+        from scheduler import Scheduler
+        import weatherreport
+        now = [1000000.0]
+        scheduler = Scheduler(clock=lambda: now[0])
+        try:
+            schedule(scheduler, self.config)
+            scheduler.run_pending()
+            self.assertEqual(PageHandler.count, 1)
+            # 索引が古くなっても，process()では取得し直さない
+            INDEX.updated -= self.config.WR_REFRESH
+            self.assertTrue(process('横浜の天気', self.config))
+            self.assertEqual(PageHandler.count, 1)
+            # 時刻が来たら，スケジューラーが取得し直す
+            now[0] += self.config.WR_REFRESH + 60
+            scheduler.run_pending()
+            self.assertEqual(PageHandler.count, 2)
+        finally:
+            weatherreport.scheduled = False
+
 
 class TestWeatherreport(unittest.TestCase):
 
+    @classmethod
+    def setUpClass(cls):
+        global src
+        src = urlopen(url).read().decode('utf-8')
+
     def test_get_table(self):
         """
         get_table()をテストする
@@ -3,11 +3,181 @@
 
 # ウィキペディアを検索する音声コマンド(wikipedia)をテストする
 
+import threading
 import unittest
 from urllib.request import urlopen
+from urllib.parse import unquote
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from wikiindex import TitleResolver
 
 from wikipedia import *
 
+# テスト用のHTML
+page = """<html><head><title>ジョゼフ・フーリエ</title></head><body>
+<div class="mw-parser-output"><p class="mw-empty-elt">
+</p>
+<p><b>ジャン・バティスト・ジョゼフ・フーリエ</b>男爵<span>（Jean Baptiste Joseph Fourier、<a href="/wiki/1768%E5%B9%B4">1768年</a>3月21日 - 1830年5月16日）</span>は、フランスの<a href="/wiki/x">数学者</a>・<a href="/wiki/y">物理学者</a>。<sup class="reference">[1]</sup></p>
+<p>二番目の段落。</p>
+""" + "<p>本文。</p>\n"*5000 + "</div></body></html>"
+
+
+class TestAbstractParser(unittest.TestCase):
+
+    def test_extract_abstruction(self):
+        """
+        extract_abstruction()をテストする
+        """
+        src = page.encode('utf-8')
+        consumed = []
+        def chunks(size=100):
+            for i in range(0, len(src), size):
+                consumed.append(i)
+                yield src[i:i+size]
+
+        abst = extract_abstruction(chunks())
+        self.assertEqual(abst,
+                ("ジャン・バティスト・ジョゼフ・フーリエ男爵"
+                 "は、フランスの数学者・物理学者。"))
+        # 概要を読んだら，それ以降のチャンクは読まない
+        self.assertLess(len(consumed)*100, len(src)//10)
+
+    def test_get_abstruction(self):
+        """
+        get_abstruction()をオフラインでテストする
+        """
+        self.assertEqual(get_abstruction(page),
+                ("ジャン・バティスト・ジョゼフ・フーリエ男爵"
+                 "は、フランスの数学者・物理学者。"))
+        self.assertEqual(get_abstruction('<p>ab[1]c（d（e）f）g</p>'),
+                         'abcg')
+        # 閉じていない括弧はそのまま残す
+        self.assertEqual(get_abstruction('<p>a（b[1]</p>'), 'a（b')
+        self.assertEqual(get_abstruction('<div></div>'), '')
+
+
+class TestLookupIndex(unittest.TestCase):
+
+    def test_process(self):
+        """
+        オフライン索引を使ったprocess()をテストする
+        """
+        import os
+        import tempfile
+        from wikiindex import build_index
+        with tempfile.TemporaryDirectory() as d:
+            dump = os.path.join(d, 'abstract.xml')
+            with open(dump, 'w', encoding='utf-8') as f:
+                f.write('<feed><doc><title>Wikipedia: フーリエ</title>'
+                        '<abstract>フーリエ (Fourier) は、フランス語圏の姓。'
+                        '[1]</abstract></doc></feed>')
+            db = os.path.join(d, 'wiki.db')
+            build_index(dump, db)
+
+            class Config:
+                WIKI_INDEX = db
+            try:
+                self.assertEqual(process("フーリエを検索", Config),
+                        "フーリエ (Fourier) は、フランス語圏の姓。")
+            finally:
+                Config.WIKI_INDEX = None
+                get_index(Config)
+
+    def test_no_titles(self):
+        """
+        WIKI_TITLESが無ければ，索引の項目名をあいまい検索に読み込まない
+        """
+        import os
+        import tempfile
+        import wikipedia
+        from wikiindex import build_index
+        with tempfile.TemporaryDirectory() as d:
+            dump = os.path.join(d, 'abstract.xml')
+            with open(dump, 'w', encoding='utf-8') as f:
+                f.write('<feed><doc><title>Wikipedia: フーリエ</title>'
+                        '<abstract>フーリエは姓。</abstract></doc></feed>')
+            db = os.path.join(d, 'wiki.db')
+            build_index(dump, db)
+
+            class Config:
+                WIKI_INDEX = db
+                WIKI_TITLES = None
+            try:
+                self.assertEqual(resolve_title('ジョセフ・フーリエ', Config),
+                                 'ジョセフ・フーリエ')
+                self.assertIsNone(wikipedia.RESOLVER)
+                titles = os.path.join(d, 'titles.txt')
+                with open(titles, 'w', encoding='utf-8') as f:
+                    f.write('ジョゼフ・フーリエ\n')
+                Config.WIKI_TITLES = titles
+                self.assertEqual(resolve_title('ジョセフ・フーリエ', Config),
+                                 'ジョゼフ・フーリエ')
+            finally:
+                wikipedia.RESOLVER = None
+                Config.WIKI_INDEX = None
+                get_index(Config)
+
+
+class ArticleHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    paths = []
+
+    def do_GET(self):
+        ArticleHandler.paths.append(unquote(self.path))
+        if unquote(self.path) == '/wiki/ジョゼフ・フーリエ':
+            self.send_response(200)
+            body = page.encode('utf-8')
+        else:
+            self.send_response(404)
+            body = b'not found'
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestResolveTitle(unittest.TestCase):
+
+    def setUp(self):
+        import wikipedia
+        ArticleHandler.paths = []
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), ArticleHandler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url_base = wikipedia.url_base
+        wikipedia.url_base = 'http://127.0.0.1:{}/wiki/'.format(
+                self.server.server_port)
+        wikipedia.RESOLVER = TitleResolver(['ジョゼフ・フーリエ'])
+        wikipedia.scheduled = True
+
+    def tearDown(self):
+        import wikipedia
+        wikipedia.url_base = self.url_base
+        wikipedia.RESOLVER = None
+        wikipedia.scheduled = False
+        wikipedia.NEGATIVE.entries.clear()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def test_process(self):
+        """
+        表記ゆれの解決と，存在しない項目の記憶をテストする
+        """
+        self.assertEqual(process("ジョセフ・フーリエを検索", None),
+                ("ジャン・バティスト・ジョゼフ・フーリエ男爵"
+                 "は、フランスの数学者・物理学者。"))
+        self.assertEqual(ArticleHandler.paths, ['/wiki/ジョゼフ・フーリエ'])
+
+        for i in range(2):
+            self.assertEqual(process("ももいろクローバーXを検索", None),
+                    "ももいろクローバーXという項目は検索できませんでした。")
+        # 2回目はアクセスしない
+        self.assertEqual(len(ArticleHandler.paths), 2)
+
+
 class TestWikipedia(unittest.TestCase):
 
     def test_get_wikipedia_srouce(self):
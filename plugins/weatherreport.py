@@ -4,8 +4,14 @@
 # 天気予報を返す音声コマンド
 
 import re
-from urllib.request import urlopen
+import time
+import codecs
+import threading
 from datetime import date
+from collections import namedtuple
+from html.parser import HTMLParser
+
+from plugin import get_http_client
 
 # スクレイピング用の正規表現パターン
 re_flag = re.S | re.M
@@ -13,28 +19,255 @@ re_flag = re.S | re.M
 table_pat = re.compile(r'(<table.+?</table>)', re_flag)
 # tr抽出のパターン
 tr_pat = re.compile(r'(<tr>.+?</tr>)', re_flag)
-# td抽出のパターン
-td_pat = re.compile(r'<td.+?>(.+?)</td>', re_flag)
-# 地点抽出のパターン
-place_pat = re.compile(r'<a.+?>(.+?)</a>', re_flag)
-# 天気抽出のパターン
-weather_pat = re.compile((r'<p class="weather-icon">.+?<span.+?>'
-                           '(.+?)</span></p>'),
-                           re_flag)
-# 最高気温，最低気温
-htemp_pat = re.compile(r'<span class="high-temp">(.+?)</span>',
-                           re_flag)
-ltemp_pat = re.compile(r'<span class="low-temp">(.+?)</span>',
-                           re_flag)
-# 降水確率
-rperc_pat = re.compile(r'<p class="precip">(.+?)<span',
-                           re_flag)
+
+# 天気予報の1地点分のレコード
+# 地区名，天気，最高気温，最低気温，降水確率，地方名を文字列で持つ
+Forecast = namedtuple('Forecast',
+                      ['place', 'weather', 'htemp', 'ltemp', 'rperc', 'city'],
+                      defaults=[''])
+
+# 地方名から地名を取り出すパターン(東京地方(東京) -> 東京)
+city_pat = re.compile(r'[(（](.+?)[)）]')
+
+# 読み込みに使うチャンクのサイズ
+CHUNK_SIZE = 4096
+
+
+class ForecastParser(HTMLParser):
+    """
+    天気予報のHTMLを少しずつ受け取り，
+    テーブルの行をForecastのリスト(rows)に追加していくパーサー
+    skip_headerがTrueなら，最初のtr要素(見出し)を読み飛ばす
+    """
+
+    def __init__(self, skip_header=True):
+        super().__init__()
+        self.rows = []
+        self.skip_header = skip_header
+        self.table_depth = 0
+        self.row = None
+        self.td_index = -1
+        # 文字列を取り込んでいる項目名と，取り込みを終えるタグ名
+        self.field = None
+        self.field_end = None
+        self.in_weather_icon = False
+
+    def handle_starttag(self, tag, attrs):
+        if tag == 'table':
+            self.table_depth += 1
+            return
+        if self.table_depth == 0 and self.row is None:
+            return
+        cls = dict(attrs).get('class') or ''
+        if tag == 'tr':
+            self._end_row()
+            self.row = {'place': '', 'weather': '', 'htemp': '',
+                        'ltemp': '', 'rperc': '', 'city': ''}
+            self.td_index = -1
+        elif self.row is None:
+            return
+        elif tag == 'td':
+            self.td_index += 1
+        elif self.td_index == 0 and tag == 'a':
+            self._start('place', 'a')
+        elif self.td_index == 0 and tag == 'span' and cls == 'city-name':
+            self._start('city', 'span')
+        elif self.td_index == 1:
+            if tag == 'p' and cls == 'weather-icon':
+                self.in_weather_icon = True
+            elif tag == 'span' and self.in_weather_icon:
+                self._start('weather', 'span')
+            elif tag == 'span' and cls == 'high-temp':
+                self._start('htemp', 'span')
+            elif tag == 'span' and cls == 'low-temp':
+                self._start('ltemp', 'span')
+            elif tag == 'p' and cls == 'precip':
+                self._start('rperc', 'p')
+            elif tag == 'span' and self.field == 'rperc':
+                # 降水確率は単位(span)の手前までを取り出す
+                self.field = None
+
+    def handle_endtag(self, tag):
+        if tag == self.field_end:
+            self.field = None
+            self.field_end = None
+        if tag == 'p':
+            self.in_weather_icon = False
+        elif tag == 'tr':
+            self._end_row()
+        elif tag == 'table' and self.table_depth:
+            self._end_row()
+            self.table_depth -= 1
+
+    def handle_data(self, data):
+        if self.field and self.row is not None:
+            self.row[self.field] += data
+
+    def close(self):
+        super().close()
+        self._end_row()
+
+    def _start(self, field, end_tag):
+        self.field = field
+        self.field_end = end_tag
+
+    def _end_row(self):
+        if self.row is None:
+            return
+        row = self.row
+        self.row = None
+        self.field = None
+        self.field_end = None
+        self.in_weather_icon = False
+        if self.skip_header:
+            self.skip_header = False
+            return
+        if self.td_index < 1:
+            # 要素が足りない行は空のレコードにする
+            row = dict.fromkeys(row, '')
+        self.rows.append(Forecast(**row))
+
+
+def parse_forecast(chunks, limit=None):
+    """
+    天気予報のHTMLをバイト列のチャンクとして順に受け取り，
+    すべての地点のForecastのリストを返す
+    ページ全体を文字列にせず，受け取ったチャンクから順に解析する
+    limitを指定すると，limit個の地点を読んだ時点で残りのチャンクは読まない
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    parser = ForecastParser()
+    for chunk in chunks:
+        parser.feed(decoder.decode(chunk))
+        if limit is not None and len(parser.rows) >= limit:
+            return parser.rows[:limit]
+    parser.feed(decoder.decode(b'', final=True))
+    parser.close()
+    return parser.rows
+
+
+class WeatherIndex:
+    """
+    ページ内のすべての地点の天気予報を，地名から引けるようにした索引
+    地区名(千代田区)，地方名(東京地方(東京))，
+    地方名の括弧内(東京)のどれでも引ける
+    """
+
+    def __init__(self):
+        self.rows = []
+        self.places = {}
+        self.updated = None
+        self.lock = threading.Lock()
+
+    def build(self, rows):
+        """
+        Forecastのリストから索引を作り直す
+        """
+        places = {}
+        for fc in rows:
+            names = [fc.place, fc.city] + city_pat.findall(fc.city)
+            for name in names:
+                name = name.strip()
+                if name and name not in places:
+                    places[name] = fc
+        with self.lock:
+            self.rows = list(rows)
+            self.places = places
+            self.updated = time.monotonic()
+
+    def refresh(self, url, config=None, limit=None):
+        """
+        URLから天気予報を読み込んで索引を作り直す
+        ページが前回から変わっていなければ，読み込み直さない
+        limitを指定すると，先頭からlimit個の地点を読んだところで接続を閉じる
+        (最後まで読まないので，次回も304で済ませず読み込み直す)
+        """
+        client = get_http_client(config)
+        with client.open(url) as res:
+            if res.status >= 400:
+                raise Exception('Failed to get forecast: {}'.format(res.status))
+            if res.from_cache and self.rows:
+                # 304が返ってきたので，今の索引をそのまま使う
+                with self.lock:
+                    self.updated = time.monotonic()
+                return
+            rows = parse_forecast(res.iter_content(CHUNK_SIZE), limit)
+        self.build(rows)
+
+    def is_stale(self, max_age):
+        return self.updated is None or \
+               time.monotonic() - self.updated >= max_age
+
+    def lookup(self, message):
+        """
+        メッセージに含まれる地名のうち，一番長いものの天気予報を返す
+        見つからなければNoneを返す
+        """
+        with self.lock:
+            names = [n for n in self.places if n in message]
+            if not names:
+                return None
+            return self.places[max(names, key=len)]
+
+    def get(self, index):
+        """
+        index番目の地点の天気予報を返す
+        """
+        with self.lock:
+            if 0 <= index < len(self.rows):
+                return self.rows[index]
+        return None
+
+
+# 天気予報の索引
+INDEX = WeatherIndex()
+# スケジューラーで索引を先読みしているかどうか
+scheduled = False
+
+
+def forecast_limit(config):
+    """
+    索引に読み込む地点の数を返す
+    WR_ALL_PLACESがFalseなら，WR_INDEX番目の地点までで読み込みをやめる
+    """
+    if getattr(config, 'WR_ALL_PLACES', True):
+        return None
+    return config.WR_INDEX + 1
+
+
+def schedule(scheduler, config):
+    """
+    天気予報の索引をWR_REFRESH秒ごと，
+    およびWR_REFRESH_ATの時刻に作り直すジョブを登録する
+    """
+    global scheduled
+    scheduler.add_job('weatherreport',
+                      lambda: INDEX.refresh(config.WR_URL, config,
+                                            forecast_limit(config)),
+                      interval=getattr(config, 'WR_REFRESH', 1800),
+                      at=getattr(config, 'WR_REFRESH_AT', ()),
+                      jitter=60)
+    scheduled = True
+
+
+def get_index(config):
+    """
+    天気予報の索引を返す
+    スケジューラーで先読みしていれば，作ってある索引をそのまま返す
+    そうでなければ，WR_REFRESH秒以上前に作った索引を作り直してから返す
+    """
+    if INDEX.updated is None or \
+            (not scheduled and
+             INDEX.is_stale(getattr(config, 'WR_REFRESH', 1800))):
+        INDEX.refresh(config.WR_URL, config, forecast_limit(config))
+    return INDEX
 
 
 def process(message, config):
     """
     Webから天気予報を取得，文字列を構築して返す
-    config.WR_URL, config.WR_INDEXを使って天気予報を取得する
+    config.WR_URLのページに載っている地点なら，メッセージの地名で引き，
+    地名が無ければconfig.WR_INDEX番目の地点の天気予報を返す
     """
 
     if '天気' not in message:
@@ -42,22 +275,11 @@ def process(message, config):
 
     #try:
     if 1:
-        # 天気予報のHTMLソースを取得
-        src = urlopen(config.WR_URL).read().decode('utf-8')
-        if len(src) < 100:
-            raise Exception('Source is to short')
-
-        # HTML全体からテーブルを取得
-        table_body = get_table(src)
-        if len(src) < 100:
-            raise Exception('Source is to short')
-
-        # tr要素を取得
-        rows = get_rows(table_body)
-
-        # 天気予報の要素を取得
-        t_tr = rows[config.WR_INDEX]
-        place, weather, htemp, ltemp, rperc = get_element_from_tr(t_tr)
+        # 天気予報の索引から，目的の地点の要素を取得
+        index = get_index(config)
+        fc = index.lookup(message) or index.get(config.WR_INDEX)
+        if fc is None:
+            raise Exception('Forecast is not found')
 
         # 要素を使って文字列を組み立てる
         # 本日の日付を取得
@@ -65,7 +287,8 @@ def process(message, config):
         wr = ("{0}の{1}月{2}日の天気は、{3}、"
               "最高気温は{4}度、最低気温は{5}度、"
               "降水確率は{6}パーセントでしょう").format(
-                    place, td.month, td.day, weather, htemp, ltemp, rperc)
+                    fc.place, td.month, td.day, fc.weather,
+                    fc.htemp, fc.ltemp, fc.rperc)
         return wr
 
     #except:
@@ -98,21 +321,12 @@ def get_element_from_tr(tr_src):
     地区名，天気，最高気温，最低気温，降水確率
     の順に文字列のリストを返す
     """
-    # tdを抽出
-    tds = td_pat.findall(tr_src)
-    if len(tds) < 2:
+    parser = ForecastParser(skip_header=False)
+    parser.feed('<table>'+tr_src)
+    parser.close()
+    if not parser.rows:
         return ['', '', '', '', '']
-    # 地区名を取得
-    place = ''.join(place_pat.findall(tds[0]))
-    # 天気を取得
-    weather = ''.join(weather_pat.findall(tds[1]))
-    # 最高気温，最低気温を取得
-    htemp = ''.join(htemp_pat.findall(tds[1]))
-    ltemp = ''.join(ltemp_pat.findall(tds[1]))
-    # 降水確率を取得
-    rperc = ''.join(rperc_pat.findall(tds[1]))
-
-    return [place, weather, htemp, ltemp, rperc]
+    return list(parser.rows[0][:5])
 
 
 if __name__ == '__main__':
@@ -4,33 +4,184 @@
 # ウィキペディアを検索する音声コマンド
 
 import re
-from urllib.request import urlopen
-from urllib.error import HTTPError
+import codecs
 from urllib.parse import quote
+from html.parser import HTMLParser
+
+from plugin import get_http_client
+from wikiindex import WikiIndex, TitleResolver, NegativeCache
 
 # WikipediaのベースURL
 url_base = 'https://ja.wikipedia.org/wiki/'
 
 # スクレイピング用の正規表現パターン
 re_flag = re.S | re.M
-# pエレメントを取得するパターン
-p_pat = re.compile(r'<p>(.+?)</p>', re_flag)
-# タグを除去するためのパターン
-removetag_pat = re.compile(r'<.+?>', re_flag)
 # 丸括弧，角括弧を除去するためのパターン
+# (索引の概要と，括弧が閉じていない場合に使う)
 removeblackets_pat = re.compile(r'\[.+?\]', re_flag)
 removeblackets_pat2 = re.compile(r'（.+?）', re_flag)
 
+# 読み込みに使うチャンクのサイズ
+CHUNK_SIZE = 4096
+# 除去する括弧の組
+BLACKETS = {'[': ']', '（': '）'}
+
+
+class AbstractParser(HTMLParser):
+    """
+    WikipediaのHTMLを少しずつ受け取り，
+    最初の空でないpエレメントから概要を取り出すパーサー
+    タグと括弧の除去は，文字列を受け取りながら一度に行う
+    概要が取り出せたらabstractに文字列が入る
+    """
+
+    def __init__(self):
+        super().__init__()
+        self.abstract = None
+        self.in_p = False
+        self.skip = 0
+        self.buf = []
+        self.raw = []
+        self.depth = dict.fromkeys(BLACKETS, 0)
+
+    def handle_starttag(self, tag, attrs):
+        if self.abstract is not None:
+            return
+        if tag == 'p':
+            self.in_p = True
+            self.buf = []
+            self.raw = []
+            self.depth = dict.fromkeys(BLACKETS, 0)
+        elif tag in ('style', 'script') and self.in_p:
+            self.skip += 1
+
+    def handle_endtag(self, tag):
+        if tag in ('style', 'script') and self.skip:
+            self.skip -= 1
+        elif tag == 'p' and self.in_p:
+            self.in_p = False
+            if any(self.depth.values()):
+                # 括弧が閉じていないので，正規表現で除去し直す
+                abst = removeblackets_pat.sub('', ''.join(self.raw))
+                abst = removeblackets_pat2.sub('', abst)
+            else:
+                abst = ''.join(self.buf)
+            abst = abst.strip()
+            if abst:
+                self.abstract = abst
+
+    def handle_data(self, data):
+        if not self.in_p or self.skip or self.abstract is not None:
+            return
+        self.raw.append(data)
+        depth = self.depth
+        buf = self.buf
+        for ch in data:
+            if ch in depth:
+                depth[ch] += 1
+            elif ch == ']' and depth['[']:
+                depth['['] -= 1
+            elif ch == '）' and depth['（']:
+                depth['（'] -= 1
+            elif not depth['['] and not depth['（']:
+                buf.append(ch)
+
+
+# オフライン検索用の索引
+INDEX = None
+INDEX_PATH = None
+
+
+def get_index(config):
+    """
+    設定ファイルのWIKI_INDEXに指定した索引を開いて返す
+    指定されていなければNoneを返す
+    """
+    global INDEX, INDEX_PATH
+    path = getattr(config, 'WIKI_INDEX', None)
+    if path != INDEX_PATH:
+        if INDEX is not None:
+            INDEX.close()
+        INDEX = WikiIndex(path) if path else None
+        INDEX_PATH = path
+    return INDEX
+
+
+def lookup_index(word, config):
+    """
+    オフライン検索用の索引から概要を得る
+    索引が無いか，項目や概要が見つからなければNoneを返す
+    """
+    index = get_index(config)
+    if index is None:
+        return None
+    r = index.lookup(word)
+    if r is None or not r[1]:
+        return None
+    # 丸括弧，角括弧を除去する
+    abst = removeblackets_pat.sub('', r[1])
+    return removeblackets_pat2.sub('', abst).strip()
+
+
+# 項目名のあいまい検索用
+RESOLVER = None
+# 存在しないとわかった項目名
+NEGATIVE = NegativeCache()
+# スケジューラーで項目名の一覧を読み込んでいるかどうか
+scheduled = False
+
+
+def load_resolver(config):
+    """
+    あいまい検索用の項目名の一覧を，WIKI_TITLESに指定したファイルから読む
+    索引の全項目名はメモリに載らないので，WIKI_INDEXだけでは読まない
+    """
+    global RESOLVER
+    path = getattr(config, 'WIKI_TITLES', None)
+    RESOLVER = TitleResolver.from_file(path) if path else None
+
+
+def schedule(scheduler, config):
+    """
+    項目名の一覧の読み込みに時間がかかるので，
+    スケジューラーで読み込んでおく(1日ごとに読み込み直す)
+    """
+    global scheduled
+    if getattr(config, 'WIKI_TITLES', None):
+        scheduler.add_job('wikipedia', lambda: load_resolver(config),
+                          interval=24*3600)
+        scheduled = True
+
+
+def resolve_title(word, config):
+    """
+    既知の項目名からwordに一番近いものを返す
+    項目名の一覧が無いか，近いものが無ければwordをそのまま返す
+    """
+    if RESOLVER is None and not scheduled:
+        load_resolver(config)
+    if RESOLVER is None:
+        return word
+    return RESOLVER.resolve(word) or word
+
 
 def process(message, config):
     # 「〜を検索」という命令を受けて，Wikipediaを
     if message.endswith('を検索'):
         # Wikipedia検索を実行
         word = message.replace('を検索', '')
-        src = get_wikipedia_srouce(word)
-        if not src:
+        NEGATIVE.ttl = getattr(config, 'WIKI_NEGATIVE_TTL', NEGATIVE.ttl)
+        if word in NEGATIVE:
+            # 存在しないとわかっている項目なので，アクセスしない
+            return word+"という項目は検索できませんでした。"
+        title = resolve_title(word, config)
+        r = lookup_index(title, config)
+        if r is None:
+            # 索引に無いので，Wikipediaにアクセスする
+            r = fetch_abstruction(title, config)
+        if r is None:
+            NEGATIVE.add(word)
             return word+"という項目は検索できませんでした。"
-        r = get_abstruction(src)
         if r:
             # 結果が帰ってきたので，取得した概要を返す
             return r
@@ -38,43 +189,61 @@ def process(message, config):
 
 
 
-def get_wikipedia_srouce(word):
+def get_wikipedia_srouce(word, config=None):
     """
     語を与えてWikipediaにアクセス，HTMLのソースを取得して
     文字列として返す
     """
     # URLを生成
     url = url_base+quote(word)
-    try:
-        # HTMLを取得
-        robj = urlopen(url)
-        # HTMLを返す
-        return robj.read().decode('utf-8')
-    except HTTPError as e:
-        if e.code >= 400:
+    # HTMLを取得
+    client = get_http_client(config)
+    with client.open(url) as res:
+        if res.status >= 400:
             return ''
-        return ''
+        # HTMLを返す
+        return res.read().decode('utf-8')
 
 
-    return src
+def fetch_abstruction(word, config=None):
+    """
+    語を与えてWikipediaにアクセスし，HTMLを読み込みながら概要を得る
+    概要を読み終えた時点で接続を閉じ，残りのHTMLは受信しない
+    項目が無ければNone，概要が無ければ空文字列を返す
+    """
+    url = url_base+quote(word)
+    client = get_http_client(config)
+    with client.open(url) as res:
+        if res.status >= 400:
+            return None
+        return extract_abstruction(res.iter_content(CHUNK_SIZE))
+
+
+def extract_abstruction(chunks):
+    """
+    HTMLをバイト列のチャンクとして順に受け取り，概要を返す
+    概要を取り出せたら，残りのチャンクは読まない
+    """
+    decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    parser = AbstractParser()
+    for chunk in chunks:
+        parser.feed(decoder.decode(chunk))
+        if parser.abstract is not None:
+            return parser.abstract
+    parser.feed(decoder.decode(b'', final=True))
+    parser.close()
+    return parser.abstract or ''
 
 
 def get_abstruction(src):
     """
     Wikipediaの検索結果(HTML)から概要を得る
-    最初のpエレメントからHTMLのタグを除去して返す
-    """
-    # 最初のpエレメントを取得する
-    p_elems = p_pat.findall(src)
-    if p_elems:
-        p_elem = p_elems[0]
-        # タグを除去する
-        abst = removetag_pat.sub('', p_elem)
-        # 丸括弧，角括弧を除去する
-        abst = removeblackets_pat.sub('', abst)
-        abst = removeblackets_pat2.sub('', abst)
-        return abst
-    return ''
+    最初のpエレメントからHTMLのタグと括弧を除去して返す
+    """
+    parser = AbstractParser()
+    parser.feed(src)
+    parser.close()
+    return parser.abstract or ''
 
 
 if __name__ == '__main__':
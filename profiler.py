@@ -0,0 +1,184 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# profiler.py
+# メインループのプロファイルを取るためのクラス
+# cProfileによるプロファイル，tracemallocによるメモリ割り当ての差分，
+# 録音処理のチャンクごとの処理時間をディレクトリに書き出す
+
+import os
+import io
+import time
+import pstats
+import signal
+import logging
+import cProfile
+import threading
+import tracemalloc
+
+
+class ChunkTimer:
+    """
+    録音処理のチャンクごとの処理時間(読み込み，FFT，平均，deque)を記録する
+    記録する数はmaxlenまで
+    """
+
+    FIELDS = ('read', 'fft', 'avg', 'deque')
+
+    def __init__(self, maxlen=100000):
+        self.maxlen = maxlen
+        self.rows = []
+
+    def add(self, read, fft, avg, deque):
+        if len(self.rows) < self.maxlen:
+            self.rows.append((read, fft, avg, deque))
+
+    def write(self, path):
+        """
+        記録した処理時間をCSVファイルに書き出す
+        """
+        with open(path, 'w') as f:
+            f.write(','.join(self.FIELDS) + '\n')
+            for row in self.rows:
+                f.write(','.join('{:.9f}'.format(x) for x in row) + '\n')
+
+    def summary(self):
+        """
+        処理ごとの合計と1チャンクあたりの平均時間を文字列で返す
+        """
+        n = len(self.rows)
+        lines = ['chunks: {}'.format(n)]
+        for i, name in enumerate(self.FIELDS):
+            total = sum(row[i] for row in self.rows)
+            mean = total / n if n else 0.0
+            lines.append('{:6s} total {:.6f}s  mean {:.3f}ms'.format(
+                         name, total, mean*1000))
+        return '\n'.join(lines) + '\n'
+
+
+class Profiler:
+    """
+    メインループのプロファイルを取るクラス
+    start()からinteractions回の対話，またはseconds秒が過ぎるまで記録し，
+    outdir以下のprofile-<日時>ディレクトリに結果を書き出す
+    seconds秒が過ぎたら，対話が無くても(待機中でも)タイマーで止める
+    """
+
+    def __init__(self, outdir='.', interactions=None, seconds=None):
+        self.outdir = outdir
+        self.interactions = interactions
+        self.seconds = seconds
+        self.count = 0
+        self.path = None
+        self.profile = None
+        self.snapshot = None
+        self.start_time = None
+        self.chunk_timer = None
+        self.timer = None
+        self.prev_handler = None
+
+    @property
+    def running(self):
+        return self.profile is not None
+
+    def start(self):
+        name = time.strftime('profile-%Y%m%d-%H%M%S')
+        self.path = os.path.join(self.outdir, name)
+        os.makedirs(self.path, exist_ok=True)
+        self.count = 0
+        self.start_time = time.monotonic()
+        tracemalloc.start(25)
+        self.snapshot = tracemalloc.take_snapshot()
+        import record
+        import capture
+        self.chunk_timer = ChunkTimer()
+        # 録音用の子プロセス(CAPTURE_PROCESS)の分は，capture.pyが受け取る
+        record.chunk_timer = capture.chunk_timer = self.chunk_timer
+        self.profile = cProfile.Profile()
+        self.profile.enable()
+        if self.seconds:
+            self.start_timer()
+        logging.debug("プロファイルを開始します({})".format(self.path))
+
+    def start_timer(self):
+        """
+        seconds秒後にプロファイルを終えるタイマーを始める
+        cProfileは有効にしたスレッドでしか止められないので，メインスレッドなら
+        SIGALRMのハンドラ(メインスレッドで実行される)で止める
+        """
+        if hasattr(signal, 'setitimer') and \
+                threading.current_thread() is threading.main_thread():
+            self.prev_handler = signal.signal(signal.SIGALRM,
+                                              lambda signum, frame: self.stop())
+            signal.setitimer(signal.ITIMER_REAL, self.seconds)
+        else:
+            self.timer = threading.Timer(self.seconds, self.stop)
+            self.timer.daemon = True
+            self.timer.start()
+
+    def cancel_timer(self):
+        if self.prev_handler is not None:
+            signal.setitimer(signal.ITIMER_REAL, 0)
+            signal.signal(signal.SIGALRM, self.prev_handler)
+            self.prev_handler = None
+        if self.timer is not None:
+            if self.timer is not threading.current_thread():
+                self.timer.cancel()
+            self.timer = None
+
+    def tick(self):
+        """
+        対話が1回終わるたびに呼ぶ
+        指定した回数や時間に達したらプロファイルを終える
+        """
+        if not self.running:
+            return
+        self.count += 1
+        if self.interactions and self.count >= self.interactions:
+            self.stop()
+        elif self.seconds and \
+                time.monotonic() - self.start_time >= self.seconds:
+            self.stop()
+
+    def stop(self):
+        """
+        プロファイルを終えて，結果をファイルに書き出す
+        """
+        if not self.running:
+            return
+        import record
+        import capture
+        # タイマーと対話の終わりから，2回止めないよう先に外す
+        profile, self.profile = self.profile, None
+        profile.disable()
+        self.cancel_timer()
+        record.chunk_timer = capture.chunk_timer = None
+        try:
+            snapshot = tracemalloc.take_snapshot()
+        finally:
+            tracemalloc.stop()
+
+        # cProfileの結果
+        profile.dump_stats(os.path.join(self.path, 'main.prof'))
+        out = io.StringIO()
+        stats = pstats.Stats(profile, stream=out)
+        stats.sort_stats('cumulative').print_stats(50)
+        stats.sort_stats('tottime').print_stats(50)
+        with open(os.path.join(self.path, 'main.txt'), 'w') as f:
+            f.write(out.getvalue())
+
+        # メモリ割り当ての差分
+        diff = snapshot.compare_to(self.snapshot, 'lineno')
+        with open(os.path.join(self.path, 'tracemalloc.txt'), 'w') as f:
+            for stat in diff[:50]:
+                f.write(str(stat) + '\n')
+
+        # チャンクごとの処理時間
+        self.chunk_timer.write(os.path.join(self.path, 'chunks.csv'))
+        with open(os.path.join(self.path, 'chunks.txt'), 'w') as f:
+            f.write(self.chunk_timer.summary())
+
+        msg = "プロファイルを終了しました({}回の対話，{:.1f}秒)"
+        logging.debug(msg.format(self.count,
+                                 time.monotonic() - self.start_time))
+        self.snapshot = None
@@ -8,34 +8,108 @@ import math
 from io import BytesIO, UnsupportedOperation
 import wave
 import audioop
-from collections import deque
 import logging
+import functools
 
 import numpy as np
-import pyaudio
+try:
+    import pyaudio
+except ImportError:
+    # 録音しないツール(segment.pyなど)では，PyAudioが無くても使えるようにする
+    pyaudio = None
 
-lowpass = 100 # ローパスフィルタ用周波数
-highpass = 5000 # ハイパスフィルタ用周波数
+import metrics
+from vad import VoiceDetector, IdleMeter, check_idle_gate, is_quiet, \
+        report_idle, startup_seconds
 
+# 帯域を制限するフィルタの周波数(Hz)
+# lowpassより低い周波数とhighpassより高い周波数を取り除く(Noneなら取り除かない)
+# (以前はFFTのビン番号で100と5000を指定していたので，
+#  16kHz，1024サンプルのときと同じ帯域になる値にしている)
+lowpass = 1562.5 # ローパスフィルタ用周波数
+highpass = None # ハイパスフィルタ用周波数
 
-def get_chunk(rate):
+# チャンクの長さの目安(ミリ秒)
+# 短くすると発話の検出が細かくなるが，CPUの使用量が増える
+CHUNK_LATENCY = 64
+
+# チャンクごとの処理時間を受け取るオブジェクト(プロファイル用)
+# add(read, fft, avg, deque)メソッドに各処理の秒数が渡される
+chunk_timer = None
+
+
+def get_chunk(rate, latency=None):
+    """
+    サンプリングレートと，チャンクの長さの目安(latency，ミリ秒)から
+    チャンク値(1回に読み込むフレーム数)を得る
+    FFTが速くなるよう，目安を超えない一番大きな2のべき乗にする
+    (16kHz，64ミリ秒なら1024，48kHzなら2048)
+    ただし64フレームより小さくはしない
+    """
+    latency = latency or CHUNK_LATENCY
+    frames = rate * latency / 1000.0
+    return 2 ** max(6, int(math.floor(math.log2(max(1.0, frames)) + 1e-9)))
+
+
+@functools.lru_cache(maxsize=8)
+def band_mask(n, rate):
+    """
+    n個のサンプルのFFTで，残す周波数のビンをTrueにした配列を返す
+    """
+    freqs = np.fft.rfftfreq(n, 1.0 / rate)
+    mask = freqs >= (lowpass or 0)
+    if highpass is not None:
+        mask &= freqs <= highpass
+    return mask
+
+
+def filter_chunk(data, rate=16000):
+    """
+    チャンクの生データ(16ビット)から余分な周波数を取り除いて返す
+    """
+    da = np.frombuffer(data, dtype=np.int16)
+    lf = np.fft.rfft(da)
+    lf[~band_mask(len(da), rate)] = 0
+    nl = np.fft.irfft(lf, len(da))
+    return nl.ravel().astype(np.int16).tobytes()
+
+
+def get_mixer(channels, rate, mix='best', max_delay=None):
+    """
+    チャンネルが2つ以上なら，1チャンネルにまとめるmicarray.ChannelMixerを返す
+    1つならNoneを返す
     """
-    サンプリングレートからチャンク値を得る
+    if channels <= 1:
+        return None
+    import micarray
+    return micarray.get_mixer(channels, rate, mix, max_delay)
+
+
+def input_latency(stream):
+    """
+    PortAudioが報告する入力の遅延(秒)をログに出し，メトリクスに記録する
     """
-    rate_chunk = {16000: 1024,
-                  44100: 256}
-    if rate in rate_chunk:
-        return rate_chunk[rate]
-    else:
-        256
+    latency = stream.get_input_latency()
+    logging.info("入力の遅延は{:.1f}ミリ秒です".format(latency * 1000))
+    metrics.observe('input_latency', latency)
+    return latency
 
-def audio_int(format, channels, rate, num_samples=50):
+
+def chunk_level(data):
+    """
+    チャンクの生データからボリュームを計算して返す
+    """
+    return math.sqrt(abs(audioop.avg(data, 4)))
+
+
+def audio_int(format, channels, rate, num_samples=50, latency=None,
+              mix='best'):
     """
     音をサンプリングして，環境音などを含めた
     ボリュームの平均を計算して返す
     """
 
-    chunk = get_chunk(rate)
+    chunk = get_chunk(rate, latency)
 
     audio = pyaudio.PyAudio()
 
@@ -45,20 +119,14 @@ def audio_int(format, channels, rate, num_samples=50):
                     input=True,
                     frames_per_buffer=chunk)
 
-    # 余分な周波数を取り除く
     cur_data = stream.read(chunk)
-    da = np.fromstring(cur_data, dtype=np.int16)
-    lf = np.fft.rfft(da)
-    lf[:lowpass] = 0 # low pass filter
-    lf[55:66] = 0 # line noise
-    lf[highpass:] = 0 # high pass filter
-    nl = np.fft.irfft(lf)
-    ns = nl.ravel().astype(np.int16)
-    cur_data = ns.tostring()
-
+    mixer = get_mixer(channels, rate, mix)
+    if mixer is not None:
+        cur_data = mixer.process(cur_data)
+    # 余分な周波数を取り除く
+    cur_data = filter_chunk(cur_data, rate)
 
-    values = [math.sqrt(abs(audioop.avg(cur_data, 4))) 
-              for x in range(num_samples)] 
+    values = [chunk_level(cur_data) for x in range(num_samples)]
     values = sorted(values, reverse=True)
     r = sum(values[:int(num_samples * 0.2)]) / int(num_samples * 0.2)
     stream.close()
@@ -70,22 +138,39 @@ def audio_int(format, channels, rate, num_samples=50):
 def get_sound_chunk(format, channels, rate,
                     fileobject,
                     threshold=200,
-                    startup_time=2,
+                    startup_time=0.15,
                     silence_limit=1,
                     prev_length=0.5,
-                    max_second=9.5):
+                    max_second=9.5,
+                    on_listen=None,
+                    audio_factory=None,
+                    latency=None,
+                    mix='best',
+                    max_delay=None,
+                    idle_gate=0):
     """
     マイクからの音声を記録し，生データとサンプルサイズを返す
     format, channels, rateに
     PyAudioのストリーム用のパラメーターを引数として渡す
     音量が閾値(threshold)を超えたら録音を開始する
-    startup_time回以上，チャンクが音量が閾値を超えたら録音開始を始める
+    閾値を超えた音の長さがstartup_time秒を超えたら録音開始を始める
     silence_limitの秒数間隔が空いたら録音を停止する
     prev_lengthの秒数分，録音開始前の音声を追加する
     録音の秒数がmax_secondに達するまで録音を続ける
+    on_listenに関数を渡すと，音声のモニターを開始したときに呼び出す
+    audio_factoryにPyAudio互換のオブジェクトを返す関数を渡すと，
+    マイクの代わりにそのオブジェクトから音声を読み込む
+    latencyにチャンクの長さの目安(ミリ秒)を渡す
+    channelsが2以上(マイクアレイ)なら，発話の検出の前に1チャンネルにまとめる
+    mixが'best'ならSN比が一番よいチャンネルを選び，'beam'なら
+    チャンネル間の遅れ(最大max_delayミリ秒)を揃えて足し合わせる
+    idle_gateを指定すると，発話を待っている間は生データのRMSとピークを調べ，
+    idle_gateより十分小さいチャンクはフィルタをかけずに無音とみなす
+    (近似なので，閾値がvad.LEVEL_FLOOR以下なら使わない)
     """
 
-    chunk = get_chunk(rate)
+    chunk = get_chunk(rate, latency)
+    idle_gate = check_idle_gate(idle_gate, threshold)
 
     stderr_fileno = None
     try:
@@ -100,7 +185,7 @@ def get_sound_chunk(format, channels, rate,
         pass
 
     #PyAudioのストリームを開く
-    audio = pyaudio.PyAudio()
+    audio = (audio_factory or pyaudio.PyAudio)()
 
     if stderr_fileno:
         # 標準エラー出力を戻す
@@ -115,57 +200,64 @@ def get_sound_chunk(format, channels, rate,
                         frames_per_buffer=chunk)
 
     # 音声を取得開始
-    msg = "閾値({})で音声のモニターを開始します"
-    logging.debug(msg.format(threshold))
-
-    audio2send = []
-    cur_data = ''
-    rel = rate/chunk
-    slid_win = deque(maxlen=int(silence_limit*rel))
-    prev_audio = deque(maxlen=int(prev_length*rel)) 
-    started = False
-    start_time = 0
+    msg = "閾値({})，チャンク{}フレーム({:.1f}ミリ秒)で音声のモニターを開始します"
+    logging.debug(msg.format(threshold, chunk, chunk * 1000.0 / rate))
+    input_latency(stream)
+    if on_listen:
+        on_listen()
+
+    detector = VoiceDetector(rate, chunk, threshold, startup_time,
+                             silence_limit, prev_length, max_second)
+    if hasattr(audio, 'on_entry'):
+        # リプレイでは，音声ファイルが変わるたびに検出の状態を初期化する
+        audio.on_entry = detector.reset
+    mixer = get_mixer(channels, rate, mix, max_delay)
+    # 音声の読み込みと，音声区間の検出にかかった時間
+    wait_time = 0.0
+    vad_time = 0.0
+    meter = IdleMeter()
 
     while True:
+        idle = not detector.active
         # 音声データを読み込む
+        t0 = time.perf_counter()
         cur_data = stream.read(chunk)
-
-        # 余分な周波数を取り除く
-        da = np.fromstring(cur_data, dtype=np.int16)
-        lf = np.fft.rfft(da)
-        lf[:lowpass] = 0 # low pass filter
-        lf[55:66] = 0 # line noise
-        lf[highpass:] = 0 # high pass filter
-        nl = np.fft.irfft(lf)
-        ns = nl.ravel().astype(np.int16)
-        dimd_data = ns.tostring()
-
-        slid_win.append(math.sqrt(abs(audioop.avg(dimd_data, 4))))
-        v = math.sqrt(abs(audioop.avg(dimd_data, 4)))
-        slid_l = list(slid_win)
-        pow = sum([x > threshold for x in slid_win])
-        if pow > startup_time:
-            # 音の大きさが閾値を超えた状態の処理
-            if not started:
-                # 開始フラグが立っていないので立てる
-                started = True
-                start_time = time.time()
-                logging.debug("音声の記録を開始します")
-            audio2send.append(cur_data)
-            if time.time() - start_time >= min(9.5, max_second):
-                # 録音時間がmax_secondか9.5秒を超えたので停止する
-                break
-        elif started:
-            break
+        t1 = time.perf_counter()
+        wait_time += t1 - t0
+        if mixer is not None:
+            # マイクアレイの音声を1チャンネルにまとめる
+            cur_data = mixer.process(cur_data)
+
+        skipped = idle and idle_gate and is_quiet(cur_data, idle_gate)
+        if skipped:
+            # 閾値より十分小さいとみなし，フィルタをかけずに無音にする
+            level = 0.0
+            t2 = t3 = time.perf_counter()
         else:
-            prev_audio.append(cur_data)
+            # 余分な周波数を取り除く
+            dimd_data = filter_chunk(cur_data, rate)
+            t2 = time.perf_counter()
+
+            level = chunk_level(dimd_data)
+            t3 = time.perf_counter()
+        done = detector.push(cur_data, level)
+        t4 = time.perf_counter()
+        vad_time += t4 - t1
+        meter.add(idle, skipped)
+        if chunk_timer is not None:
+            chunk_timer.add(t1 - t0, t2 - t1, t3 - t2, t4 - t3)
+        if done:
+            break
     msg = "音声の記録を停止します。記録時間は{:.4f}秒でした"
-    logging.debug(msg.format(time.time() - start_time))
+    logging.debug(msg.format(detector.seconds))
+    metrics.observe('capture_wait', wait_time)
+    metrics.observe('vad', vad_time)
+    report_idle(*meter.stats())
 
     width = 0
-    if started:
-        save_sound(fileobject, list(prev_audio)+audio2send, audio, rate)
-        width = audio.get_sample_size(pyaudio.paInt16)
+    if detector.started:
+        save_sound(fileobject, detector.frames, audio, rate, format)
+        width = audio.get_sample_size(format)
 
 
     stream.close()
@@ -173,7 +265,7 @@ def get_sound_chunk(format, channels, rate,
 
     return fileobject, width
 
-def save_sound(fileobject, data, p, rate):
+def save_sound(fileobject, data, p, rate, format=None):
     """
     音声をファイルオブジェクトに保存する
     """
@@ -182,7 +274,7 @@ def save_sound(fileobject, data, p, rate):
     data = b''.join(data)
     wf = wave.open(fileobject, 'wb')
     wf.setnchannels(1)
-    wf.setsampwidth(p.get_sample_size(pyaudio.paInt16))
+    wf.setsampwidth(p.get_sample_size(format or pyaudio.paInt16))
     wf.setframerate(rate)  # TODO make this value a function parameter?
     wf.writeframes(data)
     wf.close()
@@ -199,7 +291,7 @@ def test_record(key, rate=16000):
     sf = BytesIO()
     sf, w = get_sound_chunk(pyaudio.paInt16, 1, rate, sf,
                          threshold*1.2,
-                         config.STARTUP_TIME,
+                         startup_seconds(config),
                          config.SILENCE_LIMIT,
                          config.PREV_LENGTH,
                          config.MAX_SECOND)
@@ -233,7 +325,7 @@ def save_test(fn, rate=16000):
     sf = BytesIO()
     sf, w = get_sound_chunk(pyaudio.paInt16, 1, rate, sf,
                          threshold*1.2,
-                         config.STARTUP_TIME,
+                         startup_seconds(config),
                          config.SILENCE_LIMIT,
                          config.PREV_LENGTH,
                          config.MAX_SECOND)
@@ -0,0 +1,256 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# replay.py
+# 録音したWAVファイルを使い，マイクやクラウドのAPI無しで
+# スマートスピーカーのパイプライン全体を動かす
+# (daemon.py --replay <ディレクトリ|マニフェスト> で使う)
+
+import os
+import json
+import time
+import logging
+from collections import namedtuple
+
+import metrics
+from audio import AudioData, AudioFile
+
+
+# リプレイする音声ファイルと，その書き起こし
+# alternativesは，書き起こしの次に返す音声認識の候補(N-best)
+ReplayEntry = namedtuple('ReplayEntry', ['path', 'transcript', 'alternatives'],
+                         defaults=((),))
+
+AUDIO_EXTS = ('.wav', '.flac', '.aiff', '.aif')
+
+# 現在リプレイしている音声のソース
+SOURCE = None
+
+
+def load_manifest(path):
+    """
+    リプレイする音声の一覧をReplayEntryのリストとして返す
+    pathがディレクトリなら，中の音声ファイルを名前順に並べ，
+    同じ名前の.txtファイルを書き起こしとして使う
+    ファイルなら，1行に1つ{"audio": パス, "transcript": 書き起こし}を書いた
+    JSON Linesのマニフェストとして読む
+    ("alternatives"に文字列のリストを書くと，書き起こしの次の候補になる)
+    """
+    entries = []
+    if os.path.isdir(path):
+        for fn in sorted(os.listdir(path)):
+            base, ext = os.path.splitext(fn)
+            if ext.lower() not in AUDIO_EXTS:
+                continue
+            transcript = ''
+            txt = os.path.join(path, base + '.txt')
+            if os.path.exists(txt):
+                with open(txt, encoding='utf-8') as f:
+                    transcript = f.read().strip()
+            entries.append(ReplayEntry(os.path.join(path, fn), transcript))
+        return entries
+
+    base = os.path.dirname(path)
+    with open(path, encoding='utf-8') as f:
+        for line in f:
+            line = line.strip()
+            if not line:
+                continue
+            d = json.loads(line)
+            entries.append(ReplayEntry(os.path.join(base, d['audio']),
+                                       d.get('transcript', ''),
+                                       tuple(d.get('alternatives', ()))))
+    return entries
+
+
+def read_audio(path, rate):
+    """
+    音声ファイルを読み込み，rateのサンプリングレートの16ビットモノラルの
+    生データに変換して返す
+    """
+    with AudioFile(path) as af:
+        ad = AudioData(af.stream.read(), af.SAMPLE_RATE, af.SAMPLE_WIDTH)
+    return ad.get_raw_data(convert_rate=rate, convert_width=2)
+
+
+class ReplaySource:
+    """
+    音声ファイルをマイクの代わりに読み込ませるPyAudio互換のクラス
+    record.get_sound_chunk()のaudio_factoryに渡して使う
+    ストリームを開くたびに次の音声ファイルを読み込み，
+    ファイルの後ろにpad秒の無音を付けて，録音が止まるようにする
+    音声が検出されないままファイルを読み終えたら，次のファイルに進む
+    すべてのファイルを読み終えたら，EOFErrorを投げる
+    on_entryに関数を渡すと，次のファイルに進むたびに呼び出す
+    (get_sound_chunk()が発話の検出の状態を初期化し，前のファイルの状態が
+    次のファイルの結果に影響しないようにする)
+    """
+
+    def __init__(self, entries, rate, pad=3.0):
+        self.entries = list(entries)
+        self.rate = rate
+        self.pad = pad
+        self.index = -1
+        self.current = None
+        self.buffer = b''
+        self.pos = 0
+        self.missed = []
+        self.audio_seconds = 0.0
+        self.on_entry = None
+
+    def __call__(self):
+        return self
+
+    def next_entry(self):
+        """
+        次の音声ファイルを読み込む
+        """
+        self.index += 1
+        if self.index >= len(self.entries):
+            self.current = None
+            raise EOFError("no more replay entries")
+        self.current = self.entries[self.index]
+        data = read_audio(self.current.path, self.rate)
+        self.audio_seconds += len(data) / (2.0 * self.rate)
+        self.buffer = data + b'\x00' * (2 * int(self.rate * self.pad))
+        self.pos = 0
+        if self.on_entry:
+            self.on_entry()
+        logging.debug("リプレイします({})".format(self.current.path))
+
+    def open(self, format=None, channels=1, rate=None, input=True,
+             frames_per_buffer=1024, **kwargs):
+        assert rate is None or rate == self.rate, "Sample rate mismatch"
+        self.next_entry()
+        return ReplayStream(self)
+
+    def read(self, frames):
+        size = frames * 2
+        if self.pos >= len(self.buffer):
+            # 音声が検出されないまま読み終えた
+            logging.warning("音声を検出できませんでした({})".format(
+                            self.current.path))
+            self.missed.append(self.current)
+            self.next_entry()
+        data = self.buffer[self.pos:self.pos+size]
+        self.pos += size
+        if len(data) < size:
+            data += b'\x00' * (size - len(data))
+        return data
+
+    def get_sample_size(self, format):
+        return 2
+
+    def terminate(self):
+        pass
+
+
+class ReplayStream:
+    """
+    ReplaySourceから音声を読み込むストリーム
+    """
+
+    def __init__(self, source):
+        self.source = source
+
+    def read(self, frames, exception_on_overflow=True):
+        return self.source.read(frames)
+
+    def get_input_latency(self):
+        return 0.0
+
+    def close(self):
+        pass
+
+
+class StubRecognizer:
+    """
+    リプレイしている音声ファイルの書き起こしを，認識結果として返す音声認識
+    クラウドのAPIの代わりに使う
+    """
+
+    def recognize(self, audio_data, config=None, key='',
+                  language="ja-JP", show_all=False, max_alternatives=0):
+        # 前後の無音を取り除き，送るデータを小さくする
+        if getattr(config, 'TRIM_SILENCE', True):
+            with metrics.span('trim'):
+                audio_data = audio_data.trim(
+                        margin=getattr(config, 'TRIM_MARGIN', 0.2))
+
+        # 実際の音声認識と同じように，WAVへの変換は行う
+        with metrics.span('wav_encode'):
+            audio_data.get_wav_data(convert_rate=16000, convert_width=2)
+        entry = SOURCE.current if SOURCE else None
+        text = entry.transcript if entry else ''
+        if show_all:
+            return {'RecognitionStatus': 'Success', 'DisplayText': text}
+        if max_alternatives:
+            texts = [text] + list(entry.alternatives if entry else ())
+            return [(t, None) for t in texts if t][:max_alternatives]
+        return text
+
+
+class NullSink:
+    """
+    スピーカーの代わりに，読み上げる文字列と再生する音声を記録するクラス
+    """
+
+    def __init__(self):
+        self.speeches = []
+        self.sounds = []
+
+    def speech(self, txt):
+        self.speeches.append(txt)
+
+    def play(self, path):
+        self.sounds.append(path)
+
+
+def setup(daemon, path):
+    """
+    daemonモジュールを，リプレイ用の音声ソース，音声認識，出力先で動くようにする
+    """
+    global SOURCE
+    config = daemon.config
+    entries = load_manifest(path)
+    SOURCE = ReplaySource(entries, config.SAMPLE_RATE,
+                          pad=config.SILENCE_LIMIT + 1.0)
+    daemon.audio_factory = SOURCE
+    daemon.sink = NullSink()
+    # 音声ファイルは1チャンネルにして読み込むので，マイクアレイの設定は使わない
+    config.MIC_CHANNELS = 1
+    config.RECOGNIZER = StubRecognizer
+    return SOURCE
+
+
+def run(daemon):
+    """
+    すべての音声ファイルをリプレイし，スループットと処理段階ごとの時間を表示する
+    """
+    metrics.REGISTRY.clear()
+    start = time.perf_counter()
+    try:
+        daemon.run()
+    except EOFError:
+        pass
+    elapsed = time.perf_counter() - start
+    print(report(SOURCE, daemon.sink, elapsed))
+
+
+def report(source, sink, elapsed):
+    """
+    リプレイの結果を文字列で返す
+    """
+    n = min(source.index + 1, len(source.entries))
+    lines = [
+        "リプレイした音声: {} (検出できなかった音声: {})".format(
+            n, len(source.missed)),
+        "音声の長さ: {:.2f}秒  処理時間: {:.2f}秒  実時間比: {:.1f}倍".format(
+            source.audio_seconds, elapsed,
+            source.audio_seconds / elapsed if elapsed else 0.0),
+        "スループット: {:.2f}発話/秒".format(n / elapsed if elapsed else 0.0),
+        "応答: {}".format(len(sink.speeches)),
+        "",
+        metrics.report(),
+    ]
+    return '\n'.join(lines)
@@ -0,0 +1,147 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# scheduler.py
+# プラグインがデータを先読みするためのジョブを定期的に実行するスケジューラー
+
+import time
+import random
+import logging
+import threading
+import traceback
+from datetime import datetime, timedelta
+
+
+class Job:
+    """
+    スケジューラーに登録するジョブ
+    interval秒ごと，およびatで指定した時刻('05:00'など)にfuncを実行する
+    失敗したらbackoff秒から倍々に間隔を空けて(最大max_backoff秒)再実行する
+    """
+
+    def __init__(self, name, func, interval=None, at=(), jitter=0,
+                 backoff=60, max_backoff=3600):
+        assert interval or at, "interval or at must be given"
+        self.name = name
+        self.func = func
+        self.interval = interval
+        self.at = [tuple(int(x) for x in t.split(':')) for t in at]
+        self.jitter = jitter
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.failures = 0
+        self.next_run = None
+
+    def next_time(self, now):
+        """
+        now(エポック秒)の次にジョブを実行する時刻を返す
+        """
+        candidates = []
+        if self.interval:
+            candidates.append(now + self.interval)
+        dt = datetime.fromtimestamp(now)
+        for h, m in self.at:
+            t = dt.replace(hour=h, minute=m, second=0, microsecond=0)
+            if t <= dt:
+                t += timedelta(days=1)
+            candidates.append(t.timestamp())
+        return min(candidates)
+
+
+class Scheduler:
+    """
+    ジョブを1つのワーカースレッドで順に実行するスケジューラー
+    clockに現在時刻(エポック秒)を返す関数，
+    randに0以上1未満の乱数を返す関数を渡すと，テストで時刻を操作できる
+    """
+
+    def __init__(self, clock=time.time, rand=random.random):
+        self.clock = clock
+        self.rand = rand
+        self.jobs = {}
+        self.lock = threading.Lock()
+        self.wakeup = threading.Event()
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def add_job(self, name, func, interval=None, at=(), jitter=0,
+                backoff=60, max_backoff=3600, run_now=True):
+        """
+        ジョブを登録する，同じ名前のジョブがあれば置き換える
+        run_nowがTrueなら，登録後すぐに1回実行する
+        """
+        job = Job(name, func, interval, at, jitter, backoff, max_backoff)
+        now = self.clock()
+        job.next_run = now if run_now else self._with_jitter(job,
+                                                             job.next_time(now))
+        with self.lock:
+            self.jobs[name] = job
+        self.wakeup.set()
+        return job
+
+    def remove_job(self, name):
+        with self.lock:
+            self.jobs.pop(name, None)
+
+    def _with_jitter(self, job, t):
+        return t + job.jitter * self.rand()
+
+    def next_due(self):
+        """
+        次にジョブを実行する時刻を返す，ジョブが無ければNoneを返す
+        """
+        with self.lock:
+            if not self.jobs:
+                return None
+            return min(job.next_run for job in self.jobs.values())
+
+    def run_pending(self):
+        """
+        実行時刻になったジョブをすべて実行する
+        実行したジョブの数を返す
+        """
+        now = self.clock()
+        with self.lock:
+            due = [job for job in self.jobs.values() if job.next_run <= now]
+        for job in due:
+            try:
+                job.func()
+            except:
+                job.failures += 1
+                delay = min(job.backoff * 2 ** (job.failures-1),
+                            job.max_backoff)
+                job.next_run = self._with_jitter(job, self.clock() + delay)
+                msg = "ジョブ({})の実行中にエラーが発生しました\n{}"
+                logging.error(msg.format(job.name, traceback.format_exc()))
+            else:
+                job.failures = 0
+                job.next_run = self._with_jitter(job,
+                                                 job.next_time(self.clock()))
+        return len(due)
+
+    def _loop(self):
+        while not self.stopped.is_set():
+            self.run_pending()
+            due = self.next_due()
+            timeout = None if due is None else max(due - self.clock(), 0)
+            self.wakeup.wait(timeout)
+            self.wakeup.clear()
+
+    def start(self):
+        """
+        ワーカースレッドを起動する
+        """
+        if self.thread is None:
+            self.thread = threading.Thread(target=self._loop,
+                                           name='scheduler', daemon=True)
+            self.thread.start()
+
+    def stop(self):
+        """
+        ワーカースレッドを停止する
+        """
+        self.stopped.set()
+        self.wakeup.set()
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,170 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# segment.py
+# 長い録音(WAVファイルなど)を発話ごとに切り分けるツール
+# record.pyと同じフィルタ，閾値，発話開始と終わりの判定，発話前の音声の扱いで，
+# マイクに再生しなくても，実時間よりずっと速く切り分ける
+# 切り分けた発話は番号を付けたWAVファイルと，
+# replay.pyと同じ形式のマニフェスト(manifest.jsonl)に書き出す
+#
+# 使い方:
+#   python3 segment.py recording.wav -o outdir
+
+import os
+import sys
+import json
+import time
+import wave
+import audioop
+import logging
+import argparse
+import importlib
+
+import numpy as np
+
+import record
+from audio import AudioFile
+from vad import VoiceDetector, startup_seconds
+
+
+# 1回に読み込んで，まとめて処理するチャンクの数
+BLOCK_CHUNKS = 256
+
+
+def block_levels(data, rate, chunk):
+    """
+    チャンクをいくつも並べた生データ(16ビット)から，
+    record.pyのfilter_chunk()とchunk_level()と同じボリュームを
+    すべてのチャンクについてまとめて計算し，配列で返す
+    """
+    samples = np.frombuffer(data, dtype=np.int16)
+    n = len(samples) // chunk
+    # コピーせずに，チャンクごとの行に並べ替えたビューを作る
+    frames = np.lib.stride_tricks.as_strided(
+            samples, shape=(n, chunk),
+            strides=(chunk * samples.itemsize, samples.itemsize),
+            writeable=False)
+    lf = np.fft.rfft(frames, axis=1)
+    lf[:, ~record.band_mask(chunk, rate)] = 0
+    nl = np.fft.irfft(lf, chunk, axis=1).astype(np.int16)
+    # audioop.avg(data, 4)と同じく，2サンプルずつ32ビットの値として平均する
+    avg = np.floor(nl.view('<i4').mean(axis=1, dtype=np.float64))
+    return np.sqrt(np.abs(avg))
+
+
+def segment(af, threshold, startup_time=0.15, silence_limit=1,
+            prev_length=0.5, max_second=9.5, latency=None,
+            block_chunks=BLOCK_CHUNKS):
+    """
+    AudioFileの中の発話を，(開始秒, 終了秒, 生データ)として順に返すジェネレーター
+    生データは16ビットに変換する
+    """
+    rate = af.SAMPLE_RATE
+    width = af.SAMPLE_WIDTH
+    chunk = record.get_chunk(rate, latency)
+    size = chunk * 2
+    detector = VoiceDetector(rate, chunk, threshold, startup_time,
+                             silence_limit, prev_length, max_second)
+    # 発話か，発話前の音声になるかもしれないチャンクの生データ
+    # bufの先頭がbuf_start番のチャンク
+    buf = bytearray()
+    buf_start = 0
+    index = 0
+
+    def cut(frames):
+        s = (frames[0] - buf_start) * size
+        e = (frames[-1] + 1 - buf_start) * size
+        return (frames[0] * chunk / rate, (frames[-1] + 1) * chunk / rate,
+                bytes(buf[s:e]))
+
+    while True:
+        data = af.stream.read(chunk * block_chunks)
+        if width != 2:
+            data = audioop.lin2lin(data, width, 2)
+        n = len(data) // size
+        if n == 0:
+            break
+        data = data[:n * size]
+        buf += data
+        # チャンクの番号を音声データの代わりに検出器に渡す
+        for lv in block_levels(data, rate, chunk).tolist():
+            if detector.push(index, lv):
+                yield cut(detector.frames)
+                detector.reset()
+            index += 1
+        # これ以上使わないチャンクを捨てる
+        frames = detector.frames
+        keep = frames[0] if frames else index
+        del buf[:(keep - buf_start) * size]
+        buf_start = keep
+
+    if detector.started:
+        # 発話の途中で録音が終わった
+        yield cut(detector.frames)
+
+
+def write_wav(path, data, rate):
+    wf = wave.open(path, 'wb')
+    wf.setnchannels(1)
+    wf.setsampwidth(2)
+    wf.setframerate(rate)
+    wf.writeframes(data)
+    wf.close()
+
+
+def run(path, outdir, config, threshold=None, latency=None):
+    """
+    pathの録音を切り分け，outdirに発話のWAVファイルとマニフェストを書き出す
+    (発話の数, 録音の秒数, 処理時間)を返す
+    """
+    os.makedirs(outdir, exist_ok=True)
+    base = os.path.splitext(os.path.basename(path))[0]
+    manifest = os.path.join(outdir, 'manifest.jsonl')
+    count = 0
+    start = time.perf_counter()
+    with AudioFile(path) as af, \
+            open(manifest, 'w', encoding='utf-8') as f:
+        duration = af.DURATION
+        utterances = segment(
+                af, threshold or config.VOLUME_THRESHOLD,
+                startup_seconds(config), config.SILENCE_LIMIT,
+                config.PREV_LENGTH, config.MAX_SECOND,
+                latency or getattr(config, 'CAPTURE_LATENCY', None))
+        for begin, end, data in utterances:
+            count += 1
+            fn = '{}-{:05d}.wav'.format(base, count)
+            write_wav(os.path.join(outdir, fn), data, af.SAMPLE_RATE)
+            f.write(json.dumps({'audio': fn, 'transcript': '',
+                                'source': path, 'start': round(begin, 3),
+                                'end': round(end, 3)},
+                               ensure_ascii=False) + '\n')
+            logging.debug("{}: {:.2f}秒から{:.2f}秒".format(fn, begin, end))
+    return count, duration, time.perf_counter() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            description='長い録音を発話ごとのWAVファイルに切り分ける')
+    parser.add_argument('input', help='録音のファイル(WAV，AIFF，FLAC)')
+    parser.add_argument('-o', '--outdir', default='segments',
+                        help='発話とマニフェストを書き出すディレクトリ')
+    parser.add_argument('-c', '--config', default='config',
+                        help='設定ファイル(省略するとconfig.pyを使う)')
+    parser.add_argument('-t', '--threshold', type=float, default=None,
+                        help='ボリュームの閾値(省略するとVOLUME_THRESHOLD)')
+    parser.add_argument('--latency', type=float, default=None,
+                        help='チャンクの長さ(ミリ秒，省略するとCAPTURE_LATENCY)')
+    args = parser.parse_args(argv)
+
+    config = importlib.import_module(args.config)
+    count, duration, elapsed = run(args.input, args.outdir, config,
+                                   args.threshold, args.latency)
+    print("発話: {}  録音の長さ: {:.1f}秒  処理時間: {:.2f}秒  "
+          "実時間比: {:.0f}倍".format(count, duration, elapsed,
+                                     duration / elapsed if elapsed else 0.0))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,318 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# soak.py
+# 長時間動かしたときの劣化を調べるため，合成した音声で対話を何千回も繰り返し，
+# メモリ(RSS)，開いているファイルディスクリプタ，スレッドの数，
+# 対話1回あたりの処理時間の推移を記録する
+# どれかが閾値を超えて増え続けていたら失敗(終了コード1)にする
+#
+# 使い方:
+#   python3 soak.py -n 5000 -o soak.csv
+
+import os
+import gc
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import importlib
+import threading
+
+import replay
+from replay import ReplayEntry, ReplaySource, StubRecognizer, NullSink
+
+
+# 対話の推移を調べる前に捨てる，最初のサンプルの割合(キャッシュなどが温まるまで)
+WARMUP = 0.2
+
+# 増え方の上限の既定値
+# RSSは1000回の対話あたりのMB，ファイルディスクリプタとスレッドは
+# 計測した区間全体での増加数，処理時間は最初の値に対する増加率(%)
+LIMITS = {'rss_mb': 2.0, 'fds': 1.0, 'threads': 1.0, 'latency_ms': 25.0}
+
+
+def rss_bytes():
+    """
+    プロセスの常駐メモリ(RSS)のバイト数を返す
+    /procが無い環境では，最大常駐メモリを返す
+    """
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except OSError:
+        import resource
+        rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOSはバイト，Linuxはキロバイト
+        return rss if sys.platform == 'darwin' else rss * 1024
+
+
+def fd_count():
+    """
+    開いているファイルディスクリプタの数を返す
+    """
+    for d in ('/proc/self/fd', '/dev/fd'):
+        try:
+            return len(os.listdir(d))
+        except OSError:
+            pass
+    return 0
+
+
+def thread_count():
+    """
+    ネイティブのスレッド(PortAudioなど)を含めたスレッドの数を返す
+    """
+    try:
+        with open('/proc/self/status') as f:
+            for line in f:
+                if line.startswith('Threads:'):
+                    return int(line.split()[1])
+    except OSError:
+        pass
+    return threading.active_count()
+
+
+def slope(xs, ys):
+    """
+    最小二乗法で求めた直線の傾きと切片を返す
+    """
+    n = len(xs)
+    mx = sum(xs) / n
+    my = sum(ys) / n
+    sxx = sum((x - mx) ** 2 for x in xs)
+    if not sxx:
+        return 0.0, my
+    a = sum((x - mx) * (y - my) for x, y in zip(xs, ys)) / sxx
+    return a, my - a * mx
+
+
+class SoakSource(ReplaySource):
+    """
+    音声ファイルを繰り返し読み込ませるReplaySource
+    limit個の発話を読み込ませたらEOFErrorを投げる
+    読み込んだ音声はキャッシュし，計測にハーネス自身の割り当てが混ざらないようにする
+    """
+
+    def __init__(self, entries, rate, limit, pad=3.0):
+        super().__init__(entries, rate, pad)
+        self.limit = limit
+        self.count = 0
+        self.cache = {}
+
+    def next_entry(self):
+        if self.count >= self.limit:
+            self.current = None
+            raise EOFError("soak finished")
+        self.index = self.count % len(self.entries)
+        self.count += 1
+        self.current = self.entries[self.index]
+        path = self.current.path
+        if path not in self.cache:
+            data = replay.read_audio(path, self.rate)
+            self.cache[path] = data + b'\x00' * (2 * int(self.rate * self.pad))
+        self.buffer = self.cache[path]
+        self.pos = 0
+
+
+class SoakSink(NullSink):
+    """
+    スピーカーの代わりの出力先
+    実際の音声合成と同じように，応答ごとに音声ファイルを書いて削除する
+    読み上げた文字列は記録せず，数だけを数える
+    """
+
+    def __init__(self, tmpdir):
+        super().__init__()
+        self.path = os.path.join(tmpdir, 'speech_text.mp3')
+        self.count = 0
+
+    def speech(self, txt):
+        with open(self.path, 'wb') as f:
+            f.write(txt.encode('utf-8') * 64)
+        os.remove(self.path)
+        self.count += 1
+
+    def play(self, path):
+        pass
+
+
+class SoakMonitor:
+    """
+    daemon.profilerの代わりに置き，対話が終わるたびに呼ばれるtick()で
+    every回ごとにRSS，ファイルディスクリプタ，スレッドの数と，
+    その間の対話1回あたりの処理時間を記録する
+    """
+
+    FIELDS = ('cycle', 'elapsed', 'rss_mb', 'fds', 'threads', 'latency_ms')
+
+    def __init__(self, every=10, clock=time.perf_counter):
+        self.every = every
+        self.clock = clock
+        self.samples = []
+        self.count = 0
+        self.start_time = None
+        self.last = None
+
+    def start(self):
+        self.count = 0
+        self.start_time = self.last = self.clock()
+
+    def tick(self):
+        self.count += 1
+        if self.count % self.every == 0:
+            self.sample()
+
+    def sample(self):
+        now = self.clock()
+        # 回収できるオブジェクトを回収してから測り，揺らぎを小さくする
+        gc.collect()
+        self.samples.append((self.count, now - self.start_time,
+                             rss_bytes() / 2 ** 20, fd_count(),
+                             thread_count(),
+                             (now - self.last) * 1000 / self.every))
+        self.last = self.clock()
+
+    def stop(self):
+        pass
+
+    def write(self, path):
+        """
+        記録したサンプルをCSVファイルに書き出す
+        """
+        with open(path, 'w') as f:
+            f.write(','.join(self.FIELDS) + '\n')
+            for row in self.samples:
+                f.write('{},{:.3f},{:.3f},{},{},{:.3f}\n'.format(*row))
+
+
+def analyze(samples, limits=LIMITS, warmup=WARMUP):
+    """
+    サンプルの推移を直線で近似し，項目ごとに
+    (名前, 最初の値, 最後の値, 増え方, 上限, 失敗したか)のリストを返す
+    """
+    samples = samples[int(len(samples) * warmup):]
+    if len(samples) < 3:
+        raise ValueError("not enough samples to find a trend")
+    cycles = [s[0] for s in samples]
+    result = []
+    for i, name in enumerate(SoakMonitor.FIELDS[2:], 2):
+        ys = [s[i] for s in samples]
+        a, b = slope(cycles, ys)
+        first = a * cycles[0] + b
+        last = a * cycles[-1] + b
+        if name == 'rss_mb':
+            growth = a * 1000
+        elif name == 'latency_ms':
+            growth = (last - first) / first * 100 if first > 0 else 0.0
+        else:
+            growth = last - first
+        result.append((name, first, last, growth, limits[name],
+                       growth > limits[name]))
+    return result
+
+
+def format_report(result, monitor, sink):
+    lines = [
+        "対話: {}回  応答: {}回  経過時間: {:.1f}秒".format(
+            monitor.count, sink.count,
+            monitor.samples[-1][1] if monitor.samples else 0.0),
+        "{:12s} {:>10s} {:>10s} {:>10s} {:>8s}".format(
+            'metric', 'first', 'last', 'growth', 'limit'),
+    ]
+    units = {'rss_mb': 'MB/1000', 'latency_ms': '%'}
+    for name, first, last, growth, limit, failed in result:
+        lines.append("{:12s} {:>10.2f} {:>10.2f} {:>10.2f} {:>8.2f} {}{}".format(
+                     name, first, last, growth, limit,
+                     units.get(name, ''), '  FAIL' if failed else ''))
+    return '\n'.join(lines)
+
+
+def make_entries(outdir, wake_word, command, rate=16000, seed=0):
+    """
+    ウェイクワードとコマンドの代わりになる合成音声を書き出し，
+    ReplayEntryのリストとして返す
+    """
+    import random
+    from bench import synth_utterance, write_wav
+    rand = random.Random(seed)
+    entries = []
+    for i, text in enumerate((wake_word, command)):
+        path = os.path.join(outdir, 'soak-{}.wav'.format(i))
+        write_wav(path, synth_utterance(rate, snr_db=30, bursts=2,
+                                        lead_seconds=0.3, rand=rand), rate)
+        entries.append(ReplayEntry(path, text))
+    return entries
+
+
+def setup(daemon, config, entries, interactions, every=10):
+    """
+    daemonモジュールを，繰り返しの音声ソース，音声認識，出力先と
+    計測用のモニターで動くようにする
+    """
+    tmpdir = os.path.dirname(entries[0].path)
+    daemon.config = config
+    replay.SOURCE = SoakSource(entries, config.SAMPLE_RATE,
+                               interactions * len(entries),
+                               pad=config.SILENCE_LIMIT + 1.0)
+    daemon.audio_factory = replay.SOURCE
+    daemon.sink = SoakSink(tmpdir)
+    daemon.profiler = SoakMonitor(every)
+    config.RECOGNIZER = StubRecognizer
+    config.MIC_CHANNELS = 1
+    return daemon.profiler
+
+
+def run(daemon, config, interactions, every=10, command='おはよう',
+        limits=LIMITS):
+    """
+    interactions回の対話を繰り返し，(結果, モニター, 出力先)を返す
+    """
+    tmpdir = tempfile.mkdtemp(prefix='soak-')
+    try:
+        entries = make_entries(tmpdir, config.WAKE_WORD, command,
+                               config.SAMPLE_RATE)
+        monitor = setup(daemon, config, entries, interactions, every)
+        daemon.import_commands()
+        try:
+            daemon.run()
+        except EOFError:
+            pass
+        return analyze(monitor.samples, limits), monitor, daemon.sink
+    finally:
+        shutil.rmtree(tmpdir, ignore_errors=True)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+            description='対話を繰り返し，メモリやファイルディスクリプタの増加を調べる')
+    parser.add_argument('-n', '--interactions', type=int, default=2000,
+                        help='繰り返す対話の回数')
+    parser.add_argument('-e', '--every', type=int, default=10,
+                        help='何回の対話ごとに計測するか')
+    parser.add_argument('-c', '--config', default='config',
+                        help='設定ファイル(省略するとconfig.pyを使う)')
+    parser.add_argument('--command', default='おはよう',
+                        help='ウェイクワードの後に話すコマンド')
+    parser.add_argument('-o', '--output', default=None,
+                        help='計測した値を書き出すCSVファイル')
+    for name, limit in LIMITS.items():
+        parser.add_argument('--max-' + name.split('_')[0], type=float,
+                            default=limit, dest=name,
+                            help='{}の増え方の上限(既定値{})'.format(name, limit))
+    args = parser.parse_args(argv)
+
+    import daemon
+    config = importlib.import_module(args.config)
+    limits = {name: getattr(args, name) for name in LIMITS}
+    result, monitor, sink = run(daemon, config, args.interactions,
+                                args.every, args.command, limits)
+    if args.output:
+        monitor.write(args.output)
+    print(format_report(result, monitor, sink))
+    return 1 if any(r[-1] for r in result) else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,449 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# speechserver.py
+# Bing Speech APIとGoogle Cloud Speech APIの代わりをするローカルサーバーと，
+# 音声認識のクラスでサーバーに負荷をかけるツール
+# 応答の遅延，エラーの割合，返す書き起こしを設定でき，
+# キーやネットワーク無しで音声認識のクラスの接続の扱いを測れる
+#
+# サーバーを起動する:
+#   python3 speechserver.py serve --port 8000 --latency uniform:0.1:0.3
+# 負荷をかける:
+#   python3 speechserver.py load --url http://127.0.0.1:8000 -j 8 -n 200
+
+import sys
+import json
+import math
+import time
+import uuid
+import random
+import logging
+import argparse
+import threading
+from types import SimpleNamespace
+from urllib.parse import urlsplit, parse_qs
+from concurrent.futures import ThreadPoolExecutor
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from audio import AudioData
+from plugin import load_recognizer
+
+
+TOKEN_PATH = '/sts/v1.0/issueToken'
+BING_PATH = '/speech/recognition/interactive/cognitiveservices/v1'
+DISCOVERY_PATH = '/$discovery/rest'
+GOOGLE_PATH = '/v1beta1/speech:syncrecognize'
+
+
+def parse_latency(spec, rand=random):
+    """
+    遅延の指定から，遅延(秒)を返す関数を作る
+    '0.2'なら一定，'uniform:0.1:0.3'なら一様分布，
+    'normal:平均:標準偏差'なら正規分布，
+    'lognormal:中央値:シグマ'なら対数正規分布の値を返す
+    負の値は0にする
+    """
+    kind, *args = str(spec).split(':')
+    try:
+        if not args:
+            value = float(kind)
+            return lambda: value
+        a, b = (float(x) for x in args)
+    except ValueError:
+        raise ValueError("invalid latency: {}".format(spec))
+    if kind == 'uniform':
+        return lambda: rand.uniform(a, b)
+    if kind == 'normal':
+        return lambda: max(0.0, rand.gauss(a, b))
+    if kind == 'lognormal':
+        return lambda: rand.lognormvariate(math.log(a), b) if a > 0 else 0.0
+    raise ValueError("invalid latency: {}".format(spec))
+
+
+def discovery_document(root):
+    """
+    syncrecognizeだけを持つ，Cloud Speech API(v1beta1)のディスカバリ文書を返す
+    """
+    return {
+        'kind': 'discovery#restDescription',
+        'discoveryVersion': 'v1',
+        'id': 'speech:v1beta1',
+        'name': 'speech',
+        'version': 'v1beta1',
+        'rootUrl': root,
+        'servicePath': '',
+        'baseUrl': root,
+        'batchPath': 'batch',
+        'protocol': 'rest',
+        'parameters': {
+            'key': {'type': 'string', 'location': 'query'},
+        },
+        'schemas': {
+            'SyncRecognizeRequest': {'id': 'SyncRecognizeRequest',
+                                     'type': 'object'},
+            'SyncRecognizeResponse': {'id': 'SyncRecognizeResponse',
+                                      'type': 'object'},
+        },
+        'resources': {
+            'speech': {
+                'methods': {
+                    'syncrecognize': {
+                        'id': 'speech.speech.syncrecognize',
+                        'path': GOOGLE_PATH.lstrip('/'),
+                        'flatPath': GOOGLE_PATH.lstrip('/'),
+                        'httpMethod': 'POST',
+                        'parameters': {},
+                        'parameterOrder': [],
+                        'request': {'$ref': 'SyncRecognizeRequest'},
+                        'response': {'$ref': 'SyncRecognizeResponse'},
+                    },
+                },
+            },
+        },
+    }
+
+
+class SpeechHandler(BaseHTTPRequestHandler):
+    """
+    音声認識APIの代わりに応答するハンドラ
+    """
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        path = urlsplit(self.path).path
+        if path != DISCOVERY_PATH:
+            self.send_json(404, {'error': 'not found'})
+            return
+        root = 'http://{}/'.format(self.headers.get('Host', '{}:{}'.format(
+                                   *self.server.server_address[:2])))
+        self.send_json(200, discovery_document(root))
+
+    def do_POST(self):
+        server = self.server
+        url = urlsplit(self.path)
+        path = url.path
+        body = self.read_body()
+        if path == TOKEN_PATH:
+            server.count('token')
+            if not self.headers.get('Ocp-Apim-Subscription-Key'):
+                self.send_text(401, 'missing subscription key')
+                return
+            if self.inject():
+                return
+            self.send_text(200, server.issue_token())
+        elif path == BING_PATH:
+            server.count('bing')
+            auth = self.headers.get('Authorization', '')
+            if not server.check_token(auth[len('Bearer '):]):
+                self.send_text(401, 'invalid token')
+                return
+            if self.inject():
+                return
+            texts = server.next_alternatives()
+            result = {'RecognitionStatus': 'Success', 'Offset': 0,
+                      'Duration': len(body) * 10000 // 32}
+            if parse_qs(url.query).get('format') == ['detailed']:
+                result['NBest'] = [{'Confidence': confidence(i),
+                                    'Lexical': t, 'ITN': t, 'MaskedITN': t,
+                                    'Display': t}
+                                   for i, t in enumerate(texts)]
+            else:
+                result['DisplayText'] = texts[0]
+            self.send_json(200, result)
+        elif path == GOOGLE_PATH:
+            server.count('google')
+            try:
+                request = json.loads(body.decode('utf-8'))
+                request['audio']['content']
+                n = int(request['config'].get('maxAlternatives') or 1)
+            except (ValueError, KeyError, TypeError, AttributeError):
+                self.send_json(400, {'error': {'code': 400,
+                                               'message': 'bad request'}})
+                return
+            if self.inject():
+                return
+            # 実際のAPIと同じく，信頼度は先頭の候補にだけ付ける
+            alternatives = [{'transcript': t}
+                            for t in server.next_alternatives()[:n]]
+            alternatives[0]['confidence'] = confidence(0)
+            self.send_json(200, {'results': [{'alternatives': alternatives}]})
+        else:
+            self.send_json(404, {'error': 'not found'})
+
+    def read_body(self):
+        """
+        リクエストの本体を読む，chunked転送にも対応する
+        """
+        if 'chunked' in self.headers.get('Transfer-Encoding', '').lower():
+            chunks = []
+            while True:
+                line = self.rfile.readline()
+                size = int(line.split(b';')[0].strip() or b'0', 16)
+                if size == 0:
+                    # トレーラーを読み飛ばす
+                    while self.rfile.readline() not in (b'\r\n', b'\n', b''):
+                        pass
+                    return b''.join(chunks)
+                chunks.append(self.rfile.read(size))
+                self.rfile.readline()
+        length = int(self.headers.get('Content-Length') or 0)
+        return self.rfile.read(length)
+
+    def inject(self):
+        """
+        設定した遅延を入れ，エラーの割合に応じて503を返す
+        エラーを返したらTrueを返す
+        """
+        server = self.server
+        time.sleep(server.latency())
+        if server.rand.random() < server.error_rate:
+            server.count('errors')
+            self.send_text(503, 'service unavailable')
+            return True
+        return False
+
+    def send_text(self, code, text):
+        self.send_body(code, text.encode('utf-8'), 'text/plain; charset=utf-8')
+
+    def send_json(self, code, obj):
+        self.send_body(code, json.dumps(obj, ensure_ascii=False).encode('utf-8'),
+                       'application/json; charset=utf-8')
+
+    def send_body(self, code, body, content_type):
+        self.send_response(code)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class SpeechServer(ThreadingHTTPServer):
+    """
+    音声認識APIの代わりをするサーバー
+    latencyに遅延の指定(parse_latency()の形式)，
+    error_rateにエラー(503)を返す割合，transcriptsに返す書き起こしのリスト，
+    (書き起こしを文字列のタプルにすると，候補(N-best)として順に返す)
+    token_ttlにアクセストークンの有効期間(秒)を渡す
+    書き起こしはリストの順に繰り返し返す
+    """
+    daemon_threads = True
+
+    def __init__(self, address=('127.0.0.1', 0), latency='0',
+                 error_rate=0.0, transcripts=('こんにちは',), token_ttl=600,
+                 seed=None):
+        super().__init__(address, SpeechHandler)
+        self.rand = random.Random(seed)
+        self.latency = parse_latency(latency, self.rand)
+        self.error_rate = error_rate
+        self.transcripts = list(transcripts) or ['']
+        self.token_ttl = token_ttl
+        self.tokens = {}
+        self.counts = {}
+        self.index = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server_address[:2]
+        return 'http://{}:{}'.format(host, port)
+
+    def config(self):
+        """
+        このサーバーを使うように，エンドポイントを設定した設定オブジェクトを返す
+        """
+        return SimpleNamespace(BING_KEY='local', GOOGLE_KEY='local',
+                               **endpoints(self.url))
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def issue_token(self):
+        token = uuid.uuid4().hex
+        with self.lock:
+            self.tokens[token] = time.monotonic() + self.token_ttl
+        return token
+
+    def check_token(self, token):
+        with self.lock:
+            expire = self.tokens.get(token)
+        return expire is not None and time.monotonic() < expire
+
+    def next_alternatives(self):
+        """
+        次の書き起こしの候補を，確からしい順のリストで返す
+        """
+        with self.lock:
+            text = self.transcripts[self.index % len(self.transcripts)]
+            self.index += 1
+        return [text] if isinstance(text, str) else list(text) or ['']
+
+    def start(self):
+        """
+        別スレッドでサーバーを起動する
+        """
+        self.thread = threading.Thread(target=self.serve_forever,
+                                       name='speechserver', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        if self.thread:
+            self.thread.join()
+
+
+def confidence(rank):
+    """
+    rank番目(0から)の候補の信頼度
+    """
+    return round(0.9 * 0.8 ** rank, 3)
+
+
+def endpoints(url):
+    """
+    urlのサーバーを使うための，設定ファイルのエンドポイントの値を返す
+    """
+    url = url.rstrip('/')
+    return {
+        'BING_TOKEN_URL': url + TOKEN_PATH,
+        'BING_RECOGNITION_URL': url + BING_PATH,
+        'GOOGLE_DISCOVERY_URL': url + DISCOVERY_PATH + '?version={apiVersion}',
+    }
+
+
+def make_audio(seconds=2.0, rate=16000):
+    """
+    負荷をかけるときに送る，440Hzの正弦波の音声を作る
+    """
+    n = int(seconds * rate)
+    frames = bytearray()
+    for i in range(n):
+        v = int(8000 * math.sin(2 * math.pi * 440 * i / rate))
+        frames += v.to_bytes(2, 'little', signed=True)
+    return AudioData(bytes(frames), rate, 2)
+
+
+def load(config, recognizer_class, audio_data, requests=100, concurrency=4):
+    """
+    recognizer_classの音声認識をconcurrency個のスレッドから
+    合計requests回呼び出し，結果を辞書で返す
+    音声認識のオブジェクトはスレッドごとに1つ作って使い回す
+    """
+    local = threading.local()
+
+    def call(i):
+        if not hasattr(local, 'recognizer'):
+            local.recognizer = recognizer_class()
+        start = time.perf_counter()
+        try:
+            local.recognizer.recognize(audio_data, config, show_all=False)
+            error = None
+        except Exception as e:
+            error = type(e).__name__
+        return time.perf_counter() - start, error
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        results = list(executor.map(call, range(requests)))
+    elapsed = time.perf_counter() - start
+
+    latencies = sorted(t for t, e in results if e is None)
+    errors = {}
+    for t, e in results:
+        if e is not None:
+            errors[e] = errors.get(e, 0) + 1
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'ok': len(latencies),
+        'errors': errors,
+        'elapsed': elapsed,
+        'throughput': requests / elapsed if elapsed else 0.0,
+        'p50': percentile(latencies, 0.5),
+        'p90': percentile(latencies, 0.9),
+        'p99': percentile(latencies, 0.99),
+    }
+
+
+def percentile(values, q):
+    """
+    並べ替えたvaluesのq(0から1)分位点を返す
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values)-1, int(q * len(values)))]
+
+
+def report(r):
+    """
+    load()の結果を文字列で返す
+    """
+    errors = ', '.join('{}: {}'.format(k, v) for k, v in
+                       sorted(r['errors'].items())) or 'なし'
+    return '\n'.join([
+        "リクエスト: {} (同時実行数 {})  成功: {}  エラー: {}".format(
+            r['requests'], r['concurrency'], r['ok'], errors),
+        "経過時間: {:.2f}秒  スループット: {:.2f}リクエスト/秒".format(
+            r['elapsed'], r['throughput']),
+        "応答時間(ms): p50 {:.1f}  p90 {:.1f}  p99 {:.1f}".format(
+            r['p50']*1000, r['p90']*1000, r['p99']*1000),
+    ])
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description='音声認識APIの代わりをするローカルサーバーと負荷ツール')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p_serve = sub.add_parser('serve', help='サーバーを起動する')
+    p_serve.add_argument('--host', default='127.0.0.1')
+    p_serve.add_argument('--port', type=int, default=8000)
+    p_serve.add_argument('--latency', default='0',
+                         help='応答の遅延(0.2，uniform:0.1:0.3，'
+                              'normal:0.2:0.05，lognormal:0.2:0.5)')
+    p_serve.add_argument('--error-rate', type=float, default=0.0,
+                         help='503を返す割合(0から1)')
+    p_serve.add_argument('--transcript', action='append',
+                         help='返す書き起こし(複数指定すると順に返す)')
+    p_serve.add_argument('--token-ttl', type=float, default=600,
+                         help='アクセストークンの有効期間(秒)')
+    p_serve.add_argument('--seed', type=int, default=None)
+    p_load = sub.add_parser('load', help='音声認識のクラスで負荷をかける')
+    p_load.add_argument('--url', default='http://127.0.0.1:8000',
+                        help='サーバーのURL')
+    p_load.add_argument('--recognizer', default='bing_recognizer.Bing',
+                        help='音声認識のクラス(モジュール名.クラス名)')
+    p_load.add_argument('-j', '--concurrency', type=int, default=4)
+    p_load.add_argument('-n', '--requests', type=int, default=100)
+    p_load.add_argument('--seconds', type=float, default=2.0,
+                        help='送る音声の長さ(秒)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'serve':
+        server = SpeechServer((args.host, args.port), args.latency,
+                              args.error_rate,
+                              args.transcript or ['こんにちは'],
+                              args.token_ttl, args.seed)
+        logging.info("音声認識APIの代わりをします({})".format(server.url))
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            print(json.dumps(server.counts, ensure_ascii=False))
+    else:
+        rc = load_recognizer(args.recognizer)
+        config = SimpleNamespace(BING_KEY='local', GOOGLE_KEY='local',
+                                 **endpoints(args.url))
+        r = load(config, rc, make_audio(args.seconds), args.requests,
+                 args.concurrency)
+        print(report(r))
+        sys.exit(1 if r['errors'] else 0)
@@ -0,0 +1,143 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 発話のアーカイブ(archive)をテストする
+
+import io
+import os
+import wave
+import tempfile
+import unittest
+from contextlib import redirect_stdout
+
+import archive
+from archive import *
+from audio import AudioData
+
+
+def utterance(value, frames, rate=16000):
+    return AudioData(value.to_bytes(2, 'little', signed=True) * frames,
+                     rate, 2)
+
+
+class TestArchive(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'archive.bin')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_append(self):
+        """
+        保存した発話と認識結果を読み出せるかテストする
+        """
+        with UtteranceArchive(self.path, size=8192, slots=8) as ar:
+            self.assertEqual(os.path.getsize(self.path),
+                             UtteranceArchive.data_start(8) + 8192)
+            seq = ar.append(utterance(100, 1000), timestamp=1.5)
+            self.assertEqual(seq, 0)
+            ar.annotate(seq, 'ラズパイ')
+            seq = ar.append(utterance(-200, 500, 8000))
+            ar.annotate(seq, '天気' * 200, plugin='weather')
+            e = ar.get(0)
+            self.assertEqual((e.timestamp, e.length, e.transcript, e.plugin),
+                             (1.5, 2000, 'ラズパイ', ''))
+            e = ar.get(1)
+            self.assertEqual(e.plugin, 'weather')
+            # 書き起こしは192バイト以内に切り詰める
+            self.assertEqual(e.transcript, '天気' * 32)
+            ad = ar.read(1)
+            self.assertEqual(ad.sample_rate, 8000)
+            self.assertEqual(ad.frame_data, utterance(-200, 500).frame_data)
+
+        # 開き直しても残っている
+        with UtteranceArchive(self.path, readonly=True) as ar:
+            self.assertEqual([e.seq for e in ar.entries()], [0, 1])
+            self.assertEqual(ar.read(0).frame_data,
+                             utterance(100, 1000).frame_data)
+
+    def test_wrap(self):
+        """
+        音声領域とインデックスを使い切ったら，古い発話から上書きされるかテストする
+        """
+        with UtteranceArchive(self.path, size=8192, slots=8) as ar:
+            for i in range(4):
+                # 3000バイトの発話は2つしか入らない
+                ar.append(utterance(i, 1500))
+            self.assertEqual([e.seq for e in ar.entries()], [2, 3])
+            self.assertRaises(KeyError, ar.read, 1)
+            for i in range(3):
+                self.assertEqual(ar.read(3).frame_data,
+                                 utterance(3, 1500).frame_data)
+            # 上書きされた発話への書き込みは無視する
+            ar.annotate(0, 'x')
+            for i in range(10):
+                ar.append(utterance(i, 10))
+            self.assertEqual([e.seq for e in ar.entries()],
+                             list(range(6, 14)))
+            self.assertRaises(KeyError, ar.get, 5)
+            self.assertRaises(KeyError, ar.get, 14)
+
+    def test_concurrent_read(self):
+        """
+        上書き中の発話を読んだら，途中の音声を返さずKeyErrorを投げるかテストする
+        """
+        with UtteranceArchive(self.path, size=8192, slots=8) as ar, \
+                UtteranceArchive(self.path, readonly=True) as reader:
+            ar.append(utterance(1, 1500))
+            ar.append(utterance(2, 1500))
+            results = []
+            write_entry = ar._write_entry
+
+            def read_then_write(*args):
+                # 音声を書いた後，インデックスを書く前に読む
+                for seq in (0, 1):
+                    try:
+                        results.append(reader.read(seq).frame_data)
+                    except KeyError:
+                        results.append(None)
+                write_entry(*args)
+
+            ar._write_entry = read_then_write
+            # 末尾に収まらないので，先頭の発話を上書きする
+            ar.append(utterance(3, 1500))
+            self.assertEqual(results,
+                             [None, utterance(2, 1500).frame_data])
+            self.assertEqual(reader.read(2).frame_data,
+                             utterance(3, 1500).frame_data)
+
+    def test_export(self):
+        """
+        WAVファイルへの書き出しをテストする
+        """
+        with UtteranceArchive(self.path, size=8192, slots=8) as ar:
+            ar.append(utterance(300, 800))
+            ar.append(utterance(400, 800))
+        outdir = os.path.join(self.tmpdir.name, 'out')
+        with redirect_stdout(io.StringIO()) as out:
+            archive.main(['export', '-o', outdir, self.path, '1', '5'])
+        self.assertEqual(out.getvalue().split(),
+                         [os.path.join(outdir, '000001.wav')])
+        with wave.open(os.path.join(outdir, '000001.wav'), 'rb') as wf:
+            self.assertEqual(wf.getframerate(), 16000)
+            self.assertEqual(wf.readframes(800),
+                             utterance(400, 800).frame_data)
+
+        with redirect_stdout(io.StringIO()) as out:
+            archive.main(['list', self.path])
+        self.assertEqual(len(out.getvalue().splitlines()), 2)
+
+    def test_invalid(self):
+        """
+        アーカイブでないファイルは開かないことをテストする
+        """
+        with open(self.path, 'wb') as f:
+            f.write(b'\x00' * 128)
+        self.assertRaises(ValueError, UtteranceArchive, self.path,
+                          readonly=True)
+
+
+if __name__ == '__main__':
+    unittest.main()
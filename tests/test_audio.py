@@ -0,0 +1,97 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 音声データ(audio)の切り出し，連結，無音の除去をテストする
+
+import io
+import math
+import wave
+import random
+import unittest
+
+from audio import AudioData, AudioFile
+
+RATE = 16000
+
+
+def tone(seconds, amplitude=8000):
+    return b''.join(int(amplitude * math.sin(2 * math.pi * 440 * i / RATE))
+                    .to_bytes(2, 'little', signed=True)
+                    for i in range(int(seconds * RATE)))
+
+
+def noise(seconds, amplitude=50, rand=random.Random(0)):
+    return b''.join(int(rand.gauss(0, amplitude))
+                    .to_bytes(2, 'little', signed=True)
+                    for i in range(int(seconds * RATE)))
+
+
+class TestAudioData(unittest.TestCase):
+
+    def test_slice(self):
+        """
+        切り出したデータが元のバッファを共有しているかテストする
+        """
+        data = bytearray(range(256)) * 250
+        ad = AudioData(data, RATE, 2)
+        s = ad.slice(0.5, 1.0)
+        self.assertEqual(s.frame_count, RATE // 2)
+        self.assertEqual(bytes(s.frame_data), bytes(data[RATE:RATE*2]))
+        data[RATE] = 255
+        self.assertEqual(s.frame_data[0], 255)
+        # 範囲外は切り詰める
+        self.assertEqual(ad.slice(-1, 100).frame_count, ad.frame_count)
+        self.assertEqual(ad.slice(3, 2).frame_count, 0)
+        self.assertIsInstance(s.get_raw_data(), bytes)
+
+    def test_concatenate(self):
+        a = AudioData(b'\x01\x00' * 10, RATE, 2)
+        b = AudioData(b'\x02\x00' * 5, RATE, 2)
+        c = AudioData.concatenate([a, b.slice(), a])
+        self.assertEqual(c.frame_count, 25)
+        self.assertEqual((a + b).frame_data, b'\x01\x00' * 10 + b'\x02\x00' * 5)
+        with self.assertRaises(AssertionError):
+            a + AudioData(b'\x00', 8000, 1)
+
+    def test_trim(self):
+        """
+        前後の無音を，余白を残して取り除く
+        """
+        ad = AudioData(noise(1.0) + tone(0.5) + noise(1.5), RATE, 2)
+        t = ad.trim(margin=0.2)
+        self.assertAlmostEqual(t.duration, 0.9, delta=0.03)
+        self.assertEqual(bytes(t.frame_data[:len(tone(0.1))]),
+                         bytes(ad.slice(0.8, 0.9).frame_data))
+        # 閾値を指定する
+        self.assertAlmostEqual(ad.trim(threshold=10, margin=0).duration,
+                               ad.duration, delta=0.03)
+        # 音が無ければそのまま返す
+        silent = AudioData(noise(1.0), RATE, 2)
+        self.assertIs(silent.trim(), silent)
+
+    def test_wav_roundtrip(self):
+        """
+        切り出したデータをWAVにして読み戻す
+        """
+        ad = AudioData(noise(0.5) + tone(0.5), RATE, 2).trim(margin=0.1)
+        with AudioFile(io.BytesIO(ad.get_wav_data())) as af:
+            self.assertEqual(af.stream.read(), bytes(ad.frame_data))
+
+    def test_multichannel(self):
+        """
+        4チャンネルのWAVファイルを，チャンネルの平均の1チャンネルとして読む
+        """
+        from array import array
+        values = [(1000, -1000, 400, 0), (8, 16, 24, 32), (-400, -400, 0, 0)]
+        frames = array('h', [v for frame in values for v in frame])
+        buf = io.BytesIO()
+        wf = wave.open(buf, 'wb')
+        wf.setnchannels(4)
+        wf.setsampwidth(2)
+        wf.setframerate(RATE)
+        wf.writeframes(frames.tobytes())
+        wf.close()
+        buf.seek(0)
+        with AudioFile(buf) as af:
+            mono = array('h', af.stream.read())
+        self.assertEqual(list(mono), [100, 20, -200])
@@ -0,0 +1,109 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# ベンチマーク(bench)をテストする
+
+import os
+import json
+import random
+import audioop
+import tempfile
+import unittest
+from array import array
+
+from bench import *
+
+
+class TestCorpus(unittest.TestCase):
+
+    def test_synth_utterance(self):
+        """
+        合成した音声の長さと，発話区間と無音区間の音量をテストする
+        """
+        rate = 16000
+        data = synth_utterance(rate, snr_db=20, bursts=2, burst_seconds=0.5,
+                               gap_seconds=0.5, lead_seconds=1.0,
+                               rand=random.Random(0))
+        self.assertEqual(len(data), 2 * (rate * 4))
+        lead = audioop.rms(data[:2*rate], 2)
+        burst = audioop.rms(data[2*rate:3*rate], 2)
+        # SN比20dBなら，発話区間の音量は無音区間のおよそ10倍
+        self.assertAlmostEqual(burst / lead, 10, delta=2)
+
+    def test_make_corpus(self):
+        """
+        合成した音声のマニフェストをreplay.pyで読めるかテストする
+        """
+        with tempfile.TemporaryDirectory() as d:
+            manifest = make_corpus(d, rates=(16000, 44100), snrs=(10,),
+                                   per_condition=1)
+            corpus = load_corpus(manifest)
+            self.assertEqual([ad.sample_rate for ad in corpus],
+                             [16000, 44100])
+
+
+class TestBench(unittest.TestCase):
+
+    def test_html(self):
+        """
+        フィクスチャのページから天気予報と概要を取り出せるかテストする
+        """
+        from plugins import weatherreport, wikipedia
+        tenki = read_fixture('tenki_week.html')
+        rows = weatherreport.parse_forecast(chunked(tenki, 4096))
+        self.assertEqual(rows[0].place, '千代田区')
+        abst = wikipedia.extract_abstruction(
+            chunked(read_fixture('wikipedia.html'), 4096))
+        self.assertTrue(abst.startswith('ラズベリーパイは、'))
+        results = bench_html(2)
+        self.assertEqual(len(results), 3)
+        self.assertTrue(all(r['mean_ms'] > 0 for r in results))
+
+    def test_format_results(self):
+        data = {'results': [{'name': 'a', 'rate': 16000, 'mean_ms': 1.0,
+                             'p50_ms': 1.0, 'p90_ms': 2.0},
+                            {'name': 'b', 'skipped': 'no numpy'}]}
+        text = format_results(data)
+        self.assertIn('rate=16000', text)
+        self.assertIn('skipped: no numpy', text)
+        json.dumps(data)
+
+    def test_micarray(self):
+        """
+        マイクアレイの録音を合成し，まとめる処理を測れるかテストする
+        """
+        data = (1000).to_bytes(2, 'little', signed=True) * 4
+        frames = synth_array(data, 3, [0, 1, -1], [0, 0, 0])
+        self.assertEqual(list(array('h', frames)),
+                         [1000, 0, 1000, 1000, 1000, 1000,
+                          1000, 1000, 1000, 1000, 1000, 0])
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("NumPy is not installed")
+        results = bench_micarray(1, channel_counts=(4,))
+        self.assertEqual([r['name'] for r in results],
+                         ['micarray.best', 'micarray.beam'])
+        self.assertTrue(all(r['budget_pct'] > 0 for r in results))
+
+    def test_idle(self):
+        """
+        待機中のチャンクで，フィルタを省いた方が軽くなるかテストする
+        """
+        try:
+            import numpy
+        except ImportError:
+            self.skipTest("NumPy is not installed")
+        full, gated = bench_idle(1, seconds=1.0)
+        self.assertEqual(full['name'], 'record.idle_full')
+        self.assertEqual(gated['name'], 'record.idle_gated')
+        self.assertLess(gated['mean_ms'], full['mean_ms'])
+
+    def test_resolver(self):
+        """
+        項目名のあいまい検索の索引のメモリ使用量を測れるかテストする
+        """
+        build, resolve = bench_resolver(1, count=1000)
+        self.assertEqual(build['name'], 'resolver.build')
+        self.assertGreater(build['bytes_per_title'], 0)
+        self.assertEqual(resolve['titles'], 1000)
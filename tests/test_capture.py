@@ -0,0 +1,506 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 別プロセスでの録音(capture)と発話区間の検出(vad)をテストする
+
+import io
+import os
+import time
+import random
+import signal
+import audioop
+import unittest
+from array import array
+from unittest import mock
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from capture import *
+from vad import VoiceDetector, IdleMeter, check_idle_gate, is_quiet, \
+        startup_seconds, DEFAULT_STARTUP_SECONDS
+
+RATE = 16000
+CHUNK = 1024
+# 2チャンク分の秒数
+STARTUP = 2*CHUNK/RATE
+
+
+def rms_level(data, rate):
+    return audioop.rms(data, 2)
+
+
+class FakeSource:
+    """
+    無音，発話(大きな音)，無音の順にチャンクを返すPyAudio互換のクラス
+    すべて返したらEOFErrorを投げる
+    """
+
+    def __init__(self, pattern):
+        # patternは(チャンクの値, チャンクの数)のリスト
+        self.chunks = []
+        for value, n in pattern:
+            self.chunks.extend([value] * n)
+
+    def __call__(self):
+        return self
+
+    def open(self, **kwargs):
+        return self
+
+    def read(self, frames, exception_on_overflow=True):
+        if not self.chunks:
+            raise EOFError()
+        value = self.chunks.pop(0)
+        return value.to_bytes(2, 'little', signed=True) * frames
+
+    def close(self):
+        pass
+
+    def terminate(self):
+        pass
+
+    def get_input_latency(self):
+        return CHUNK / RATE
+
+
+class SlowSource(FakeSource):
+    """
+    チャンクを実時間の約1/10の速さで返すFakeSource
+    """
+
+    def read(self, frames, exception_on_overflow=True):
+        time.sleep(0.005)
+        return super().read(frames, exception_on_overflow)
+
+
+class BufferAudio:
+    """
+    生データを先頭からチャンクずつ返すPyAudio互換のクラス
+    すべて返したらEOFErrorを投げる
+    """
+
+    def __init__(self, data):
+        self.data = data
+        self.pos = 0
+
+    def __call__(self):
+        return self
+
+    def open(self, **kwargs):
+        return self
+
+    def read(self, frames, exception_on_overflow=True):
+        if self.pos + frames * 2 > len(self.data):
+            raise EOFError()
+        self.pos += frames * 2
+        return self.data[self.pos - frames * 2:self.pos]
+
+    def get_input_latency(self):
+        return 0.0
+
+    def get_sample_size(self, format):
+        return 2
+
+    def close(self):
+        pass
+
+    def terminate(self):
+        pass
+
+
+def noisy_recording(rand):
+    """
+    直流分と小さな雑音の上に，出だしと終わりが滑らかな大きな発話と
+    小さな発話(ノイズ)を並べた録音
+    """
+    def part(seconds, sigma, ramp=0.0):
+        n = int(seconds * RATE)
+        out = []
+        for i in range(n):
+            env = min(1.0, (i + 1) / (ramp * RATE), (n - i) / (ramp * RATE)) \
+                if ramp else 1.0
+            v = 2 + rand.gauss(0, 15) + rand.gauss(0, sigma * env)
+            out.append(max(-32768, min(32767, int(v))))
+        return out
+    return array('h', part(1, 0) + part(1, 2500, 0.3) + part(2, 0) +
+                 part(0.8, 400, 0.2) + part(2, 0)).tobytes()
+
+
+class TestVoiceDetector(unittest.TestCase):
+
+    def test_seconds(self):
+        """
+        秒で指定した長さが，サンプリングレートに合わせたチャンクの数になるか
+        """
+        for rate, chunk in ((16000, 1024), (44100, 2048), (8000, 512)):
+            vd = VoiceDetector(rate, chunk, startup_time=0.2,
+                               silence_limit=1, prev_length=0.5)
+            self.assertEqual(vd.startup_chunks, round(0.2*rate/chunk))
+            self.assertEqual(vd.window, int(rate/chunk))
+            self.assertEqual(vd.prev_chunks, int(0.5*rate/chunk))
+
+    def test_startup_seconds(self):
+        """
+        以前の設定(STARTUP_TIMEがチャンクの数)は，値によらず
+        以前のチャンクの長さで秒に直し，警告を出す
+        """
+        from types import SimpleNamespace
+        import vad
+        vad._legacy_warned.clear()
+        for chunks in (1, 2, 3):
+            config = SimpleNamespace(SAMPLE_RATE=16000, STARTUP_TIME=chunks)
+            with self.assertLogs(level='WARNING'):
+                self.assertEqual(startup_seconds(config), chunks * 0.064)
+        config = SimpleNamespace(SAMPLE_RATE=44100, STARTUP_TIME=2)
+        with self.assertLogs(level='WARNING'):
+            self.assertAlmostEqual(startup_seconds(config), 512 / 44100)
+        # STARTUP_SECONDSがあれば，1でも2でも秒とみなす
+        for seconds in (1, 2, 0.2):
+            config = SimpleNamespace(SAMPLE_RATE=16000, STARTUP_TIME=3,
+                                     STARTUP_SECONDS=seconds)
+            self.assertEqual(startup_seconds(config), seconds)
+        self.assertEqual(startup_seconds(SimpleNamespace(SAMPLE_RATE=16000)),
+                         DEFAULT_STARTUP_SECONDS)
+        # VoiceDetectorは値によらず秒とみなす
+        self.assertEqual(VoiceDetector(RATE, CHUNK, startup_time=1)
+                         .startup_chunks, round(RATE/CHUNK))
+        self.assertEqual(VoiceDetector(RATE, CHUNK, startup_time=2)
+                         .startup_chunks, round(2*RATE/CHUNK))
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_get_chunk(self):
+        """
+        チャンクの長さが，指定した目安を超えないかテストする
+        """
+        from record import get_chunk
+        self.assertEqual(get_chunk(16000, 64), 1024)
+        self.assertEqual(get_chunk(48000, 64), 2048)
+        self.assertEqual(get_chunk(44100, 64), 2048)
+        self.assertEqual(get_chunk(8000, 1), 64)
+        for rate in (8000, 16000, 22050, 44100, 48000):
+            for latency in (20, 32, 50, 64, 100):
+                self.assertLessEqual(get_chunk(rate, latency),
+                                     max(64, rate * latency / 1000))
+
+    def test_push(self):
+        """
+        発話の開始と終わりを検出できるかテストする
+        """
+        vd = VoiceDetector(RATE, CHUNK, threshold=100, startup_time=STARTUP,
+                           silence_limit=0.5, prev_length=0.25)
+        levels = [0]*10 + [1000]*20 + [0]*10
+        for i, lv in enumerate(levels):
+            if vd.push(i, lv):
+                break
+        # 閾値を超えたチャンクが3つになったら開始し，
+        # 窓(7チャンク)の中で2つ以下になったら終わる
+        self.assertEqual(vd.audio[0], 12)
+        self.assertEqual(i, 34)
+        self.assertEqual(vd.frames, list(range(9, 34)))
+
+    def test_max_second(self):
+        vd = VoiceDetector(RATE, CHUNK, threshold=100, startup_time=0,
+                           silence_limit=0.5, prev_length=0, max_second=1.0)
+        for i in range(100):
+            if vd.push(i, 1000):
+                break
+        self.assertEqual(len(vd.audio), int(RATE/CHUNK))
+
+    def test_active(self):
+        """
+        閾値を超えたチャンクが窓に残っている間は，待機中とみなさない
+        """
+        vd = VoiceDetector(RATE, CHUNK, threshold=100, startup_time=STARTUP,
+                           silence_limit=0.5, prev_length=0)
+        vd.push(0, 0)
+        self.assertFalse(vd.active)
+        vd.push(1, 1000)
+        self.assertTrue(vd.active)
+        for i in range(vd.window):
+            vd.push(i, 0)
+        self.assertFalse(vd.active)
+
+
+class TestIdle(unittest.TestCase):
+
+    def test_is_quiet(self):
+        quiet = (20).to_bytes(2, 'little', signed=True) * CHUNK
+        loud = (3000).to_bytes(2, 'little', signed=True) * CHUNK
+        self.assertTrue(is_quiet(quiet, 50))
+        self.assertFalse(is_quiet(loud, 50))
+        # RMSが小さくても，大きなピークがあればフィルタをかける
+        click = quiet[:-2] + (1000).to_bytes(2, 'little', signed=True)
+        self.assertFalse(is_quiet(click, 50))
+
+    def test_meter(self):
+        """
+        待機中のチャンクの時間だけを数えるかテストする
+        """
+        ticks = iter(range(0, 100, 10))
+        cpu = iter(range(0, 100, 1))
+        meter = IdleMeter(clock=lambda: next(ticks), cpu=lambda: next(cpu))
+        meter.add(True, True)
+        meter.add(False)
+        meter.add(True, False)
+        self.assertEqual(meter.stats(), (2, 20, 2, 1))
+        self.assertEqual(meter.percent, 10.0)
+        meter.reset()
+        self.assertEqual(meter.stats(), (0.0, 0.0, 0, 0))
+        self.assertEqual(meter.percent, 0.0)
+
+    def test_check_idle_gate(self):
+        """
+        閾値が低いと，小さな雑音でもボリュームが閾値を超えるので省かない
+        """
+        self.assertEqual(check_idle_gate(50, 400), 50)
+        self.assertEqual(check_idle_gate(0, 100), 0)
+        with self.assertLogs(level='WARNING'):
+            self.assertEqual(check_idle_gate(50, 200), 0)
+
+    @unittest.skipIf(numpy is None, "NumPy is not installed")
+    def test_get_sound_chunk(self):
+        """
+        直流分のある雑音と滑らかな出だしの発話で，フィルタを省いても
+        record.get_sound_chunk()が同じ発話を切り出すかテストする
+        """
+        import record
+        data = noisy_recording(random.Random(0))
+
+        def segments(idle_gate):
+            audio = BufferAudio(data)
+            result = []
+            with mock.patch.object(record, 'filter_chunk',
+                                   wraps=record.filter_chunk) as f:
+                try:
+                    while True:
+                        fo, width = record.get_sound_chunk(
+                                8, 1, RATE, io.BytesIO(), threshold=400,
+                                startup_time=0.2, silence_limit=1,
+                                prev_length=0.5, audio_factory=audio,
+                                idle_gate=idle_gate)
+                        result.append(fo.getvalue())
+                except EOFError:
+                    pass
+            return result, f.call_count
+
+        full, full_calls = segments(0)
+        gated, gated_calls = segments(50)
+        self.assertEqual(len(full), 2)
+        self.assertEqual(gated, full)
+        # 待機中の雑音のチャンクの多くで，フィルタを省いた
+        self.assertLess(gated_calls, full_calls / 2)
+
+
+class TestFrameRing(unittest.TestCase):
+
+    def setUp(self):
+        self.ring = FrameRing.create(4, 8, RATE)
+
+    def tearDown(self):
+        self.ring.close()
+        self.ring.unlink()
+
+    def test_wrap(self):
+        """
+        折り返した区間の読み込みと，上書きされた区間の検出をテストする
+        """
+        ring = self.ring
+        for i in range(12):
+            self.assertEqual(ring.write(bytes([i])*4, float(i)), i)
+        self.assertEqual(ring.seq, 12)
+        segs = ring.segments(6, 10)
+        self.assertEqual(len(segs), 2)
+        self.assertEqual(ring.read(6, 10),
+                         b''.join(bytes([i])*4 for i in range(6, 10)))
+        with self.assertRaises(OverrunError):
+            ring.read(3, 6)
+        with self.assertRaises(OverrunError):
+            ring.read(10, 13)
+        for seg in segs:
+            seg.release()
+
+    def test_attach(self):
+        other = FrameRing.attach(self.ring.name)
+        self.ring.write(b'abcd', 1.0, FLAG_VOICE)
+        self.assertEqual(other.seq, 1)
+        self.assertEqual(other.read(0, 1), b'abcd')
+        self.assertEqual(other.flags[0], FLAG_VOICE)
+        other.close()
+
+    def test_timings(self):
+        """
+        チャンクごとの処理時間は，上書きされていない範囲だけ返す
+        """
+        ring = self.ring
+        for i in range(10):
+            ring.write(b'abcd', 0.0, 0, (i, 0.5, 0.25, 0.0))
+        self.assertEqual(ring.timings(0, 10),
+                         [(float(i), 0.5, 0.25, 0.0) for i in range(3, 10)])
+
+
+class TestCaptureProcess(unittest.TestCase):
+
+    def test_capture(self):
+        """
+        子プロセスで検出した発話を共有メモリから読み込む
+        """
+        source = FakeSource([(0, 30), (3000, 20), (0, 30),
+                             (5000, 10), (0, 30)])
+        cp = CaptureProcess(RATE, CHUNK, threshold=100, startup_time=STARTUP,
+                            silence_limit=0.5, prev_length=0.25,
+                            buffer_seconds=10, audio_factory=source,
+                            level=rms_level, discard_stale=False)
+        listening = []
+        cp.on_listen = lambda: listening.append(True)
+        cp.start()
+        try:
+            ad = cp.get_audiodata(timeout=10)
+            self.assertEqual(listening, [True])
+            samples = [int.from_bytes(ad.frame_data[i:i+2], 'little',
+                                      signed=True)
+                       for i in range(0, len(ad.frame_data), CHUNK*2)]
+            # 発話前の音声(3チャンク)を含む発話と，
+            # 終わりを検出するまでの無音(4チャンク)
+            self.assertEqual(samples, [0] + [3000]*20 + [0]*4)
+            ad = cp.get_audiodata(timeout=10)
+            self.assertIn(5000, [int.from_bytes(ad.frame_data[i:i+2],
+                                 'little', signed=True)
+                                 for i in range(0, len(ad.frame_data), 2)])
+            with self.assertRaises(EOFError):
+                cp.get_audiodata(timeout=10)
+        finally:
+            cp.stop()
+
+    def test_idle_gate(self):
+        """
+        待機中に小さなチャンクのボリュームの計算を省いても，同じ発話を検出する
+        """
+        source = FakeSource([(10, 30), (3000, 20), (10, 30)])
+        cp = CaptureProcess(RATE, CHUNK, threshold=300, startup_time=STARTUP,
+                            silence_limit=0.5, prev_length=0.25,
+                            buffer_seconds=10, audio_factory=source,
+                            level=rms_level, discard_stale=False,
+                            idle_gate=50)
+        cp.start()
+        try:
+            ad = cp.get_audiodata(timeout=10)
+            samples = [int.from_bytes(ad.frame_data[i:i+2], 'little',
+                                      signed=True)
+                       for i in range(0, len(ad.frame_data), CHUNK*2)]
+            self.assertEqual(samples, [10] + [3000]*20 + [10]*4)
+        finally:
+            cp.stop()
+
+    def test_discard_stale(self):
+        """
+        呼び出す前に終わっていた発話は捨てる
+        """
+        source = FakeSource([(0, 30), (3000, 20), (0, 30)])
+        cp = CaptureProcess(RATE, CHUNK, threshold=100, startup_time=STARTUP,
+                            silence_limit=0.5, prev_length=0.25,
+                            buffer_seconds=10, audio_factory=source,
+                            level=rms_level)
+        cp.start()
+        try:
+            cp.process.join(10)
+            with self.assertRaises(EOFError):
+                cp.get_audiodata(timeout=10)
+        finally:
+            cp.stop()
+
+    def test_flush(self):
+        """
+        flush()する前に声が始まっていた発話(再生した応答)は捨てる
+        """
+        source = FakeSource([(0, 30), (3000, 20), (0, 30),
+                             (5000, 10), (0, 30)])
+        cp = CaptureProcess(RATE, CHUNK, threshold=100, startup_time=STARTUP,
+                            silence_limit=0.5, prev_length=0.25,
+                            buffer_seconds=10, audio_factory=source,
+                            level=rms_level, discard_stale=False)
+        cp.start()
+        try:
+            cp.process.join(10)
+            # 最初の発話の途中で再生を終えたものとする
+            cp.discard_before = 35
+            ad = cp.get_audiodata(timeout=10)
+            samples = set(array('h', ad.frame_data))
+            self.assertIn(5000, samples)
+            self.assertNotIn(3000, samples)
+            cp.flush()
+            self.assertEqual(cp.discard_before, cp.ring.seq)
+            with self.assertRaises(EOFError):
+                cp.get_audiodata(timeout=10)
+        finally:
+            cp.stop()
+
+    def test_chunk_timer(self):
+        """
+        子プロセスで測ったチャンクごとの処理時間を，chunk_timerに渡す
+        """
+        import capture
+        from profiler import ChunkTimer
+        source = FakeSource([(0, 30), (3000, 20), (0, 30)])
+        cp = CaptureProcess(RATE, CHUNK, threshold=100, startup_time=STARTUP,
+                            silence_limit=0.5, prev_length=0.25,
+                            buffer_seconds=10, audio_factory=source,
+                            level=rms_level, discard_stale=False)
+        timer = ChunkTimer()
+        cp.start()
+        try:
+            with mock.patch.object(capture, 'chunk_timer', timer):
+                cp.get_audiodata(timeout=10)
+                with self.assertRaises(EOFError):
+                    cp.get_audiodata(timeout=10)
+            self.assertEqual(len(timer.rows), 80)
+            for row in timer.rows:
+                self.assertEqual(len(row), 4)
+                self.assertTrue(all(t >= 0 for t in row))
+        finally:
+            cp.stop()
+
+    def kill(self, cp):
+        time.sleep(0.2)
+        os.kill(cp.process.pid, signal.SIGKILL)
+
+    def test_killed(self):
+        """
+        子プロセスが知らせずに終了したら，待ち続けずにCaptureErrorを投げる
+        """
+        source = SlowSource([(0, 1000)])
+        cp = CaptureProcess(RATE, CHUNK, threshold=100, startup_time=STARTUP,
+                            silence_limit=0.5, prev_length=0.25,
+                            buffer_seconds=10, audio_factory=source,
+                            level=rms_level, max_restarts=0)
+        cp.start()
+        try:
+            self.kill(cp)
+            with self.assertRaises(CaptureError):
+                cp.get_audiodata()
+        finally:
+            cp.stop()
+
+    def test_restart(self):
+        """
+        起動し直せる回数が残っていれば，子プロセスを起動し直して録音を続ける
+        """
+        source = SlowSource([(0, 200), (3000, 20), (0, 30)])
+        cp = CaptureProcess(RATE, CHUNK, threshold=100, startup_time=STARTUP,
+                            silence_limit=0.5, prev_length=0.25,
+                            buffer_seconds=10, audio_factory=source,
+                            level=rms_level, discard_stale=False,
+                            max_restarts=1)
+        cp.start()
+        try:
+            self.kill(cp)
+            with self.assertLogs(level='ERROR'):
+                ad = cp.get_audiodata(timeout=20)
+            self.assertEqual(cp.restarts, 1)
+            self.assertIn(3000, [int.from_bytes(ad.frame_data[i:i+2],
+                                 'little', signed=True)
+                                 for i in range(0, len(ad.frame_data), 2)])
+        finally:
+            cp.stop()
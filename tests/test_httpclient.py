@@ -0,0 +1,166 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# プラグイン用のHTTPクライアント(httpclient)をテストする
+
+import gzip
+import threading
+import unittest
+from http.server import HTTPServer, BaseHTTPRequestHandler
+
+from httpclient import *
+
+BODY = ('<html><body>' + 'テスト'*1000 + '</body></html>').encode('utf-8')
+ETAG = '"v1"'
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    connections = 0
+    requests = []
+
+    def setup(self):
+        Handler.connections += 1
+        super().setup()
+
+    def do_GET(self):
+        Handler.requests.append(dict(self.headers))
+        if self.path == '/redirect':
+            self.send_response(301)
+            self.send_header('Location', '/page')
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.headers.get('If-None-Match') == ETAG:
+            self.send_response(304)
+            self.send_header('ETag', ETAG)
+            self.end_headers()
+            return
+        body = BODY
+        self.send_response(200)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            self.send_header('Content-Encoding', 'gzip')
+        self.send_header('ETag', ETAG)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestHTTPClient(unittest.TestCase):
+
+    def setUp(self):
+        Handler.connections = 0
+        Handler.requests = []
+        self.server = HTTPServer(('127.0.0.1', 0), Handler)
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.start()
+        self.url = 'http://127.0.0.1:{}'.format(self.server.server_port)
+        self.client = HTTPClient(timeout=5)
+
+    def tearDown(self):
+        self.client.close()
+        self.server.shutdown()
+        self.server.server_close()
+        self.thread.join()
+
+    def test_gzip_and_keepalive(self):
+        """
+        gzipの展開と接続の再利用をテストする
+        """
+        for i in range(3):
+            with self.client.open(self.url+'/page', revalidate=False) as res:
+                self.assertEqual(res.status, 200)
+                self.assertEqual(res.read(), BODY)
+        # 3回のリクエストで接続は1つだけ
+        self.assertEqual(Handler.connections, 1)
+
+    def test_conditional_get(self):
+        """
+        ETagによる再検証をテストする
+        """
+        with self.client.open(self.url+'/page') as res:
+            self.assertFalse(res.from_cache)
+            self.assertEqual(res.read(), BODY)
+        with self.client.open(self.url+'/page') as res:
+            self.assertTrue(res.from_cache)
+            self.assertEqual(res.status, 200)
+            self.assertEqual(res.read(), BODY)
+        self.assertEqual(Handler.requests[1].get('If-None-Match'), ETAG)
+
+    def test_partial_read(self):
+        """
+        途中で読むのをやめたレスポンスは保存されず，接続も再利用されない
+        """
+        with self.client.open(self.url+'/page') as res:
+            res.read(16)
+        self.assertIsNone(self.client.store.get(self.url+'/page'))
+        with self.client.open(self.url+'/page') as res:
+            self.assertEqual(res.read(), BODY)
+        self.assertEqual(Handler.connections, 2)
+
+    def test_redirect(self):
+        """
+        リダイレクトをたどることをテストする
+        """
+        with self.client.open(self.url+'/redirect') as res:
+            self.assertEqual(res.url, self.url+'/page')
+            self.assertEqual(res.read(), BODY)
+
+    def test_store_on_disk(self):
+        """
+        ディレクトリに保存したレスポンスを別のクライアントで再検証する
+        """
+        import tempfile
+        with tempfile.TemporaryDirectory() as d:
+            client = HTTPClient(timeout=5, store=ResponseStore(d))
+            with client.open(self.url+'/page') as res:
+                res.read()
+            client.close()
+            client = HTTPClient(timeout=5, store=ResponseStore(d))
+            with client.open(self.url+'/page') as res:
+                self.assertTrue(res.from_cache)
+                self.assertEqual(res.read(), BODY)
+            client.close()
+
+    def test_connection_limit(self):
+        """
+        同時接続数の上限をテストする
+        """
+        client = HTTPClient(timeout=0.1, max_connections=1)
+        res = client.open(self.url+'/page', revalidate=False)
+        with self.assertRaises(HTTPClientError):
+            client.open(self.url+'/page', revalidate=False)
+        res.close()
+        with client.open(self.url+'/page', revalidate=False) as res:
+            self.assertEqual(res.read(), BODY)
+        client.close()
+
+
+class TestResponseStore(unittest.TestCase):
+
+    def test_bounded(self):
+        """
+        メモリ上のエントリは，合計バイト数と数の上限までに抑える
+        """
+        store = ResponseStore(max_bytes=100, max_entries=3)
+        for i in range(3):
+            store.put('u{}'.format(i), None, None, b'x' * 30)
+        # 使ったエントリは新しくなる
+        self.assertIsNotNone(store.get('u0'))
+        store.put('u3', None, None, b'x' * 30)
+        self.assertEqual(list(store.entries), ['u2', 'u0', 'u3'])
+        self.assertEqual(store.size, 90)
+        store.put('u4', None, None, b'x' * 50)
+        self.assertEqual(list(store.entries), ['u3', 'u4'])
+        self.assertIsNone(store.get('u1'))
+        # 上書きしても大きさを数え直す
+        store.put('u4', None, None, b'x' * 10)
+        self.assertEqual(store.size, 40)
+        # 上限より大きな本文はメモリ上に置かない
+        store.put('big', None, None, b'x' * 101)
+        self.assertNotIn('big', store.entries)
+        self.assertLessEqual(store.size, 100)
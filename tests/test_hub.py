@@ -0,0 +1,203 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 複数のサテライトの発話を処理するハブ(hub)をテストする
+
+import threading
+import unittest
+import multiprocessing
+from types import SimpleNamespace
+
+from hub import *
+
+# 発話の長さ(0.1秒単位)と書き起こしの対応
+TRANSCRIPTS = {1: 'ラズパイ', 2: 'おはよう', 3: 'こんばんは'}
+
+
+class LengthRecognizer:
+    """
+    発話の長さから書き起こしを決めるテスト用の音声認識
+    """
+
+    def recognize(self, audio_data, config=None, key='',
+                  language="ja-JP", show_all=False):
+        n = len(audio_data.frame_data) // (audio_data.sample_rate // 10 * 2)
+        return TRANSCRIPTS.get(n, '')
+
+
+def utterance(n):
+    return AudioData(b'\x00\x00' * (1600 * n), 16000, 2)
+
+
+class NBestRecognizer:
+    """
+    決まった候補(N-best)を返すテスト用の音声認識
+    """
+
+    def __init__(self, candidates):
+        self.candidates = candidates
+
+    def recognize(self, audio_data, config=None, show_all=False,
+                  max_alternatives=1):
+        return self.candidates[:max_alternatives]
+
+
+class TestProcessUtterance(unittest.TestCase):
+
+    def setUp(self):
+        import hub
+        import plugin
+        self.hub = hub
+        self.plugin = plugin
+        self.commands = plugin.COMMANDS
+        plugin.import_commands()
+        hub._worker_config = SimpleNamespace(
+                WAKE_WORD='ラズパイ', HUB_TTS=False,
+                RECOGNITION_ALTERNATIVES=3, WAKE_WORD_MAX_RANK=2,
+                WAKE_WORD_MIN_CONFIDENCE=0.6)
+
+    def tearDown(self):
+        self.plugin.COMMANDS = self.commands
+        self.hub._worker_config = None
+        self.hub._recognizer = None
+
+    def process(self, *candidates):
+        self.hub._recognizer = NBestRecognizer(list(candidates))
+        return [process_utterance(b'\x00\x00' * 1600, 16000, 2, awake)
+                for awake in (False, True)]
+
+    def test_nbest(self):
+        """
+        デーモンと同じように，2番目以降の候補もウェイクワードやコマンドに使う
+        """
+        sleep, awake = self.process(('ラズバイ', 0.8), ('ラズパイ', 0.7))
+        self.assertTrue(sleep['wake'])
+        self.assertEqual(sleep['transcript'], 'ラズバイ')
+        sleep, awake = self.process(('ラズバイ', 0.8), ('ラズパイ', 0.3))
+        self.assertFalse(sleep['wake'])
+        sleep, awake = self.process(('お早う', 0.8), ('おはよう', 0.7))
+        self.assertEqual(awake['response'], 'おはようございます')
+        self.assertFalse(awake['failure'])
+        sleep, awake = self.process()
+        self.assertEqual(awake['response'], '音声認識に失敗しました。')
+
+
+class TestFairQueue(unittest.TestCase):
+
+    def test_round_robin(self):
+        """
+        サテライトを順番に回り，処理中のサテライトは飛ばす
+        """
+        q = FairQueue()
+        for item in ('a1', 'a2', 'a3'):
+            q.put('a', item)
+        q.put('b', 'b1')
+        q.put('c', 'c1')
+        self.assertEqual(q.get(0), ('a', 'a1'))
+        self.assertEqual(q.get(0), ('b', 'b1'))
+        self.assertEqual(q.get(0), ('c', 'c1'))
+        # aの処理が終わるまで，aの次の発話は取り出さない
+        self.assertIsNone(q.get(0))
+        q.done('a')
+        self.assertEqual(q.get(0), ('a', 'a2'))
+        q.put('b', 'b2')
+        q.done('a')
+        q.done('b')
+        # 前回取り出したaより先にbを取り出す
+        self.assertEqual(q.get(0), ('b', 'b2'))
+        self.assertEqual(q.get(0), ('a', 'a3'))
+        q.close()
+        self.assertIsNone(q.get())
+
+
+class TestHub(unittest.TestCase):
+
+    @classmethod
+    def setUpClass(cls):
+        config = SimpleNamespace(RECOGNIZER=LengthRecognizer,
+                                 WAKE_WORD='ラズパイ', HUB_TTS=False)
+        cls.hub = Hub(config, workers=2,
+                      mp_context=multiprocessing.get_context('fork')).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.hub.stop()
+
+    def test_session(self):
+        """
+        ウェイクワードの後の発話だけをコマンドとして実行する
+        """
+        client = SatelliteClient(self.hub.address, 'living')
+        try:
+            self.assertEqual(client.sid, 'living')
+            # IDが重複したサテライトには番号を付ける
+            other = SatelliteClient(self.hub.address, 'living')
+            self.assertEqual(other.sid, 'living-1')
+            other.close()
+            r, speech = client.send(utterance(2))
+            self.assertEqual(r['transcript'], 'おはよう')
+            self.assertIsNone(r['response'])
+            r, speech = client.send(utterance(1))
+            self.assertTrue(r['wake'])
+            r, speech = client.send(utterance(2))
+            self.assertEqual(r['response'], 'おはようございます')
+            self.assertFalse(r['failure'])
+            r, speech = client.send(utterance(1))
+            r, speech = client.send(utterance(3))
+            self.assertTrue(r['failure'])
+            self.assertEqual(r['response'],
+                             'こんばんははコマンドとして認識できません。')
+        finally:
+            client.close()
+
+    def test_invalid_header(self):
+        """
+        ヘッダーが辞書でなければ，エラーのフレームを返して接続を閉じる
+        """
+        import json
+        import socket
+        for header in ([1, 2], 'hello', {'type': 'hello', 'size': 'x'}):
+            with socket.create_connection(self.hub.address, 10) as sock:
+                h = json.dumps(header).encode('utf-8')
+                sock.sendall(FRAME_HEADER.pack(len(h)) + h)
+                with sock.makefile('rb') as rfile:
+                    reply, payload = recv_frame(rfile)
+                    self.assertEqual(reply['type'], 'error')
+                    self.assertIsNone(recv_frame(rfile))
+        # 接続した後の不正なフレーム
+        client = SatelliteClient(self.hub.address, 'kitchen')
+        try:
+            h = json.dumps(['utterance']).encode('utf-8')
+            client.sock.sendall(FRAME_HEADER.pack(len(h)) + h)
+            with self.assertRaises(ProtocolError):
+                client.receive()
+        finally:
+            client.close()
+
+    def test_satellites(self):
+        """
+        複数のサテライトから同時に発話を送る
+        セッションはサテライトごとに分かれる
+        """
+        results = {}
+
+        def satellite(name):
+            client = SatelliteClient(self.hub.address, 'sat{}'.format(name))
+            rs = []
+            try:
+                for i in range(3):
+                    rs.append(client.send(utterance(1))[0]['wake'])
+                    rs.append(client.send(utterance(2))[0]['response'])
+            finally:
+                client.close()
+            results[name] = (client.sid, rs)
+
+        threads = [threading.Thread(target=satellite, args=(i,))
+                   for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join(30)
+        self.assertEqual(len(results), 4)
+        for sid, rs in results.values():
+            self.assertEqual(rs, [True, 'おはようございます'] * 3)
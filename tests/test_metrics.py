@@ -0,0 +1,63 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 処理時間のメトリクス(metrics)をテストする
+
+import time
+import unittest
+from urllib.request import urlopen
+
+import metrics
+from metrics import Histogram, Registry
+
+
+class TestHistogram(unittest.TestCase):
+
+    def test_observe(self):
+        """
+        値が正しいバケットに数えられることをテストする
+        """
+        h = Histogram(buckets=(0.1, 1.0))
+        for v in [0.05, 0.1, 0.5, 2.0]:
+            h.observe(v)
+        self.assertEqual(h.cumulative(), [(0.1, 2), (1.0, 3), ('+Inf', 4)])
+        self.assertEqual(h.count, 4)
+        self.assertAlmostEqual(h.sum, 2.65)
+        self.assertEqual(h.quantile(0.5), 0.1)
+        self.assertEqual(h.quantile(0.75), 1.0)
+
+
+class TestRegistry(unittest.TestCase):
+
+    def test_render(self):
+        """
+        Prometheusのテキスト形式をテストする
+        """
+        r = Registry()
+        r.observe('x_seconds', 0.002, stage='vad')
+        r.observe('x_seconds', 0.5, stage='plugin', plugin='plugins.greeting')
+        text = r.render()
+        self.assertEqual(text.count('# TYPE x_seconds histogram'), 1)
+        self.assertIn('x_seconds_bucket{stage="vad",le="0.002"} 1', text)
+        self.assertIn('x_seconds_bucket{stage="vad",le="+Inf"} 1', text)
+        self.assertIn('x_seconds_count{plugin="plugins.greeting",'
+                      'stage="plugin"} 1', text)
+
+    def test_server(self):
+        """
+        spanで測った時間がHTTPサーバーから取得できることをテストする
+        """
+        metrics.REGISTRY.clear()
+        with metrics.span('test_stage'):
+            time.sleep(0.01)
+        server = metrics.start_server(0)
+        try:
+            url = 'http://127.0.0.1:{}/metrics'.format(server.server_port)
+            text = urlopen(url).read().decode('utf-8')
+        finally:
+            server.shutdown()
+            server.server_close()
+        self.assertIn('sspeaker_stage_seconds_count{stage="test_stage"} 1',
+                      text)
+        h = metrics.REGISTRY.get('sspeaker_stage_seconds', stage='test_stage')
+        self.assertGreaterEqual(h.sum, 0.01)
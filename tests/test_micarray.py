@@ -0,0 +1,97 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# マイクアレイの音声を1チャンネルにまとめる処理(micarray)をテストする
+# NumPyが無い環境では飛ばす
+
+import random
+import unittest
+from array import array
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+RATE = 16000
+CHUNK = 1024
+DELAYS = [0, 3, -2, 5]
+
+
+def source(chunks, rand):
+    """
+    無音の後に，ノイズ(発話の代わり)が続く1チャンネルの音声
+    """
+    silent = [0.0] * (CHUNK * 8)
+    voice = [rand.gauss(0, 3000) for i in range(CHUNK * (chunks - 8))]
+    return silent + voice
+
+
+def record_array(src, noise_levels, rand):
+    """
+    チャンネルごとにDELAYSだけ遅らせ，ノイズを加えたインターリーブの生データ
+    """
+    n = len(src)
+    out = array('h')
+    for i in range(n):
+        for d, k in zip(DELAYS, noise_levels):
+            v = src[i - d] if 0 <= i - d < n else 0.0
+            out.append(max(-32768, min(32767, int(v + rand.gauss(0, k)))))
+    return out.tobytes()
+
+
+def snr_db(out, target):
+    err = out - target
+    return 10 * np.log10(np.var(target) / np.var(err))
+
+
+@unittest.skipIf(np is None, "NumPy is not installed")
+class TestChannelMixer(unittest.TestCase):
+
+    def mix(self, mode, noise_levels, chunks=24):
+        from micarray import ChannelMixer
+        rand = random.Random(0)
+        src = source(chunks, rand)
+        data = record_array(src, noise_levels, rand)
+        mixer = ChannelMixer(len(DELAYS), RATE, mode, max_delay=0.5)
+        size = CHUNK * 2 * len(DELAYS)
+        out = b''.join(mixer.process(data[i:i+size])
+                       for i in range(0, len(data), size))
+        self.assertEqual(len(out), CHUNK * 2 * chunks)
+        return mixer, np.frombuffer(out, dtype=np.int16), np.array(src)
+
+    def test_best(self):
+        """
+        SN比が一番よいチャンネルを選ぶかテストする
+        """
+        mixer, out, src = self.mix('best', [1000, 300, 1500, 800])
+        self.assertEqual(mixer.channel, 1)
+        # 選んだチャンネル(3サンプル遅れ)と同じ音声になる
+        voiced = slice(CHUNK * 10, None)
+        target = np.roll(src, 3)[voiced]
+        self.assertGreater(snr_db(out[voiced], target), 15)
+
+    def test_beam(self):
+        """
+        チャンネル間の遅れを推定し，揃えて足し合わせるとSN比が上がるかテストする
+        """
+        mixer, out, src = self.mix('beam', [1000] * 4)
+        ref = mixer.channel
+        self.assertEqual(list(mixer.delays),
+                         [d - DELAYS[ref] for d in DELAYS])
+        # 出力はmax_lagサンプル遅れる
+        voiced = slice(CHUNK * 10, None)
+        target = np.roll(src, DELAYS[ref] + mixer.max_lag)[voiced]
+        single = snr_db(self.mix('best', [1000] * 4)[1][voiced],
+                        np.roll(src, DELAYS[ref])[voiced])
+        # 4チャンネルを揃えて足せば，ノイズの分散は1/4(約6dB)になる
+        self.assertGreater(snr_db(out[voiced], target), single + 4)
+
+    def test_get_mixer(self):
+        from micarray import get_mixer
+        self.assertIsNone(get_mixer(1, RATE))
+        self.assertEqual(get_mixer(6, RATE, 'beam').mode, 'beam')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,218 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# プラグインの読み込み直し(plugin.reload_commands)をテストする
+
+import os
+import sys
+import tempfile
+import unittest
+
+import plugin
+from plugin import *
+
+PACKAGE = 'hotplugins_test'
+
+PLUGIN = '''
+def process(message, config):
+    if message == {word!r}:
+        return {answer!r}
+'''
+
+SCHEDULED = PLUGIN + '''
+def schedule(scheduler, config):
+    scheduler.add_job({job!r}, lambda: None, interval=60)
+'''
+
+
+class FakeScheduler:
+
+    def __init__(self):
+        self.jobs = {}
+
+    def add_job(self, name, func, **kwargs):
+        self.jobs[name] = func
+
+    def remove_job(self, name):
+        self.jobs.pop(name, None)
+
+
+class TestReload(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dir = os.path.join(self.tmpdir.name, PACKAGE)
+        os.mkdir(self.dir)
+        self.write('__init__.py', '')
+        self.write('a.py', PLUGIN.format(word='あ', answer='a1'))
+        self.write('b.py', SCHEDULED.format(word='い', answer='b1',
+                                            job='b-job'))
+        sys.path.insert(0, self.tmpdir.name)
+        self.saved = plugin.COMMANDS
+        self.scheduler = FakeScheduler()
+        import_commands(PACKAGE)
+        schedule_commands(self.scheduler, None)
+
+    def tearDown(self):
+        plugin.COMMANDS = self.saved
+        plugin.JOBS.clear()
+        plugin.FAILED.clear()
+        sys.path.remove(self.tmpdir.name)
+        for name in list(sys.modules):
+            if name.split('.')[0] == PACKAGE:
+                del sys.modules[name]
+        self.tmpdir.cleanup()
+
+    def write(self, fn, src):
+        with open(os.path.join(self.dir, fn), 'w', encoding='utf-8') as f:
+            f.write(src)
+
+    def names(self):
+        return [mod.__name__.split('.')[-1] for mod in plugin.COMMANDS]
+
+    def test_unchanged(self):
+        """
+        ファイルが変わっていなければ，何も読み込み直さないことをテストする
+        """
+        commands = plugin.COMMANDS
+        self.assertEqual(reload_commands(PACKAGE), [])
+        self.assertIs(plugin.COMMANDS, commands)
+
+    def test_changed(self):
+        """
+        変更，追加，削除されたプラグインだけを読み込み直すかテストする
+        """
+        commands = plugin.COMMANDS
+        a = commands[0]
+        self.assertEqual(invoke_commands('あ', None), 'a1')
+        self.assertEqual(set(self.scheduler.jobs), {'b-job'})
+
+        self.write('a.py', PLUGIN.format(word='あ', answer='a2 changed'))
+        self.write('c.py', PLUGIN.format(word='う', answer='c1'))
+        os.remove(os.path.join(self.dir, 'b.py'))
+        changed = reload_commands(PACKAGE, self.scheduler, None)
+        self.assertEqual(changed, [PACKAGE + '.a', PACKAGE + '.c'])
+        self.assertEqual(self.names(), ['a', 'c'])
+        # 前のリストは変更せず，新しいリストに置き換える
+        self.assertIsNot(plugin.COMMANDS, commands)
+        self.assertEqual(len(commands), 2)
+        # 変更したプラグインは新しいモジュールになり，前のモジュールは変わらない
+        self.assertIsNot(plugin.COMMANDS[0], a)
+        self.assertIs(sys.modules[PACKAGE + '.a'], plugin.COMMANDS[0])
+        self.assertEqual(a.process('あ', None), 'a1')
+        self.assertEqual(invoke_commands('あ', None), 'a2 changed')
+        self.assertEqual(invoke_commands('う', None), 'c1')
+        self.assertIsNone(invoke_commands('い', None))
+        # 削除したプラグインのジョブは取り除く
+        self.assertEqual(self.scheduler.jobs, {})
+
+        self.write('b.py', SCHEDULED.format(word='い', answer='b2',
+                                            job='b-job2'))
+        self.assertEqual(reload_commands(PACKAGE, self.scheduler, None),
+                         [PACKAGE + '.b'])
+        self.assertEqual(self.names(), ['a', 'b', 'c'])
+        self.assertEqual(set(self.scheduler.jobs), {'b-job2'})
+
+    def test_error(self):
+        """
+        読み込めないプラグインは，前のモジュールを使い続けることをテストする
+        """
+        self.write('a.py', 'def process(message, config):\n    return (\n')
+        with self.assertLogs(level='ERROR'):
+            self.assertEqual(reload_commands(PACKAGE), [])
+        self.assertEqual(self.names(), ['a', 'b'])
+        self.assertEqual(invoke_commands('あ', None), 'a1')
+
+    def test_error_once(self):
+        """
+        読み込めなかったファイルは，変わるまで読み込み直さないことをテストする
+        """
+        from unittest import mock
+        self.write('a.py', 'def process(message, config):\n    return (\n')
+        self.write('c.py', 'raise RuntimeError("broken")\n')
+        with mock.patch.object(plugin, 'load_module',
+                               wraps=plugin.load_module) as load:
+            with self.assertLogs(level='ERROR') as logs:
+                self.assertEqual(reload_commands(PACKAGE), [])
+            self.assertEqual(len(logs.records), 2)
+            self.assertEqual(load.call_count, 2)
+            self.assertEqual(reload_commands(PACKAGE), [])
+            self.assertEqual(load.call_count, 2)
+        self.assertEqual(self.names(), ['a', 'b'])
+        self.assertEqual(invoke_commands('あ', None), 'a1')
+
+    def test_runtime_error(self):
+        """
+        実行の途中でエラーになったプラグインは，
+        途中まで定義した関数を使わず，前のモジュールを使い続ける
+        """
+        a = plugin.COMMANDS[0]
+        self.write('a.py', PLUGIN.format(word='あ', answer='a2 broken') +
+                   'raise RuntimeError("broken")\n')
+        with self.assertLogs(level='ERROR'):
+            self.assertEqual(reload_commands(PACKAGE), [])
+        self.assertIs(plugin.COMMANDS[0], a)
+        self.assertIs(sys.modules[PACKAGE + '.a'], a)
+        self.assertEqual(invoke_commands('あ', None), 'a1')
+        # 直したら読み込み直す
+        self.write('a.py', PLUGIN.format(word='あ', answer='a3 fixed'))
+        self.assertEqual(reload_commands(PACKAGE), [PACKAGE + '.a'])
+        self.assertEqual(invoke_commands('あ', None), 'a3 fixed')
+
+    def test_watch(self):
+        """
+        スケジューラーのジョブから読み込み直せるかテストする
+        """
+        watch_commands(self.scheduler, None, 1, PACKAGE)
+        self.write('a.py', PLUGIN.format(word='あ', answer='a3 watched'))
+        self.scheduler.jobs['plugin-reload']()
+        self.assertEqual(invoke_commands('あ', None), 'a3 watched')
+
+
+
+class TestHTTPClient(unittest.TestCase):
+
+    def setUp(self):
+        self.saved = plugin.HTTP_CLIENT, plugin.HTTP_SETTINGS
+        plugin.HTTP_CLIENT = plugin.HTTP_SETTINGS = None
+
+    def tearDown(self):
+        plugin.HTTP_CLIENT, plugin.HTTP_SETTINGS = self.saved
+
+    def test_rebuild(self):
+        """
+        設定が変わったらHTTPクライアントを作り直す
+        """
+        from types import SimpleNamespace
+        config = SimpleNamespace(HTTP_TIMEOUT=5, HTTP_MAX_CONNECTIONS=2)
+        client = get_http_client(config)
+        self.assertEqual(client.timeout, 5)
+        self.assertIs(get_http_client(config), client)
+        # 設定を渡さなければ，今のクライアントを使う
+        self.assertIs(get_http_client(), client)
+        config.HTTP_TIMEOUT = 20
+        config.HTTP_CACHE_MEMORY = 1024
+        with self.assertLogs(level='INFO'):
+            other = get_http_client(config)
+        self.assertIsNot(other, client)
+        self.assertEqual(other.timeout, 20)
+        self.assertEqual(other.store.max_bytes, 1024)
+
+
+class TestLoadRecognizer(unittest.TestCase):
+
+    def test_load_recognizer(self):
+        """
+        モジュール名.クラス名の文字列からクラスを読み込む
+        """
+        from collections import OrderedDict
+        self.assertIs(load_recognizer('collections.OrderedDict'),
+                      OrderedDict)
+        # クラスならそのまま返す
+        self.assertIs(load_recognizer(OrderedDict), OrderedDict)
+        with self.assertRaises(ImportError):
+            load_recognizer('no_such_recognizer.Recognizer')
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,62 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# メインループのプロファイル(profiler)をテストする
+# NumPyが無い環境では飛ばす(record.pyを読み込むため)
+
+import os
+import time
+import tempfile
+import unittest
+import tracemalloc
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from profiler import Profiler
+
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class TestProfiler(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_seconds(self):
+        """
+        対話が無くても，指定した秒数が過ぎたらプロファイルを終える
+        """
+        profiler = Profiler(self.tmpdir.name, seconds=0.2)
+        profiler.start()
+        self.assertTrue(tracemalloc.is_tracing())
+        deadline = time.monotonic() + 5
+        while profiler.running and time.monotonic() < deadline:
+            time.sleep(0.05)
+        self.assertFalse(profiler.running)
+        self.assertFalse(tracemalloc.is_tracing())
+        self.assertEqual(sorted(os.listdir(profiler.path)),
+                         ['chunks.csv', 'chunks.txt', 'main.prof',
+                          'main.txt', 'tracemalloc.txt'])
+
+    def test_interactions(self):
+        """
+        指定した回数の対話で終え，タイマーは止める
+        """
+        profiler = Profiler(self.tmpdir.name, interactions=2, seconds=60)
+        profiler.start()
+        profiler.tick()
+        self.assertTrue(profiler.running)
+        profiler.tick()
+        self.assertFalse(profiler.running)
+        self.assertFalse(tracemalloc.is_tracing())
+        self.assertIsNone(profiler.prev_handler)
+        self.assertIsNone(profiler.timer)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,231 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# リプレイモード(replay)をテストする
+
+import os
+import json
+import wave
+import tempfile
+import unittest
+
+import replay
+from replay import *
+from audio import AudioData
+
+
+def write_wav(path, frames, rate=16000):
+    """
+    テスト用のWAVファイルを書き出す
+    """
+    wf = wave.open(path, 'wb')
+    wf.setnchannels(1)
+    wf.setsampwidth(2)
+    wf.setframerate(rate)
+    wf.writeframes(frames)
+    wf.close()
+
+
+class TestReplay(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        d = self.tmpdir.name
+        write_wav(os.path.join(d, '01.wav'), b'\x10\x00' * 1600)
+        write_wav(os.path.join(d, '02.wav'), b'\x20\x00' * 3200, rate=8000)
+        with open(os.path.join(d, '01.txt'), 'w', encoding='utf-8') as f:
+            f.write('ラズパイ\n')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_load_manifest(self):
+        """
+        ディレクトリとマニフェストからの読み込みをテストする
+        """
+        d = self.tmpdir.name
+        entries = load_manifest(d)
+        self.assertEqual([os.path.basename(e.path) for e in entries],
+                         ['01.wav', '02.wav'])
+        self.assertEqual([e.transcript for e in entries], ['ラズパイ', ''])
+
+        manifest = os.path.join(d, 'manifest.jsonl')
+        with open(manifest, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'audio': '02.wav', 'transcript': '天気'})
+                    + '\n')
+        self.assertEqual(load_manifest(manifest),
+                         [ReplayEntry(os.path.join(d, '02.wav'), '天気')])
+        with open(manifest, 'w', encoding='utf-8') as f:
+            f.write(json.dumps({'audio': '02.wav', 'transcript': '天気',
+                                'alternatives': ['転機']}) + '\n')
+        self.assertEqual(load_manifest(manifest)[0].alternatives, ('転機',))
+
+    def test_source(self):
+        """
+        ReplaySourceがファイルと無音を順に返すことをテストする
+        """
+        source = ReplaySource(load_manifest(self.tmpdir.name), 16000, pad=0.1)
+        stream = source().open(rate=16000, frames_per_buffer=1024)
+        self.assertEqual(source.current.transcript, 'ラズパイ')
+        data = stream.read(1600)
+        self.assertEqual(data, b'\x10\x00' * 1600)
+        self.assertEqual(stream.read(1600), b'\x00' * 3200)
+        # 次のストリームでは次のファイル(8kHzから変換される)
+        stream = source.open(rate=16000)
+        self.assertAlmostEqual(len(source.buffer), 2 * (6400 + 1600),
+                               delta=4)
+        # 読み終えたら検出できなかったものとして次へ進み，最後はEOFError
+        with self.assertRaises(EOFError):
+            for i in range(100):
+                stream.read(1024)
+        self.assertEqual(len(source.missed), 1)
+        self.assertAlmostEqual(source.audio_seconds, 0.5, places=3)
+
+    def test_reset_detector(self):
+        """
+        次のファイルに進んだら，前のファイルの検出の状態を持ち越さない
+        """
+        try:
+            from record import get_sound_chunk
+        except ImportError:
+            self.skipTest("NumPy is not installed")
+        from io import BytesIO
+        d = os.path.join(self.tmpdir.name, 'reset')
+        os.mkdir(d)
+        silent = b'\x00\x00' * 1024
+        loud = (b'\x10\x27\xf0\xd8' * 512)
+        # 閾値を超えるチャンクは，どちらのファイルも発話の開始に足りない
+        write_wav(os.path.join(d, '01.wav'), silent * 5 + loud * 2)
+        write_wav(os.path.join(d, '02.wav'), loud * 2 + silent * 20)
+        source = ReplaySource(load_manifest(d), 16000, pad=0.1)
+        with self.assertLogs(level='WARNING'):
+            with self.assertRaises(EOFError):
+                get_sound_chunk(8, 1, 16000, BytesIO(), 1000,
+                                startup_time=3 * 1024 / 16000,
+                                silence_limit=1, prev_length=0.1,
+                                audio_factory=source)
+        self.assertEqual([os.path.basename(e.path) for e in source.missed],
+                         ['01.wav', '02.wav'])
+
+    def test_stub_recognizer(self):
+        """
+        StubRecognizerが書き起こしを返すことをテストする
+        """
+        source = ReplaySource(load_manifest(self.tmpdir.name), 16000)
+        source.open(rate=16000)
+        replay.SOURCE = source
+        try:
+            ad = AudioData(b'\x00\x00' * 100, 16000, 2)
+            self.assertEqual(StubRecognizer().recognize(ad), 'ラズパイ')
+            source.current = source.current._replace(
+                    alternatives=('ラズベリー', 'ラズバイ'))
+            self.assertEqual(StubRecognizer().recognize(ad,
+                                                        max_alternatives=2),
+                             [('ラズパイ', None), ('ラズベリー', None)])
+        finally:
+            replay.SOURCE = None
+
+
+class Command:
+    """
+    messageにwordが含まれていたら応答するプラグインの代わり
+    """
+
+    def __init__(self, name, word):
+        self.__name__ = 'plugins.' + name
+        self.word = word
+
+    def process(self, message, config):
+        if self.word in message:
+            return self.word + 'です'
+
+
+class TestDispatch(unittest.TestCase):
+
+    def setUp(self):
+        import daemon
+        import plugin
+        self.daemon = daemon
+        self.plugin = plugin
+        self.commands = plugin.COMMANDS
+        plugin.COMMANDS = [Command('weather', '天気'),
+                           Command('greeting', 'おはよう')]
+
+    def tearDown(self):
+        self.plugin.COMMANDS = self.commands
+
+    def candidates(self, *texts):
+        return [(t, None) for t in texts]
+
+    def test_dispatch(self):
+        """
+        候補を確からしい順に調べ，最初に反応した候補を使う
+        """
+        dispatch = self.daemon.dispatch
+        c = self.candidates
+        self.daemon.config = None
+        w, mod, r = dispatch(c('転機', '天気', 'おはよう'))
+        self.assertEqual((w, mod.__name__, r),
+                         ('天気', 'plugins.weather', '天気です'))
+        # 先頭の候補が組み込みのコマンドなら，プラグインは呼ばない
+        self.assertEqual(dispatch(c('終了', 'おはよう')), ('終了', None, None))
+        self.assertEqual(dispatch(c('おはよう', '終了'))[2], 'おはようです')
+        # 2番目以降の候補では，組み込みのコマンドを受け付けない
+        self.assertEqual(dispatch(c('あ', '終了')), ('あ', None, None))
+        self.assertEqual(dispatch(c('あ', '再起動', '天気'))[0], '天気')
+        # どれにも反応しなければ，先頭の候補を返す
+        self.assertEqual(dispatch(c('あ', 'い')), ('あ', None, None))
+        self.assertEqual(dispatch([]), ('', None, None))
+
+    def test_wake_word(self):
+        """
+        2番目以降の候補は，順位と信頼度の条件を満たすときだけウェイクワードとみなす
+        """
+        from types import SimpleNamespace
+        self.daemon.config = SimpleNamespace(WAKE_WORD='ラズパイ',
+                                             WAKE_WORD_MAX_RANK=2,
+                                             WAKE_WORD_MIN_CONFIDENCE=0.6)
+        is_wake_word = self.daemon.is_wake_word
+        self.assertTrue(is_wake_word([('ラズパイ', None)]))
+        self.assertTrue(is_wake_word([('ラズバイ', 0.8), ('ラズパイ', 0.7)]))
+        # 信頼度が低いか，分からない
+        self.assertFalse(is_wake_word([('ラズバイ', 0.8), ('ラズパイ', 0.3)]))
+        self.assertFalse(is_wake_word([('ラズバイ', 0.8), ('ラズパイ', None)]))
+        # 順位が低すぎる
+        self.assertFalse(is_wake_word([('あ', 0.9), ('い', 0.8),
+                                       ('ラズパイ', 0.7)]))
+        self.assertFalse(is_wake_word([]))
+        # 設定が無ければ，先頭の候補だけを使う
+        self.daemon.config = SimpleNamespace(WAKE_WORD='ラズパイ')
+        self.assertFalse(is_wake_word([('ラズバイ', 0.8), ('ラズパイ', 0.7)]))
+
+
+class TestOption(unittest.TestCase):
+
+    def setUp(self):
+        import sys
+        import daemon
+        self.sys = sys
+        self.daemon = daemon
+        self.argv = sys.argv
+        self.saved = (getattr(daemon, 'config', None), daemon.replay_path,
+                      daemon.schedule_plugins, daemon.startup_timing)
+
+    def tearDown(self):
+        self.sys.argv = self.argv
+        (self.daemon.config, self.daemon.replay_path,
+         self.daemon.schedule_plugins, self.daemon.startup_timing) = self.saved
+
+    def schedule_plugins(self, *args):
+        self.sys.argv = ['daemon.py'] + list(args)
+        self.daemon.set_option()
+        return self.daemon.schedule_plugins
+
+    def test_replay_schedule(self):
+        """
+        リプレイでは，指定したときだけプラグインのジョブを動かす
+        """
+        self.assertTrue(self.schedule_plugins())
+        self.assertFalse(self.schedule_plugins('--replay', 'corpus'))
+        self.assertTrue(self.schedule_plugins('--replay', 'corpus',
+                                              '--replay-schedule'))
@@ -0,0 +1,106 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 先読み用のスケジューラー(scheduler)をテストする
+
+import time
+import unittest
+from datetime import datetime
+
+from scheduler import *
+
+
+class FakeClock:
+    """
+    テスト用に時刻を進められる時計
+    """
+
+    def __init__(self, now):
+        self.now = now
+
+    def __call__(self):
+        return self.now
+
+
+class TestScheduler(unittest.TestCase):
+
+    def setUp(self):
+        # 2026年1月1日 04:00(ローカル時刻)から始める
+        self.clock = FakeClock(datetime(2026, 1, 1, 4, 0).timestamp())
+        self.scheduler = Scheduler(clock=self.clock, rand=lambda: 0.5)
+        self.calls = []
+
+    def test_interval(self):
+        """
+        interval秒ごとに実行されることをテストする
+        """
+        self.scheduler.add_job('job', lambda: self.calls.append(1),
+                               interval=1800, jitter=10)
+        self.assertEqual(self.scheduler.run_pending(), 1)
+        self.assertEqual(self.scheduler.run_pending(), 0)
+        # ジッターとして5秒ずれる
+        self.assertEqual(self.scheduler.next_due(), self.clock.now + 1805)
+        self.clock.now += 1805
+        self.assertEqual(self.scheduler.run_pending(), 1)
+        self.assertEqual(len(self.calls), 2)
+
+    def test_at(self):
+        """
+        指定した時刻に実行されることをテストする
+        """
+        self.scheduler.add_job('job', lambda: self.calls.append(1),
+                               interval=3*3600, at=['05:00'], run_now=False)
+        self.assertEqual(self.scheduler.next_due(),
+                         datetime(2026, 1, 1, 5, 0).timestamp())
+        self.clock.now = self.scheduler.next_due()
+        self.scheduler.run_pending()
+        self.assertEqual(len(self.calls), 1)
+        # 次は3時間後
+        self.assertEqual(self.scheduler.next_due(),
+                         datetime(2026, 1, 1, 8, 0).timestamp())
+
+    def test_backoff(self):
+        """
+        失敗したときに間隔を倍々に空けることをテストする
+        """
+        def fail():
+            self.calls.append(1)
+            raise Exception('fail')
+        self.scheduler.add_job('job', fail, interval=1800,
+                               backoff=60, max_backoff=200)
+        for delay in [60, 120, 200, 200]:
+            start = self.clock.now
+            self.scheduler.run_pending()
+            self.assertEqual(self.scheduler.next_due(), start + delay)
+            self.clock.now = self.scheduler.next_due()
+        self.assertEqual(len(self.calls), 4)
+
+    def test_replace_and_remove(self):
+        """
+        同じ名前のジョブの置き換えと削除をテストする
+        """
+        self.scheduler.add_job('job', lambda: self.calls.append(1),
+                               interval=60)
+        self.scheduler.add_job('job', lambda: self.calls.append(2),
+                               interval=60)
+        self.scheduler.run_pending()
+        self.assertEqual(self.calls, [2])
+        self.scheduler.remove_job('job')
+        self.assertIsNone(self.scheduler.next_due())
+
+    def test_worker_thread(self):
+        """
+        ワーカースレッドでジョブが実行されることをテストする
+        """
+        scheduler = Scheduler()
+        scheduler.start()
+        try:
+            scheduler.add_job('job', lambda: self.calls.append(1),
+                              interval=3600)
+            for i in range(100):
+                if self.calls:
+                    break
+                time.sleep(0.01)
+            self.assertEqual(self.calls, [1])
+        finally:
+            scheduler.stop()
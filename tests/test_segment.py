@@ -0,0 +1,126 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 長い録音の切り分け(segment)をテストする
+# NumPyが無い環境では飛ばす
+
+import os
+import json
+import wave
+import random
+import tempfile
+import unittest
+from array import array
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+from audio import AudioFile
+from vad import VoiceDetector
+
+RATE = 16000
+
+
+def noise(seconds, sigma, rand):
+    n = int(seconds * RATE)
+    return array('h', (max(-32768, min(32767, int(rand.gauss(0, sigma))))
+                       for i in range(n))).tobytes()
+
+
+def recording():
+    """
+    無音とノイズ(発話の代わり)を交互に並べた録音
+    最後は発話の途中で終わる
+    """
+    rand = random.Random(0)
+    return (noise(1.0, 0, rand) + noise(1.0, 3000, rand) +
+            noise(2.5, 0, rand) + noise(0.6, 3000, rand) +
+            noise(2.0, 0, rand) + noise(0.5, 3000, rand))
+
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class TestSegment(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.tmpdir.name, 'long.wav')
+        wf = wave.open(self.path, 'wb')
+        wf.setnchannels(1)
+        wf.setsampwidth(2)
+        wf.setframerate(RATE)
+        wf.writeframes(recording())
+        wf.close()
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_block_levels(self):
+        """
+        まとめて計算したボリュームが，record.pyのチャンクごとの計算と同じか
+        """
+        import record
+        from segment import block_levels
+        data = recording()[:1024 * 2 * 40]
+        levels = block_levels(data, RATE, 1024)
+        expected = [record.chunk_level(record.filter_chunk(
+                    data[i:i+2048], RATE)) for i in range(0, len(data), 2048)]
+        self.assertEqual(len(levels), 40)
+        for a, b in zip(levels, expected):
+            self.assertAlmostEqual(a, b, places=6)
+
+    def test_segment(self):
+        """
+        チャンクごとに検出したときと同じ発話に切り分けるかテストする
+        """
+        import record
+        from segment import segment
+        params = dict(threshold=200, startup_time=0.2, silence_limit=1,
+                      prev_length=0.5)
+        # 少ないチャンクずつ読み込み，発話が読み込みの境目をまたぐようにする
+        with AudioFile(self.path) as af:
+            result = list(segment(af, block_chunks=7, **params))
+
+        # record.get_sound_chunk()と同じく，1チャンクずつ検出する
+        data = recording()
+        vd = VoiceDetector(RATE, 1024, **params)
+        expected = []
+        for i in range(len(data) // 2048):
+            c = data[i*2048:(i+1)*2048]
+            lv = record.chunk_level(record.filter_chunk(c, RATE))
+            if vd.push(c, lv):
+                expected.append(b''.join(vd.frames))
+                vd.reset()
+        if vd.started:
+            expected.append(b''.join(vd.frames))
+
+        self.assertEqual(len(result), 3)
+        self.assertEqual([r[2] for r in result], expected)
+        begin, end, frames = result[0]
+        # 発話の開始を検出したチャンクの0.5秒前から切り出す
+        self.assertTrue(0.5 <= begin < 1.0)
+        self.assertEqual(len(frames), (end - begin) * RATE * 2)
+
+    def test_run(self):
+        """
+        WAVファイルとマニフェストの書き出しをテストする
+        """
+        import config
+        from segment import run
+        from replay import load_manifest
+        outdir = os.path.join(self.tmpdir.name, 'out')
+        count, duration, elapsed = run(self.path, outdir, config, 200)
+        self.assertEqual(count, 3)
+        self.assertAlmostEqual(duration, 7.6)
+        entries = load_manifest(os.path.join(outdir, 'manifest.jsonl'))
+        self.assertEqual([os.path.basename(e.path) for e in entries],
+                         ['long-00001.wav', 'long-00002.wav',
+                          'long-00003.wav'])
+        with open(os.path.join(outdir, 'manifest.jsonl')) as f:
+            starts = [json.loads(line)['start'] for line in f]
+        self.assertEqual(starts, sorted(starts))
+
+
+if __name__ == '__main__':
+    unittest.main()
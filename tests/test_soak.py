@@ -0,0 +1,140 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 長時間の動作を調べるハーネス(soak)をテストする
+
+import os
+import unittest
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+import soak
+from soak import *
+
+
+def samples(rss=0.0, fds=0.0, threads=0.0, latency=0.0, n=50):
+    """
+    対話10回ごとに，それぞれの値が一定の割合で増えるサンプル
+    """
+    return [(i * 10, i * 0.1, 40 + rss * i, 5 + int(fds * i),
+             3 + int(threads * i), 5.0 * (1 + latency * i))
+            for i in range(1, n + 1)]
+
+
+class TestAnalyze(unittest.TestCase):
+
+    def failed(self, result):
+        return [r[0] for r in result if r[-1]]
+
+    def test_flat(self):
+        """
+        増えていなければ失敗しないことをテストする
+        """
+        result = analyze(samples())
+        self.assertEqual(self.failed(result), [])
+        self.assertEqual([r[0] for r in result],
+                         ['rss_mb', 'fds', 'threads', 'latency_ms'])
+
+    def test_growth(self):
+        """
+        増え続けている項目を見つけられるかテストする
+        """
+        # 10回ごとに0.05MB，1000回で5MB増える
+        self.assertEqual(self.failed(analyze(samples(rss=0.05))),
+                         ['rss_mb'])
+        self.assertEqual(self.failed(analyze(samples(fds=0.5))), ['fds'])
+        self.assertEqual(self.failed(analyze(samples(threads=0.1))),
+                         ['threads'])
+        self.assertEqual(self.failed(analyze(samples(latency=0.02))),
+                         ['latency_ms'])
+        # 最初の増加(ウォームアップ)は無視する
+        warm = [(c, t, 80 if c <= 50 else 40, f, th, lat)
+                for c, t, r, f, th, lat in samples()]
+        self.assertEqual(self.failed(analyze(warm)), [])
+        self.assertRaises(ValueError, analyze, samples(n=2))
+
+    def test_monitor(self):
+        now = [0.0]
+        monitor = SoakMonitor(every=2, clock=lambda: now[0])
+        monitor.start()
+        for i in range(6):
+            now[0] += 0.5
+            monitor.tick()
+        self.assertEqual([s[0] for s in monitor.samples], [2, 4, 6])
+        self.assertAlmostEqual(monitor.samples[-1][5], 500.0)
+        self.assertGreater(monitor.samples[-1][2], 0)
+        self.assertGreater(monitor.samples[-1][3], 0)
+
+
+class LeakySink(SoakSink):
+    """
+    応答ごとにファイルを開いたままにする出力先
+    """
+
+    def __init__(self, tmpdir):
+        super().__init__(tmpdir)
+        self.files = []
+
+    def speech(self, txt):
+        super().speech(txt)
+        self.files.append(open(os.devnull))
+
+
+@unittest.skipIf(numpy is None, "NumPy is not installed")
+class TestSoak(unittest.TestCase):
+
+    def setUp(self):
+        import config
+        import daemon
+        self.config = config
+        self.daemon = daemon
+        self.saved = {name: getattr(config, name)
+                      for name in ('RECOGNIZER', 'MIC_CHANNELS')}
+
+    def tearDown(self):
+        for name, value in self.saved.items():
+            setattr(self.config, name, value)
+        self.daemon.audio_factory = None
+        self.daemon.sink = None
+        self.daemon.profiler = None
+
+    def test_run(self):
+        """
+        対話を繰り返し，増えていないことを確かめられるかテストする
+        """
+        result, monitor, sink = soak.run(self.daemon, self.config, 60,
+                                         every=5)
+        self.assertEqual(sink.count, 60)
+        self.assertEqual(len(monitor.samples), 12)
+        fds = [r for r in result if r[0] == 'fds'][0]
+        self.assertFalse(fds[-1])
+
+    def test_leak(self):
+        """
+        ファイルディスクリプタの漏れを見つけられるかテストする
+        """
+        setup = soak.setup
+
+        def leaky_setup(daemon, *args):
+            monitor = setup(daemon, *args)
+            daemon.sink = LeakySink(os.path.dirname(daemon.sink.path))
+            return monitor
+
+        soak.setup = leaky_setup
+        try:
+            result, monitor, sink = soak.run(self.daemon, self.config, 40,
+                                             every=5)
+        finally:
+            soak.setup = setup
+            for f in self.daemon.sink.files:
+                f.close()
+        fds = [r for r in result if r[0] == 'fds'][0]
+        self.assertTrue(fds[-1])
+        self.assertGreater(fds[3], 20)
+
+
+if __name__ == '__main__':
+    unittest.main()
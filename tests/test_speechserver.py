@@ -0,0 +1,130 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 音声認識APIの代わりをするサーバー(speechserver)をテストする
+
+import json
+import random
+import unittest
+from urllib.request import Request, urlopen
+
+from speechserver import *
+from bing_recognizer import Bing, RequestError, UnknownValueError, \
+        parse_nbest
+
+
+class TestSpeechServer(unittest.TestCase):
+
+    def setUp(self):
+        self.server = SpeechServer(transcripts=['今日の天気', 'ラズパイ'],
+                                   seed=0).start()
+        self.config = self.server.config()
+        self.audio = AudioData(b'\x00\x00' * 1600, 16000, 2)
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_bing(self):
+        """
+        Bingの音声認識をローカルのサーバーで実行する
+        """
+        bing = Bing()
+        self.assertEqual(bing.recognize(self.audio, self.config), '今日の天気')
+        r = bing.recognize(self.audio, self.config, show_all=True)
+        self.assertEqual(r['RecognitionStatus'], 'Success')
+        self.assertEqual(r['DisplayText'], 'ラズパイ')
+        # アクセストークンはキャッシュされる
+        self.assertEqual(self.server.counts, {'token': 1, 'bing': 2})
+
+    def test_bing_nbest(self):
+        """
+        詳細形式で，候補(N-best)を確からしい順に受け取る
+        """
+        self.server.transcripts = [('ラズバイ', 'ラズパイ', 'ラズベリー')]
+        bing = Bing()
+        self.assertEqual(bing.recognize(self.audio, self.config,
+                                        max_alternatives=2),
+                         [('ラズバイ', 0.9), ('ラズパイ', 0.72)])
+        # 候補を求めなければ，先頭の候補だけを返す
+        self.assertEqual(bing.recognize(self.audio, self.config), 'ラズバイ')
+
+    def test_google_nbest(self):
+        """
+        maxAlternativesを指定すると，その数まで候補を返す
+        """
+        self.server.transcripts = [('ラズバイ', 'ラズパイ', 'ラズベリー')]
+        body = {'config': {'encoding': 'LINEAR16', 'sampleRate': 16000,
+                           'languageCode': 'ja-JP', 'maxAlternatives': 2},
+                'audio': {'content': ''}}
+        request = Request(self.server.url + GOOGLE_PATH,
+                          data=json.dumps(body).encode('utf-8'),
+                          headers={'Content-Type': 'application/json'})
+        with urlopen(request, timeout=10) as f:
+            response = json.loads(f.read().decode('utf-8'))
+        self.assertEqual(response['results'][0]['alternatives'],
+                         [{'transcript': 'ラズバイ', 'confidence': 0.9},
+                          {'transcript': 'ラズパイ'}])
+
+    def test_invalid_token(self):
+        """
+        無効なアクセストークンではエラーになる
+        """
+        bing = Bing()
+        bing.bing_cached_access_token = 'invalid'
+        bing.bing_cached_access_token_expiry = float('inf')
+        with self.assertRaises(RequestError):
+            bing.recognize(self.audio, self.config)
+
+    def test_error_rate(self):
+        """
+        エラーの割合を1にすると，すべて503を返す
+        """
+        self.server.error_rate = 1.0
+        with self.assertRaises(RequestError):
+            Bing().recognize(self.audio, self.config)
+        self.assertEqual(self.server.counts['errors'], 1)
+
+    def test_load(self):
+        """
+        負荷をかけて結果を集計する
+        """
+        r = load(self.config, Bing, self.audio, requests=20, concurrency=4)
+        self.assertEqual(r['ok'], 20)
+        self.assertEqual(r['errors'], {})
+        self.assertEqual(self.server.counts['bing'], 20)
+        # トークンはスレッドごとに1回だけ取得する
+        self.assertLessEqual(self.server.counts['token'], 4)
+        self.assertIn('スループット', report(r))
+
+
+class TestParseNBest(unittest.TestCase):
+
+    def test_parse_nbest(self):
+        result = {'RecognitionStatus': 'Success',
+                  'NBest': [{'Display': 'ラズパイ', 'Confidence': 0.8},
+                            {'Display': '', 'Confidence': 0.5},
+                            {'Display': 'ラズベリー', 'Confidence': 0.3}]}
+        self.assertEqual(parse_nbest(result, 5),
+                         [('ラズパイ', 0.8), ('ラズベリー', 0.3)])
+        self.assertEqual(parse_nbest(result, 1), [('ラズパイ', 0.8)])
+        # 単純形式の結果は，DisplayTextだけを候補にする
+        self.assertEqual(parse_nbest({'RecognitionStatus': 'Success',
+                                      'DisplayText': '天気'}, 3),
+                         [('天気', None)])
+        with self.assertRaises(UnknownValueError):
+            parse_nbest({'RecognitionStatus': 'NoMatch'}, 3)
+
+
+class TestParseLatency(unittest.TestCase):
+
+    def test_parse_latency(self):
+        rand = random.Random(0)
+        self.assertEqual(parse_latency('0.25')(), 0.25)
+        f = parse_latency('uniform:0.1:0.3', rand)
+        self.assertTrue(all(0.1 <= f() <= 0.3 for i in range(100)))
+        f = parse_latency('normal:0.0:1.0', rand)
+        self.assertTrue(all(f() >= 0 for i in range(100)))
+        f = parse_latency('lognormal:0.2:0.5', rand)
+        self.assertTrue(all(f() > 0 for i in range(100)))
+        with self.assertRaises(ValueError):
+            parse_latency('poisson:1:2')
@@ -0,0 +1,94 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# 一括音声認識ツール(transcribe)をテストする
+
+import os
+import json
+import wave
+import tempfile
+import threading
+import unittest
+
+from transcribe import *
+
+
+class FakeRecognizer:
+    """
+    音声の長さを文字列で返すテスト用の音声認識
+    """
+    calls = []
+    lock = threading.Lock()
+
+    def recognize(self, audio_data, config=None, key='',
+                  language="ja-JP", show_all=False):
+        with FakeRecognizer.lock:
+            FakeRecognizer.calls.append(len(audio_data.frame_data))
+        if not audio_data.frame_data:
+            raise ValueError('empty')
+        return str(len(audio_data.frame_data))
+
+
+class Config:
+    RECOGNIZER = FakeRecognizer
+
+
+class TestTranscribe(unittest.TestCase):
+
+    def setUp(self):
+        FakeRecognizer.calls = []
+        self.tmpdir = tempfile.TemporaryDirectory()
+        d = self.tmpdir.name
+        os.mkdir(os.path.join(d, 'sub'))
+        for fn, n in [('a.wav', 100), ('sub/b.wav', 200), ('c.wav', 0)]:
+            wf = wave.open(os.path.join(d, fn), 'wb')
+            wf.setnchannels(1)
+            wf.setsampwidth(2)
+            wf.setframerate(16000)
+            wf.writeframes(b'\x01\x00' * n)
+            wf.close()
+        self.output = os.path.join(d, 'out.jsonl')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_run_and_resume(self):
+        """
+        認識の実行と，書き出し済みのファイルを飛ばす再開をテストする
+        """
+        paths = find_audio(self.tmpdir.name)
+        self.assertEqual([os.path.relpath(p, self.tmpdir.name)
+                          for p in paths], ['a.wav', 'c.wav', 'sub/b.wav'])
+        count, errors, elapsed = run(paths, self.output,
+                                     Transcriber(Config), concurrency=2)
+        self.assertEqual((count, errors), (3, 1))
+        with open(self.output, encoding='utf-8') as f:
+            results = {os.path.basename(r['audio']): r
+                       for r in map(json.loads, f)}
+        self.assertEqual(results['a.wav']['transcript'], '200')
+        self.assertEqual(results['b.wav']['transcript'], '400')
+        self.assertIn('latency', results['a.wav'])
+        self.assertTrue(results['c.wav']['error'].startswith('ValueError'))
+
+        # 再開するとエラーになったファイルだけを認識し直す
+        FakeRecognizer.calls = []
+        count, errors, elapsed = run(paths, self.output,
+                                     Transcriber(Config), concurrency=2)
+        self.assertEqual((count, errors), (1, 1))
+        self.assertEqual(FakeRecognizer.calls, [0])
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_acquire(self):
+        """
+        頻度の制限をテストする
+        """
+        now = [0.0]
+        def sleep(t):
+            now[0] += t
+        limiter = RateLimiter(2, burst=2, clock=lambda: now[0], sleep=sleep)
+        for i in range(6):
+            limiter.acquire()
+        # 最初の2回は待たず，残りの4回は0.5秒ずつ待つ
+        self.assertAlmostEqual(now[0], 2.0)
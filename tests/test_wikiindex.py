@@ -0,0 +1,136 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# Wikipediaのオフライン索引(wikiindex)をテストする
+
+import os
+import gzip
+import tempfile
+import unittest
+
+from wikiindex import *
+
+# テスト用の概要ダンプ
+DUMP = """<feed>
+<doc>
+<title>Wikipedia: ジョゼフ・フーリエ</title>
+<url>https://ja.wikipedia.org/wiki/x</url>
+<abstract>ジャン・バティスト・ジョゼフ・フーリエ男爵（1768年 - 1830年）は、フランスの数学者・物理学者。</abstract>
+<links><sublink linktype="nav"><anchor>生涯</anchor><link>https://ja.wikipedia.org/wiki/x#a</link></sublink></links>
+</doc>
+<doc>
+<title>Wikipedia: フーリエ_(数学者)</title>
+<url>https://ja.wikipedia.org/wiki/y</url>
+<abstract>#転送 [[ジョゼフ・フーリエ]]</abstract>
+<links></links>
+</doc>
+<doc>
+<title>Wikipedia: ＡＢＣ</title>
+<url>https://ja.wikipedia.org/wiki/z</url>
+<abstract>ABC &amp; XYZ</abstract>
+<links></links>
+</doc>
+</feed>
+"""
+
+
+class TestWikiIndex(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.dump = os.path.join(self.tmpdir.name, 'abstract.xml.gz')
+        with gzip.open(self.dump, 'wt', encoding='utf-8') as f:
+            f.write(DUMP)
+        self.db = os.path.join(self.tmpdir.name, 'wiki.db')
+
+    def tearDown(self):
+        self.tmpdir.cleanup()
+
+    def test_normalize_title(self):
+        """
+        normalize_title()をテストする
+        """
+        self.assertEqual(normalize_title('ＡＢＣ'), 'abc')
+        self.assertEqual(normalize_title(' Foo_ Bar '), 'foo bar')
+
+    def test_build_and_lookup(self):
+        """
+        索引を作って概要を引く
+        """
+        self.assertEqual(build_index(self.dump, self.db), 3)
+        index = WikiIndex(self.db)
+        title, abst = index.lookup('ジョゼフ・フーリエ')
+        self.assertEqual(title, 'ジョゼフ・フーリエ')
+        self.assertTrue(abst.startswith('ジャン・バティスト'))
+        # リダイレクトをたどる
+        self.assertEqual(index.lookup('フーリエ (数学者)')[0],
+                         'ジョゼフ・フーリエ')
+        # 正規化した項目名で引ける
+        self.assertEqual(index.lookup('abc'), ('ＡＢＣ', 'ABC & XYZ'))
+        self.assertIsNone(index.lookup('ももいろクローバーX'))
+        index.close()
+
+
+class TestTitleResolver(unittest.TestCase):
+
+    def setUp(self):
+        self.resolver = TitleResolver(['ジョゼフ・フーリエ', 'フーリエ変換',
+                                       'ももいろクローバーZ', '東京都'])
+
+    def test_fold_title(self):
+        """
+        fold_title()をテストする
+        """
+        self.assertEqual(fold_title('ジョゼフ・フーリエ'), 'じょぜふふりえ')
+        self.assertEqual(fold_title('ＡＢＣ　Ｄ'), 'abcd')
+
+    def test_resolve(self):
+        """
+        resolve()をテストする
+        """
+        # カタカナとひらがな，中黒の違いは同じ項目とみなす
+        self.assertEqual(self.resolver.resolve('じょぜふふーりえ'),
+                         'ジョゼフ・フーリエ')
+        # 1文字違い
+        self.assertEqual(self.resolver.resolve('ジョセフ・フーリエ'),
+                         'ジョゼフ・フーリエ')
+        self.assertEqual(self.resolver.resolve('ももいろクローバーX'),
+                         'ももいろクローバーZ')
+        self.assertIsNone(self.resolver.resolve('大阪府'))
+        self.assertIsNone(self.resolver.resolve(''))
+
+
+class TestNegativeCache(unittest.TestCase):
+
+    def test_ttl(self):
+        """
+        ttl秒が過ぎたら忘れることをテストする
+        """
+        now = [0.0]
+        cache = NegativeCache(ttl=10, maxsize=2, clock=lambda: now[0])
+        cache.add('ももいろクローバーX')
+        self.assertTrue('ももいろクローバーX' in cache)
+        now[0] = 10
+        self.assertFalse('ももいろクローバーX' in cache)
+
+    def test_maxsize(self):
+        """
+        maxsizeを超えたら古いものから捨てることをテストする
+        """
+        cache = NegativeCache(ttl=10, maxsize=2)
+        for w in ['a', 'b', 'c']:
+            cache.add(w)
+        self.assertFalse('a' in cache)
+        self.assertTrue('b' in cache)
+        self.assertTrue('c' in cache)
+
+    def test_readd(self):
+        """
+        覚えている項目名を入れ直しても，他の項目名を捨てないことをテストする
+        """
+        cache = NegativeCache(ttl=10, maxsize=2)
+        cache.add('a')
+        cache.add('b')
+        cache.add('b')
+        self.assertTrue('a' in cache)
+        self.assertTrue('b' in cache)
@@ -0,0 +1,189 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# transcribe.py
+# ディレクトリかマニフェストにある音声ファイルをまとめて音声認識し，
+# 結果をJSON Linesで書き出すツール
+# 同時に実行する数とリクエストの頻度を制限でき，
+# 途中で止めても，書き出し済みのファイルを飛ばして再開できる
+
+import os
+import sys
+import json
+import time
+import logging
+import argparse
+import importlib
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+from audio import AudioData, AudioFile
+from replay import load_manifest, AUDIO_EXTS
+from plugin import load_recognizer
+
+
+class RateLimiter:
+    """
+    1秒あたりrate回までに実行の頻度を制限するトークンバケット
+    burst回までは続けて実行できる
+    """
+
+    def __init__(self, rate, burst=1, clock=time.monotonic,
+                 sleep=time.sleep):
+        self.rate = rate
+        self.burst = burst
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = burst
+        self.last = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """
+        実行できるようになるまで待つ
+        """
+        while True:
+            with self.lock:
+                now = self.clock()
+                self.tokens = min(self.burst,
+                                  self.tokens + (now - self.last) * self.rate)
+                self.last = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            self.sleep(wait)
+
+
+def find_audio(path):
+    """
+    音声ファイルのパスのリストを返す
+    pathがディレクトリなら，サブディレクトリも含めて音声ファイルを探す
+    ファイルならreplay.pyと同じ形式のマニフェストとして読む
+    """
+    if not os.path.isdir(path):
+        return [e.path for e in load_manifest(path)]
+    paths = []
+    for root, dirs, files in os.walk(path):
+        dirs.sort()
+        for fn in sorted(files):
+            if os.path.splitext(fn)[1].lower() in AUDIO_EXTS:
+                paths.append(os.path.join(root, fn))
+    return paths
+
+
+def load_done(output):
+    """
+    書き出し済みの結果から，エラー無く終わったファイルの集合を返す
+    """
+    done = set()
+    if not os.path.exists(output):
+        return done
+    with open(output, encoding='utf-8') as f:
+        for line in f:
+            try:
+                r = json.loads(line)
+            except ValueError:
+                # 書きかけの行は無視する
+                continue
+            if not r.get('error'):
+                done.add(r['audio'])
+    return done
+
+
+def read_audiodata(path):
+    """
+    音声ファイルを読み込んでAudioDataとして返す
+    """
+    with AudioFile(path) as af:
+        return AudioData(af.stream.read(), af.SAMPLE_RATE, af.SAMPLE_WIDTH)
+
+
+class Transcriber:
+    """
+    設定ファイルのRECOGNIZERを使い，音声ファイルを認識するクラス
+    音声認識のオブジェクトはスレッドごとに作る(アクセストークンのキャッシュも
+    スレッドごとになる)
+    """
+
+    def __init__(self, config, limiter=None):
+        self.config = config
+        self.limiter = limiter
+        self.local = threading.local()
+        self.recognizer_class = load_recognizer(config.RECOGNIZER)
+
+    def transcribe(self, path):
+        """
+        1つのファイルを認識し，結果を辞書で返す
+        """
+        r = {'audio': path}
+        try:
+            ad = read_audiodata(path)
+            r['duration'] = len(ad.frame_data) / float(
+                    ad.sample_rate * ad.sample_width)
+            if not hasattr(self.local, 'recognizer'):
+                self.local.recognizer = self.recognizer_class()
+            if self.limiter:
+                self.limiter.acquire()
+            start = time.perf_counter()
+            try:
+                r['transcript'] = self.local.recognizer.recognize(
+                        ad, self.config, show_all=False)
+            finally:
+                r['latency'] = time.perf_counter() - start
+        except Exception as e:
+            r['error'] = '{}: {}'.format(type(e).__name__, e)
+        return r
+
+
+def run(paths, output, transcriber, concurrency=4):
+    """
+    ファイルをconcurrency個ずつ並行して認識し，outputに追記する
+    書き出し済みのファイルは飛ばす
+    (認識したファイル数, エラーの数, 経過時間)を返す
+    """
+    done = load_done(output)
+    todo = [p for p in paths if p not in done]
+    logging.info("{}ファイル中{}ファイルを認識します".format(len(paths),
+                                                      len(todo)))
+    count = errors = 0
+    start = time.perf_counter()
+    with open(output, 'a', encoding='utf-8') as f, \
+            ThreadPoolExecutor(max_workers=concurrency) as executor:
+        futures = [executor.submit(transcriber.transcribe, p) for p in todo]
+        for future in as_completed(futures):
+            r = future.result()
+            f.write(json.dumps(r, ensure_ascii=False) + '\n')
+            f.flush()
+            count += 1
+            if r.get('error'):
+                errors += 1
+                logging.warning("{}: {}".format(r['audio'], r['error']))
+    return count, errors, time.perf_counter() - start
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description='音声ファイルをまとめて音声認識する')
+    parser.add_argument('input', help='音声ファイルのディレクトリかマニフェスト')
+    parser.add_argument('-o', '--output', default='transcripts.jsonl',
+                        help='結果を書き出すJSON Linesファイル')
+    parser.add_argument('-c', '--config', default='config',
+                        help='設定ファイル(省略するとconfig.pyを使う)')
+    parser.add_argument('-j', '--concurrency', type=int, default=4,
+                        help='同時に実行する認識の数')
+    parser.add_argument('-r', '--rate', type=float, default=0,
+                        help='1秒あたりのリクエスト数の上限(0なら制限しない)')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    config = importlib.import_module(args.config)
+    limiter = RateLimiter(args.rate, burst=args.concurrency) \
+            if args.rate else None
+    transcriber = Transcriber(config, limiter)
+    count, errors, elapsed = run(find_audio(args.input), args.output,
+                                 transcriber, args.concurrency)
+    print("{}ファイルを認識しました(エラー{}件)，{:.2f}秒，{:.2f}ファイル/秒"
+          .format(count, errors, elapsed,
+                  count / elapsed if elapsed else 0.0))
+    sys.exit(1 if errors else 0)
@@ -0,0 +1,205 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# vad.py
+# チャンクごとのボリュームから発話の区間を検出するクラス
+# record.get_sound_chunk()と，別プロセスで録音するcapture.pyで使う
+
+import time
+import audioop
+import logging
+from collections import deque
+
+import metrics
+
+
+# record.chunk_level()は16ビットのサンプルを2つずつ32ビットの値として平均するので，
+# 下位のサンプルだけでsqrt(65536) = 256近くになり，小さな雑音でもこの値を超えることがある
+LEVEL_FLOOR = 256
+
+# 以前のrecord.get_chunk()が返したチャンクのフレーム数(サンプリングレートがキー)
+# 以前の設定ファイルのSTARTUP_TIMEは，このチャンクの数で書かれている
+LEGACY_CHUNKS = {16000: 1024, 44100: 256}
+# 発話の開始とみなす音の長さ(秒)の初期値
+DEFAULT_STARTUP_SECONDS = 0.2
+# 警告を出した以前の設定(値, サンプリングレート)
+_legacy_warned = set()
+
+
+def startup_seconds(config):
+    """
+    設定ファイルから，発話の開始とみなす音の長さ(秒)を返す
+    STARTUP_SECONDSが無く，以前の設定ファイルのSTARTUP_TIME(チャンクの数)が
+    あれば，以前のチャンクの長さで秒に直し，非推奨の警告を1回だけ出す
+    """
+    seconds = getattr(config, 'STARTUP_SECONDS', None)
+    if seconds is not None:
+        return seconds
+    chunks = getattr(config, 'STARTUP_TIME', None)
+    if chunks is None:
+        return DEFAULT_STARTUP_SECONDS
+    rate = config.SAMPLE_RATE
+    seconds = chunks * LEGACY_CHUNKS.get(rate, 1024) / rate
+    if (chunks, rate) not in _legacy_warned:
+        _legacy_warned.add((chunks, rate))
+        msg = ("STARTUP_TIME(チャンクの数)は非推奨です。"
+               "STARTUP_SECONDS = {:.3f}(秒)に書き換えてください")
+        logging.warning(msg.format(seconds))
+    return seconds
+
+
+def check_idle_gate(gate, threshold):
+    """
+    待機中にフィルタを省く生データのRMS(gate)を，閾値と比べて使えるかを調べて返す
+    閾値がLEVEL_FLOOR以下だと，RMSの小さな雑音でもボリュームが閾値を超えることがあり，
+    省くと発話の区間が変わってしまうので，0(省かない)を返す
+    """
+    if gate and threshold <= LEVEL_FLOOR:
+        msg = ("閾値({})が{}以下なので，待機中にフィルタを省く設定"
+               "(IDLE_GATE={})は使いません")
+        logging.warning(msg.format(threshold, LEVEL_FLOOR, gate))
+        return 0
+    return gate
+
+
+def is_quiet(data, gate, width=2):
+    """
+    チャンクの生データのRMSがgateより小さく，ピークもgateの4倍より小さければ
+    Trueを返す(周波数のフィルタをかけなくても，無音とみなせる)
+    audioopの整数演算だけなので，FFTよりずっと軽い
+    """
+    return audioop.rms(data, width) < gate and \
+        audioop.max(data, width) < 4 * gate
+
+
+class VoiceDetector:
+    """
+    チャンクのボリュームを順に受け取り，発話の区間を検出するクラス
+    長さはすべて秒で指定し，チャンクの長さ(chunk / rate秒)で数に直す
+    (以前の設定ファイルのSTARTUP_TIMEは，startup_seconds()で秒に直して渡す)
+    直近silence_limit秒のチャンクのうち，ボリュームが閾値(threshold)を
+    超えたものの長さがstartup_time秒より長くなったら発話の開始とし，
+    そうでなくなったら発話の終わりとする
+    発話の前のprev_length秒分のチャンクも発話に含める
+    発話の長さがmax_second秒(最大9.5秒)に達したら，そこで終わりとする
+    """
+
+    def __init__(self, rate, chunk, threshold=200, startup_time=0.15,
+                 silence_limit=1, prev_length=0.5, max_second=9.5):
+        self.rate = rate
+        self.chunk = chunk
+        self.threshold = threshold
+        rel = rate/chunk
+        self.startup_chunks = int(round(startup_time*rel))
+        self.window = int(silence_limit*rel)
+        self.prev_chunks = int(prev_length*rel)
+        self.max_chunks = max(1, int(min(9.5, max_second)*rel))
+        self.reset()
+
+    def reset(self):
+        """
+        検出の状態を初期化する
+        """
+        self.slid_win = deque(maxlen=self.window)
+        self.prev_audio = deque(maxlen=self.prev_chunks)
+        self.audio = []
+        self.started = False
+
+    def push(self, data, level):
+        """
+        チャンクの生データ(data)とボリューム(level)を渡す
+        発話が終わったらTrueを返す
+        """
+        self.slid_win.append(level)
+        pow = sum([x > self.threshold for x in self.slid_win])
+        if pow > self.startup_chunks:
+            # 音の大きさが閾値を超えた状態の処理
+            if not self.started:
+                # 開始フラグが立っていないので立てる
+                self.started = True
+                logging.debug("音声の記録を開始します")
+            self.audio.append(data)
+            # 録音時間がmax_secondか9.5秒に達したら停止する
+            return len(self.audio) >= self.max_chunks
+        elif self.started:
+            return True
+        self.prev_audio.append(data)
+        return False
+
+    @property
+    def active(self):
+        """
+        発話の途中か，直近silence_limit秒に閾値を超えたチャンクがあればTrue
+        (このときは，無音の判定を省かずにフィルタをかける)
+        """
+        return self.started or any(x > self.threshold for x in self.slid_win)
+
+    @property
+    def frames(self):
+        """
+        発話前の音声を含む，発話のチャンクのリスト
+        """
+        return list(self.prev_audio) + self.audio
+
+    @property
+    def seconds(self):
+        """
+        記録した発話の秒数(発話前の音声を除く)
+        """
+        return len(self.audio) * self.chunk / float(self.rate)
+
+
+class IdleMeter:
+    """
+    発話を待っている間(待機中)のCPU時間と経過時間，
+    フィルタを省いたチャンクの数を数えるクラス
+    チャンクを処理するたびにadd()を呼ぶ
+    """
+
+    def __init__(self, clock=time.perf_counter, cpu=time.process_time):
+        self.clock = clock
+        self.cpu_clock = cpu
+        self.reset()
+
+    def reset(self):
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.chunks = 0
+        self.skipped = 0
+        self.last = (self.clock(), self.cpu_clock())
+
+    def add(self, idle, skipped=False):
+        """
+        前回のadd()からの時間を，idleなら待機中の時間として数える
+        """
+        now = (self.clock(), self.cpu_clock())
+        if idle:
+            self.wall += now[0] - self.last[0]
+            self.cpu += now[1] - self.last[1]
+            self.chunks += 1
+            self.skipped += bool(skipped)
+        self.last = now
+
+    @property
+    def percent(self):
+        """
+        待機中のCPU使用率(%)
+        """
+        return self.cpu / self.wall * 100 if self.wall > 0 else 0.0
+
+    def stats(self):
+        return self.cpu, self.wall, self.chunks, self.skipped
+
+
+def report_idle(cpu, wall, chunks, skipped):
+    """
+    待機中のCPU使用率をログに出し，CPU時間と経過時間をメトリクスに記録する
+    (使用率はidle_cpuとidle_wallの合計の比で求められる)
+    """
+    if not chunks:
+        return
+    metrics.observe('idle_cpu', cpu)
+    metrics.observe('idle_wall', wall)
+    logging.debug("待機中のCPU使用率は{:.1f}%でした(フィルタを省いたチャンク"
+                  " {}/{})".format(cpu / wall * 100 if wall > 0 else 0.0,
+                                   skipped, chunks))
@@ -0,0 +1,326 @@
+#! /usr/bin/env python3
+# -*- coding: utf-8 -*-
+
+# wikiindex.py
+# Wikipediaの概要ダンプ(jawiki-latest-abstract.xml)から
+# オフライン検索用の索引(SQLite)を作り，項目名で概要を引く
+
+import os
+import re
+import bz2
+import gzip
+import sqlite3
+import logging
+import time
+import argparse
+import threading
+import unicodedata
+from array import array
+from collections import Counter
+import xml.etree.ElementTree as ET
+
+
+# ダンプのタイトルに付いている接頭辞
+TITLE_PREFIX = 'Wikipedia: '
+# リダイレクトを表す概要のパターン
+redirect_pat = re.compile(r'^\s*#(?:転送|REDIRECT)\s*\[\[(.+?)(?:\|.*?)?\]\]',
+                          re.I)
+# 一度に書き込む行数
+BATCH_SIZE = 10000
+# リダイレクトをたどる回数の上限
+MAX_REDIRECTS = 3
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS pages (
+    key TEXT PRIMARY KEY,
+    title TEXT NOT NULL,
+    abstract TEXT NOT NULL,
+    redirect TEXT
+) WITHOUT ROWID
+"""
+
+
+def normalize_title(title):
+    """
+    検索用に項目名を正規化する
+    全角英数字などを半角に揃え，アンダースコアを空白にし，
+    連続する空白をまとめて，大文字小文字を区別しないようにする
+    """
+    title = unicodedata.normalize('NFKC', title).replace('_', ' ')
+    return ' '.join(title.split()).casefold()
+
+
+def fold_title(title):
+    """
+    あいまい検索用に項目名をさらに正規化する
+    カタカナをひらがなに揃え，空白，中黒，長音記号などを取り除く
+    (互換漢字はnormalize_title()のNFKCで通常の漢字に揃う)
+    """
+    title = normalize_title(title)
+    chars = []
+    for ch in title:
+        code = ord(ch)
+        if 0x30a1 <= code <= 0x30f6:
+            # カタカナをひらがなにする
+            ch = chr(code - 0x60)
+        elif ch in ' ・ー-_=･':
+            continue
+        chars.append(ch)
+    return ''.join(chars)
+
+
+def ngrams(s, n=2):
+    """
+    文字列のn-gramの集合を返す
+    """
+    if len(s) < n:
+        return {s} if s else set()
+    return {s[i:i+n] for i in range(len(s)-n+1)}
+
+
+def open_dump(path):
+    """
+    ダンプファイルを開く，拡張子が.gzや.bz2なら展開しながら読む
+    """
+    if path.endswith('.gz'):
+        return gzip.open(path, 'rb')
+    if path.endswith('.bz2'):
+        return bz2.open(path, 'rb')
+    return open(path, 'rb')
+
+
+def iter_dump(fileobject):
+    """
+    ダンプのdoc要素を順に読み，(項目名, 概要, リダイレクト先)を返すジェネレータ
+    読み終えた要素はすぐに捨てるので，ダンプの大きさによらず
+    メモリの使用量は一定になる
+    """
+    context = ET.iterparse(fileobject, events=('start', 'end'))
+    root = None
+    for event, elem in context:
+        if root is None:
+            root = elem
+        if event != 'end' or elem.tag != 'doc':
+            continue
+        title = elem.findtext('title') or ''
+        if title.startswith(TITLE_PREFIX):
+            title = title[len(TITLE_PREFIX):]
+        abstract = (elem.findtext('abstract') or '').strip()
+        redirect = None
+        m = redirect_pat.match(abstract)
+        if m:
+            redirect = m.group(1).split('#')[0].strip()
+            abstract = ''
+        # 読み終えた要素を捨てる
+        root.clear()
+        if title:
+            yield title, abstract, redirect
+
+
+def build_index(dump_path, db_path):
+    """
+    ダンプファイルから索引を作る
+    作った項目の数を返す
+    """
+    tmp_path = db_path + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    db = sqlite3.connect(tmp_path)
+    db.execute('PRAGMA journal_mode = OFF')
+    db.execute('PRAGMA synchronous = OFF')
+    db.execute(SCHEMA)
+    count = 0
+    batch = []
+    with open_dump(dump_path) as f:
+        for title, abstract, redirect in iter_dump(f):
+            batch.append((normalize_title(title), title, abstract, redirect))
+            if len(batch) >= BATCH_SIZE:
+                count += _insert(db, batch)
+                batch = []
+                logging.info("{}項目を書き込みました".format(count))
+        count += _insert(db, batch)
+    db.commit()
+    db.execute('VACUUM')
+    db.close()
+    os.replace(tmp_path, db_path)
+    return count
+
+
+def _insert(db, batch):
+    # 同じ項目名が複数あれば，最初のものを使う
+    cur = db.executemany('INSERT OR IGNORE INTO pages VALUES (?, ?, ?, ?)',
+                         batch)
+    return cur.rowcount
+
+
+class WikiIndex:
+    """
+    build_index()で作った索引から概要を引くクラス
+    """
+
+    def __init__(self, path):
+        self.db_uri = 'file:{}?mode=ro'.format(os.path.abspath(path))
+        self.db = sqlite3.connect(self.db_uri, uri=True,
+                                  check_same_thread=False)
+        self.lock = threading.Lock()
+
+    def lookup(self, title):
+        """
+        項目名から(項目名, 概要)を返す，リダイレクトはたどる
+        見つからなければNoneを返す
+        """
+        key = normalize_title(title)
+        with self.lock:
+            for i in range(MAX_REDIRECTS+1):
+                row = self.db.execute(
+                    'SELECT title, abstract, redirect FROM pages WHERE key = ?',
+                    (key,)).fetchone()
+                if row is None:
+                    return None
+                if not row[2]:
+                    return row[0], row[1]
+                key = normalize_title(row[2])
+        return None
+
+    def titles(self):
+        """
+        索引に含まれる項目名を順に返すジェネレータ
+        (リダイレクトの項目名も含む)
+        """
+        db = sqlite3.connect(self.db_uri, uri=True)
+        try:
+            for row in db.execute('SELECT title FROM pages'):
+                yield row[0]
+        finally:
+            db.close()
+
+    def close(self):
+        self.db.close()
+
+
+class TitleResolver:
+    """
+    音声認識の結果と表記が少し違う項目名を，
+    既知の項目名の一覧から探すクラス
+    項目名をfold_title()で正規化した文字列のbigramで索引を作り，
+    Dice係数がthreshold以上で一番近い項目名を返す
+    項目名の一覧はすべてメモリに置くので，1項目名あたり約680バイト使う
+    (bench.pyのresolver.buildで測った値，x86_64のCPython 3.11．64ビットの
+    Raspberry Pi OSでもオブジェクトの大きさは同じなので，ほぼ同じになる)
+    日本語版の全項目名(リダイレクトを含めて約200万)では1.4GBほどになり，
+    Raspberry Piには載らないので，WIKI_TITLESで項目名を絞り込んで使う
+    (プラグインは索引の全項目名からは作らない)
+    """
+
+    def __init__(self, titles, threshold=0.6, max_postings=20000):
+        self.threshold = threshold
+        self.max_postings = max_postings
+        self.titles = []
+        self.folded = {}
+        self.postings = {}
+        for title in titles:
+            title = title.strip()
+            if not title:
+                continue
+            key = fold_title(title)
+            if key in self.folded:
+                continue
+            tid = len(self.titles)
+            self.titles.append(title)
+            self.folded[key] = tid
+            for g in ngrams(key):
+                ids = self.postings.get(g)
+                if ids is None:
+                    ids = self.postings[g] = array('I')
+                ids.append(tid)
+
+    @classmethod
+    def from_file(cls, path, **kwargs):
+        """
+        1行に1つ項目名を書いたファイル(all-titles-in-ns0など)から作る
+        """
+        with open_dump(path) as f:
+            return cls((line.decode('utf-8', 'replace') for line in f),
+                       **kwargs)
+
+    def resolve(self, word):
+        """
+        wordに一番近い項目名を返す，見つからなければNoneを返す
+        """
+        key = fold_title(word)
+        if key in self.folded:
+            return self.titles[self.folded[key]]
+        grams = ngrams(key)
+        if not grams:
+            return None
+        shared = Counter()
+        for g in grams:
+            ids = self.postings.get(g)
+            # 多くの項目名に含まれるbigramは手がかりにならないので使わない
+            if ids is None or len(ids) > self.max_postings:
+                continue
+            shared.update(ids)
+        best, best_score = None, self.threshold
+        for tid, n in shared.most_common(50):
+            other = len(ngrams(fold_title(self.titles[tid])))
+            score = 2.0 * n / (len(grams) + other)
+            if score >= best_score:
+                best, best_score = tid, score
+        if best is None:
+            return None
+        return self.titles[best]
+
+
+class NegativeCache:
+    """
+    存在しないとわかった項目名を，ttl秒の間覚えておくクラス
+    """
+
+    def __init__(self, ttl=3600, maxsize=1000, clock=time.monotonic):
+        self.ttl = ttl
+        self.maxsize = maxsize
+        self.clock = clock
+        self.entries = {}
+        self.lock = threading.Lock()
+
+    def add(self, word):
+        key = normalize_title(word)
+        with self.lock:
+            # 覚えている項目名は入れ直すだけで，他の項目名は捨てない
+            self.entries.pop(key, None)
+            if len(self.entries) >= self.maxsize:
+                # 一番古いものから捨てる
+                self.entries.pop(next(iter(self.entries)))
+            self.entries[key] = self.clock() + self.ttl
+
+    def __contains__(self, word):
+        key = normalize_title(word)
+        with self.lock:
+            expire = self.entries.get(key)
+            if expire is None:
+                return False
+            if self.clock() >= expire:
+                del self.entries[key]
+                return False
+            return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+            description='Wikipediaの概要ダンプからオフライン検索用の索引を作る')
+    sub = parser.add_subparsers(dest='command', required=True)
+    p_build = sub.add_parser('build', help='索引を作る')
+    p_build.add_argument('dump', help='jawiki-latest-abstract.xml(.gz/.bz2)')
+    p_build.add_argument('db', help='作成する索引ファイル')
+    p_lookup = sub.add_parser('lookup', help='索引から概要を引く')
+    p_lookup.add_argument('db', help='索引ファイル')
+    p_lookup.add_argument('title', help='項目名')
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    if args.command == 'build':
+        n = build_index(args.dump, args.db)
+        print("{}項目の索引を作りました。".format(n))
+    else:
+        r = WikiIndex(args.db).lookup(args.title)
+        print(r if r else "見つかりませんでした。")